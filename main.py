@@ -1,25 +1,53 @@
 import os
+import time
+import uuid
+import socket
+import queue
+import atexit
+import random
+import contextvars
+import functools
+import threading
+import bisect
+import zlib
+import asyncio
 import logging
-from logging.handlers import TimedRotatingFileHandler
-from datetime import datetime
+from contextlib import asynccontextmanager, contextmanager
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
+from datetime import datetime, timedelta, timezone
 from typing import Optional, Any, Dict
+import io
+import csv
 import json
+import hashlib
+import re
+import unicodedata
+from collections import OrderedDict, deque
 
 import httpx
+import numpy as np
+try:
+    import orjson  # Serialización JSON rápida (opcional)
+except ImportError:
+    orjson = None
 import requests
 from dotenv import load_dotenv
 
 # --- FASTAPI IMPORTS CORREGIDOS ---
-from fastapi import FastAPI, HTTPException, status, Depends  # <--- Faltaba Depends
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, status, Depends, Query, Request  # <--- Faltaba Depends
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
 
 # --- MOTOR / MONGO IMPORTS ---
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 # --- SQLALCHEMY IMPORTS CORREGIDOS ---
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, func, text, Float, Numeric # <--- Faltaban estos
-from sqlalchemy.orm import sessionmaker, Session, declarative_base # <--- Faltaba Session y declarative_base
+from sqlalchemy import bindparam, select, Column, Integer, String, Text, DateTime, func, text, Float, Numeric # <--- Faltaban estos
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.exc import DBAPIError, DataError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 """
 sudo docker-compose up -d --build
 
@@ -37,25 +65,834 @@ MAIN_AGENTID=os.getenv("MAIN_AGENTID")
 #Bot de summary
 SUMM_TOKEN=os.getenv("SUMM_TOKEN")
 SUMM_AGENTID=os.getenv("SUMM_AGENTID")
+
+# --- CONFIGURACIÓN CLIENTE HTTP (agents.dyna.ai) ---
+# Un solo cliente compartido por toda la app: reutiliza conexiones keep-alive
+# en lugar de pagar un handshake TCP+TLS nuevo en cada llamada al agente.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() in ("1", "true", "yes")
+# Timeouts por endpoint (segundos)
+TIMEOUT_CHAT = float(os.getenv("TIMEOUT_CHAT", "15"))
+TIMEOUT_SUMMARY = float(os.getenv("TIMEOUT_SUMMARY", "10"))
+TIMEOUT_QUERY = float(os.getenv("TIMEOUT_QUERY", "45"))
+TIMEOUT_TEST = float(os.getenv("TIMEOUT_TEST", "15"))
+AGENT_STREAMING = os.getenv("AGENT_STREAMING", "false").lower() in ("1", "true", "yes")  # El agente soporta respuestas SSE
+
+# --- CONFIGURACIÓN BATCH DE RESÚMENES ---
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "8"))   # Workers simultáneos (get_chat + summarize)
+SUMMARY_BULK_SIZE = int(os.getenv("SUMMARY_BULK_SIZE", "100"))     # Updates por bulk_write
+SUMMARY_CURSOR_BATCH = int(os.getenv("SUMMARY_CURSOR_BATCH", "500"))
+# Solo re-resumir conversaciones con mensajes nuevos (hash / último mensaje)
+SUMMARY_INCREMENTAL = os.getenv("SUMMARY_INCREMENTAL", "true").lower() in ("1", "true", "yes")
+
+# --- CONFIGURACIÓN ÍNDICE DE SEGMENTOS (teléfono -> segment_code) ---
+SEGMENT_INDEX_TTL = float(os.getenv("SEGMENT_INDEX_TTL", "300"))            # Segundos antes de reconstruir
+SEGMENT_INDEX_MISS_REFRESH = float(os.getenv("SEGMENT_INDEX_MISS_REFRESH", "60"))  # Edad mínima para reconstruir ante un fallo
+SEGMENT_PAGE_SIZE = int(os.getenv("SEGMENT_PAGE_SIZE", "100"))
+SEGMENT_PAGE_CONCURRENCY = int(os.getenv("SEGMENT_PAGE_CONCURRENCY", "4"))
+SEGMENT_MAX_PAGES = int(os.getenv("SEGMENT_MAX_PAGES", "500"))
+PHONE_SUFFIX_DIGITS = 10  # Número nacional (MX) sin lada de país
+
+# --- CONFIGURACIÓN CACHÉ NL -> SQL ---
+SQL_CACHE_SIZE = int(os.getenv("SQL_CACHE_SIZE", "1000"))
+SQL_CACHE_TTL = float(os.getenv("SQL_CACHE_TTL", "86400"))          # Segundos
+SQL_CACHE_PERSIST = os.getenv("SQL_CACHE_PERSIST", "true").lower() in ("1", "true", "yes")  # Nivel persistente en Mongo
+# Índice TTL del nivel persistente: Mongo borra las entradas viejas (de versiones anteriores del catálogo incluidas)
+SQL_CACHE_PERSIST_TTL = int(os.getenv("SQL_CACHE_PERSIST_TTL", str(int(SQL_CACHE_TTL))))  # Segundos
+CATALOG_VERSION_CHECK = float(os.getenv("CATALOG_VERSION_CHECK", "30"))  # Cada cuánto revisar si cambió el catálogo
+
+# --- CONFIGURACIÓN RUTA RÁPIDA (sin LLM) ---
+FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "true").lower() in ("1", "true", "yes")
+FAST_PATH_LLM_ANSWER = os.getenv("FAST_PATH_LLM_ANSWER", "false").lower() in ("1", "true", "yes")  # Redactar la respuesta con el agente
+FAST_PATH_MAX_ROWS = int(os.getenv("FAST_PATH_MAX_ROWS", "5"))
+FAST_PATH_MAX_RAM_GB = float(os.getenv("FAST_PATH_MAX_RAM_GB", "24"))  # "N GB" sin calificador mayor a esto no es RAM
+SEARCH_ROUTE_ENABLED = os.getenv("SEARCH_ROUTE_ENABLED", "true").lower() in ("1", "true", "yes")  # Preguntas por palabra clave -> índice
+SEARCH_ROUTE_MAX_TERMS = int(os.getenv("SEARCH_ROUTE_MAX_TERMS", "3"))
+
+# --- CONFIGURACIÓN COMPACTACIÓN DEL PROMPT DE ANÁLISIS ---
+COMPACT_TOKEN_BUDGET = int(os.getenv("COMPACT_TOKEN_BUDGET", "1500"))  # Tokens aprox. para los datos
+COMPACT_MAX_TEXT = int(os.getenv("COMPACT_MAX_TEXT", "160"))           # Caracteres por campo de texto
+COMPACT_MAX_COLUMNS = int(os.getenv("COMPACT_MAX_COLUMNS", "12"))
+
+# --- CONFIGURACIÓN STREAMING DE /test-sql-raw ---
+SQL_STREAM_BATCH = int(os.getenv("SQL_STREAM_BATCH", "500"))         # Filas por fetch del cursor del servidor
+SQL_STREAM_MAX_ROWS = int(os.getenv("SQL_STREAM_MAX_ROWS", "100000"))  # Tope de filas por respuesta
+
+# --- CONFIGURACIÓN GUARDRAILS DEL SQL GENERADO ---
+GUARD_MAX_ROWS = int(os.getenv("GUARD_MAX_ROWS", "200"))                      # LIMIT máximo
+GUARD_STATEMENT_TIMEOUT_MS = int(os.getenv("GUARD_STATEMENT_TIMEOUT_MS", "5000"))
+GUARD_MAX_COST = float(os.getenv("GUARD_MAX_COST", "0"))                      # 0 = sin chequeo EXPLAIN
+
+# --- CONFIGURACIÓN PLANTILLAS SQL ---
+SQL_TEMPLATE_CACHE_SIZE = int(os.getenv("SQL_TEMPLATE_CACHE_SIZE", "500"))
 # --- CONFIGURACIÓN DE LOGS ---
+# El event loop solo encola el LogRecord (QueueHandler); el formateo a JSON y la
+# escritura a disco ocurren en el hilo del QueueListener.
 if not os.path.exists("logs"):
     os.makedirs("logs")
 
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()        # json | text
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # 0 = sin límite
+# Muestreo de etapas ruidosas (solo INFO/DEBUG): "query=0.2,chat=0.1,summary=0.5"
+LOG_SAMPLING = {
+    nombre.strip(): float(tasa)
+    for nombre, tasa in (par.split("=", 1) for par in os.getenv("LOG_SAMPLING", "").split(",") if "=" in par)
+}
+
+request_id_var: contextvars.ContextVar = contextvars.ContextVar("request_id", default="-")
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Una línea JSON por registro: ts, level, logger, request_id, msg (+ extra 'fields')."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    """Agrega el request_id del contexto (se evalúa en el hilo que emite el log)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Descarta una fracción de los INFO/DEBUG de loggers ruidosos ('marketing_agent.<etapa>')."""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        etapa = record.name.rsplit(".", 1)[-1]
+        tasa = self.rates.get(etapa)
+        return tasa is None or random.random() < tasa
+
+
+class IndexedRotatingFileHandler(TimedRotatingFileHandler):
+    """Al rotar, el índice ts->offset del archivo activo pasa al archivo rotado (mismo inode)."""
+
+    def doRollover(self):
+        super().doRollover()
+        try:
+            log_index.on_rollover(self.baseFilename)
+        except Exception:
+            pass  # El índice se reconstruye bajo demanda
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    QueueHandler que NO formatea en el hilo del request: el mensaje
+    (msg % args) se arma después, en el hilo del listener. Si la cola
+    está llena descarta el registro y lo cuenta (no bloquea ni imprime).
+    """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
 logger = logging.getLogger("marketing_agent")
 logger.setLevel(logging.INFO)
+logger.propagate = False
 
-handler = TimedRotatingFileHandler(LOG_FILE_PATH, when="midnight", interval=1, backupCount=7)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler = IndexedRotatingFileHandler(LOG_FILE_PATH, when="midnight", interval=1, backupCount=7, encoding="utf-8")
+formatter = JsonLogFormatter() if LOG_FORMAT == "json" else \
+    logging.Formatter('%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s')
 handler.setFormatter(formatter)
-logger.addHandler(handler)
+
+log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+queue_handler = LazyQueueHandler(log_queue)
+queue_handler.addFilter(SamplingFilter(LOG_SAMPLING))
+queue_handler.addFilter(RequestContextFilter())
+logger.addHandler(queue_handler)
+
+log_listener = QueueListener(log_queue, handler, respect_handler_level=True)
+
+
+_log_listener_started = False
+
+
+def start_log_listener():
+    global _log_listener_started
+    if not _log_listener_started:
+        log_listener.start()
+        _log_listener_started = True
+
+
+def stop_log_listener():
+    """Vacía la cola pendiente y detiene el hilo escritor (idempotente)."""
+    global _log_listener_started
+    if _log_listener_started:
+        log_listener.stop()
+        _log_listener_started = False
+
+
+start_log_listener()
+atexit.register(stop_log_listener)
+
+# Loggers por etapa (para muestreo): comparten handler con 'marketing_agent'
+query_logger = logger.getChild("query")
+chat_logger = logger.getChild("chat")
+summary_logger = logger.getChild("summary")
+lead_logger = logger.getChild("lead")
+# -----------------------------
+
+# --- MÉTRICAS (formato Prometheus) ---
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "false").lower() == "true"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Etapas medidas durante el request actual (para la cabecera Server-Timing)
+server_timing_var: contextvars.ContextVar = contextvars.ContextVar("server_timing", default=None)
+
+
+class MetricsRegistry:
+    """
+    Contadores e histogramas en memoria, expuestos en el formato de texto de
+    Prometheus. Los gauges (pools, cachés) se leen al momento con 'collectors'.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._histograms: Dict[str, Dict[tuple, list]] = {}
+        self._help: Dict[str, str] = {}
+        self._collectors = []
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def inc(self, name: str, labels: Optional[Dict[str, str]] = None, value: float = 1.0):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(sorted((labels or {}).items()))
+        series = self._counters.setdefault(name, {})
+        series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, labels: Optional[Dict[str, str]], seconds: float):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(sorted((labels or {}).items()))
+        series = self._histograms.setdefault(name, {})
+        hist = series.get(key)
+        if hist is None:
+            hist = series[key] = [0] * len(self.buckets) + [0.0, 0]  # buckets..., sum, count
+        i = bisect.bisect_left(self.buckets, seconds)
+        if i < len(self.buckets):
+            hist[i] += 1
+        hist[-2] += seconds
+        hist[-1] += 1
+
+    def collector(self, fn):
+        """Registra fn() -> [(nombre, tipo, labels, valor)] evaluada en cada scrape."""
+        self._collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _labels(key, extra: str = "") -> str:
+        partes = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in key]
+        if extra:
+            partes.append(extra)
+        return "{" + ",".join(partes) + "}" if partes else ""
+
+    def _header(self, lines: list, name: str, kind: str):
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    def render(self) -> str:
+        lines = []
+        for name, series in self._counters.items():
+            self._header(lines, name, "counter")
+            for key, value in series.items():
+                lines.append(f"{name}{self._labels(key)} {value:g}")
+        for name, series in self._histograms.items():
+            self._header(lines, name, "histogram")
+            for key, hist in series.items():
+                acumulado = 0
+                for bound, count in zip(self.buckets, hist):
+                    acumulado += count
+                    lines.append("%s_bucket%s %d" % (name, self._labels(key, 'le="%g"' % bound), acumulado))
+                lines.append("%s_bucket%s %d" % (name, self._labels(key, 'le="+Inf"'), hist[-1]))
+                lines.append(f"{name}_sum{self._labels(key)} {hist[-2]:.6f}")
+                lines.append(f"{name}_count{self._labels(key)} {hist[-1]}")
+        agrupadas: Dict[str, list] = {}
+        for fn in self._collectors:
+            try:
+                for name, kind, labels, value in fn():
+                    agrupadas.setdefault((name, kind), []).append((labels, value))
+            except Exception as e:
+                logger.error("Error en colector de métricas %s: %s", getattr(fn, "__name__", fn), e)
+        for (name, kind), muestras in agrupadas.items():
+            self._header(lines, name, kind)
+            for labels, value in muestras:
+                lines.append(f"{name}{self._labels(tuple(sorted(labels.items())))} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry(LATENCY_BUCKETS)
+metrics.describe("stage_duration_seconds", "Duración por etapa (query_*, get_chat, summarize, mongo_*)")
+metrics.describe("http_request_duration_seconds", "Duración de requests entrantes por ruta")
+metrics.describe("http_requests_total", "Requests entrantes por ruta y status")
+metrics.describe("outbound_requests_total", "Requests salientes del cliente HTTP por host y resultado")
+metrics.describe("outbound_request_duration_seconds", "Latencia hasta cabeceras de requests salientes por host")
+
+
+def record_stage(stage: str, seconds: float):
+    metrics.observe("stage_duration_seconds", {"stage": stage}, seconds)
+    timings = server_timing_var.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """Mide el bloque como etapa (histograma + Server-Timing del request actual)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+
+def timed_stage(stage: str):
+    """Decorador para corrutinas completas (get_chat, summarize)."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
 # -----------------------------
 
-app = FastAPI(title="Marketing Agent Tool API")
+http_client: Optional[httpx.AsyncClient] = None
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """Envuelve el transporte con pool para contar resultados y latencia por host."""
+
+    def __init__(self, inner: httpx.AsyncHTTPTransport):
+        self.inner = inner
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            response = await self.inner.handle_async_request(request)
+            outcome = f"{response.status_code // 100}xx"
+            return response
+        except httpx.TimeoutException:
+            outcome = "timeout"
+            raise
+        finally:
+            host = request.url.host
+            metrics.inc("outbound_requests_total", {"host": host, "outcome": outcome})
+            metrics.observe("outbound_request_duration_seconds", {"host": host}, time.perf_counter() - started)
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+
+def build_http_client() -> httpx.AsyncClient:
+    """Crea el cliente HTTP con pool de conexiones configurable."""
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    )
+    http2 = HTTP2_ENABLED
+    if http2:
+        try:
+            import h2  # noqa: F401  (httpx[http2])
+        except ImportError:
+            logger.warning("HTTP2_ENABLED pero el paquete 'h2' no está instalado. Usando HTTP/1.1")
+            http2 = False
+    return httpx.AsyncClient(
+        transport=InstrumentedTransport(httpx.AsyncHTTPTransport(limits=limits, http2=http2)),
+        timeout=httpx.Timeout(TIMEOUT_QUERY, connect=HTTP_CONNECT_TIMEOUT)
+    )
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Devuelve el cliente compartido. Si se llama fuera del ciclo de vida de la app
+    (scripts, pruebas manuales) se crea bajo demanda.
+    """
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = build_http_client()
+    return http_client
+
+
+def endpoint_timeout(seconds: float) -> httpx.Timeout:
+    """Timeout por llamada respetando el timeout de conexión global."""
+    return httpx.Timeout(seconds, connect=min(HTTP_CONNECT_TIMEOUT, seconds))
+
+
+# --- RESILIENCIA DEL AGENTE (reintentos, hedging, circuit breaker) ---
+# call_agent_api y summarize pasan por un ResilientCaller: reintentos con
+# backoff exponencial y jitter completo, limitados por un presupuesto global
+# (una fracción de las llamadas); hedging opcional tras el p95 observado; y un
+# circuit breaker por llamador que falla rápido mientras el agente está caído.
+# El timeout del endpoint es el plazo total de la llamada, no por intento.
+AGENT_RETRY_MAX_ATTEMPTS = int(os.getenv("AGENT_RETRY_MAX_ATTEMPTS", "3"))      # 1 = sin reintentos
+AGENT_RETRY_BASE_MS = float(os.getenv("AGENT_RETRY_BASE_MS", "200"))
+AGENT_RETRY_MAX_BACKOFF_MS = float(os.getenv("AGENT_RETRY_MAX_BACKOFF_MS", "2000"))
+AGENT_RETRY_BUDGET_RATIO = float(os.getenv("AGENT_RETRY_BUDGET_RATIO", "0.2"))  # reintentos+hedges por llamada
+AGENT_RETRY_BUDGET_MIN_PER_S = float(os.getenv("AGENT_RETRY_BUDGET_MIN_PER_S", "1"))  # piso con poco tráfico
+AGENT_RETRY_BUDGET_MAX = float(os.getenv("AGENT_RETRY_BUDGET_MAX", "20"))
+# El diálogo del agente no es idempotente (registra el turno): hedging apagado por defecto
+AGENT_HEDGE_ENABLED = os.getenv("AGENT_HEDGE_ENABLED", "false").lower() == "true"
+AGENT_HEDGE_QUANTILE = float(os.getenv("AGENT_HEDGE_QUANTILE", "0.95"))
+AGENT_HEDGE_MIN_MS = float(os.getenv("AGENT_HEDGE_MIN_MS", "300"))
+AGENT_HEDGE_MIN_SAMPLES = int(os.getenv("AGENT_HEDGE_MIN_SAMPLES", "20"))
+AGENT_BREAKER_WINDOW = int(os.getenv("AGENT_BREAKER_WINDOW", "20"))             # últimas llamadas evaluadas
+AGENT_BREAKER_MIN_CALLS = int(os.getenv("AGENT_BREAKER_MIN_CALLS", "10"))
+AGENT_BREAKER_FAILURE_RATIO = float(os.getenv("AGENT_BREAKER_FAILURE_RATIO", "0.5"))
+AGENT_BREAKER_OPEN_S = float(os.getenv("AGENT_BREAKER_OPEN_S", "30"))           # antes de la llamada de prueba
+
+
+class AgentUnavailable(Exception):
+    """Circuito abierto: el agente falló demasiado y la llamada se rechaza sin intentarla."""
+
+    def __init__(self, caller: str, retry_after: float):
+        super().__init__(f"El agente '{caller}' no está disponible temporalmente (reintenta en {retry_after:.0f}s).")
+        self.caller = caller
+        self.retry_after = retry_after
+
+
+def _agent_failure(exc: BaseException) -> bool:
+    """Fallas atribuibles al agente (reintentables y cuentan para el breaker); un 4xx es culpa nuestra."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        code = exc.response.status_code
+        return code == 429 or code >= 500
+    return isinstance(exc, httpx.TransportError)  # timeouts, conexión, protocolo
+
+
+class RetryBudget:
+    """
+    Token bucket compartido: cada llamada deposita AGENT_RETRY_BUDGET_RATIO y
+    cada reintento o hedge gasta 1, así una caída no multiplica la carga.
+    """
+
+    def __init__(self, ratio: float, min_per_s: float, capacity: float):
+        self.ratio = ratio
+        self.min_per_s = min_per_s
+        self.capacity = capacity
+        self.tokens = capacity
+        self._last = time.monotonic()
+        self.exhausted = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.min_per_s)
+        self._last = now
+
+    def deposit(self):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill()
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        self.exhausted += 1
+        return False
+
+
+class CircuitBreaker:
+    """
+    closed -> open cuando la tasa de fallas de la ventana supera el umbral;
+    open -> half_open tras AGENT_BREAKER_OPEN_S; una llamada de prueba decide
+    si vuelve a closed o a open.
+    """
+
+    def __init__(self, window: int, min_calls: int, failure_ratio: float, open_s: float):
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.open_s = open_s
+        self.state = "closed"
+        self._outcomes: deque = deque(maxlen=window)  # True = éxito
+        self._opened_at = 0.0
+        self._probe = False
+        self.opened_total = 0
+        self.rejected = 0
+
+    def retry_after(self) -> float:
+        return max(0.0, self._opened_at + self.open_s - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if self.retry_after() > 0:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probe:
+                self.rejected += 1
+                return False
+            self._probe = True
+        return True
+
+    def record(self, ok: bool):
+        if self.state == "half_open":
+            self._probe = False
+            if ok:
+                self.state = "closed"
+                self._outcomes.clear()
+                logger.info("Circuito del agente cerrado: la llamada de prueba tuvo éxito")
+            else:
+                self._open()
+            return
+        self._outcomes.append(ok)
+        fallas = self._outcomes.count(False)
+        if (self.state == "closed" and len(self._outcomes) >= self.min_calls
+                and fallas / len(self._outcomes) >= self.failure_ratio):
+            self._open()
+
+    def release(self):
+        """La llamada terminó sin veredicto (cancelada): libera la prueba de half_open."""
+        if self.state == "half_open":
+            self._probe = False
+
+    def _open(self):
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self.opened_total += 1
+        logger.warning("Circuito del agente abierto por %.0fs", self.open_s)
+
+    def failure_rate(self) -> float:
+        return round(self._outcomes.count(False) / len(self._outcomes), 3) if self._outcomes else 0.0
+
+
+class ResilientCaller:
+    """POST al agente con plazo total, reintentos con presupuesto, hedging y circuit breaker."""
+
+    def __init__(self, name: str, budget: RetryBudget, hedge: bool = AGENT_HEDGE_ENABLED):
+        self.name = name
+        self.budget = budget
+        self.hedge = hedge
+        self.breaker = CircuitBreaker(AGENT_BREAKER_WINDOW, AGENT_BREAKER_MIN_CALLS,
+                                      AGENT_BREAKER_FAILURE_RATIO, AGENT_BREAKER_OPEN_S)
+        self.latencies: deque = deque(maxlen=256)  # segundos de intentos exitosos
+        self.counts = {"calls": 0, "ok": 0, "failed": 0, "rejected": 0, "retries": 0,
+                       "hedges": 0, "hedge_wins": 0}
+
+    def latency_quantile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordenadas = sorted(self.latencies)
+        return ordenadas[min(len(ordenadas) - 1, int(q * len(ordenadas)))]
+
+    def hedge_delay(self) -> Optional[float]:
+        if not self.hedge or len(self.latencies) < AGENT_HEDGE_MIN_SAMPLES:
+            return None
+        return max(AGENT_HEDGE_MIN_MS / 1000.0, self.latency_quantile(AGENT_HEDGE_QUANTILE))
+
+    def _check(self):
+        if not self.breaker.allow():
+            self.counts["rejected"] += 1
+            raise AgentUnavailable(self.name, self.breaker.retry_after())
+
+    async def _attempt(self, url: str, headers, payload, timeout_s: float) -> httpx.Response:
+        started = time.perf_counter()
+        response = await get_http_client().post(url, headers=headers, json=payload,
+                                                timeout=endpoint_timeout(timeout_s))
+        response.raise_for_status()
+        self.latencies.append(time.perf_counter() - started)
+        return response
+
+    async def _hedged(self, url: str, headers, payload, deadline: float) -> httpx.Response:
+        """Un intento; si no respondió tras el p95, lanza un segundo y gana el primero exitoso."""
+        delay = self.hedge_delay()
+        primero = asyncio.create_task(self._attempt(url, headers, payload, deadline - time.monotonic()))
+        if delay is None or delay >= deadline - time.monotonic():
+            return await primero
+        pendientes = {primero}
+        try:
+            hechos, _ = await asyncio.wait(pendientes, timeout=delay)
+            if hechos or not self.budget.withdraw():
+                return await primero
+            self.counts["hedges"] += 1
+            segundo = asyncio.create_task(self._attempt(url, headers, payload, deadline - time.monotonic()))
+            pendientes.add(segundo)
+            error = None
+            while pendientes:
+                hechos, pendientes = await asyncio.wait(pendientes, return_when=asyncio.FIRST_COMPLETED)
+                for task in hechos:
+                    if task.exception() is None:
+                        if task is segundo:
+                            self.counts["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pendientes:
+                task.cancel()
+
+    async def post(self, url: str, headers, payload, timeout_s: float) -> httpx.Response:
+        """Devuelve la respuesta 2xx o propaga la última excepción de httpx (o AgentUnavailable)."""
+        self.counts["calls"] += 1
+        self.budget.deposit()
+        deadline = time.monotonic() + timeout_s
+        intento = 0
+        while True:
+            self._check()
+            try:
+                response = await self._hedged(url, headers, payload, deadline)
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except Exception as e:
+                if not _agent_failure(e):
+                    self.breaker.record(True)  # El agente respondió; el error es de la petición
+                    self.counts["failed"] += 1
+                    raise
+                self.breaker.record(False)
+                intento += 1
+                backoff = random.uniform(0, min(AGENT_RETRY_MAX_BACKOFF_MS, AGENT_RETRY_BASE_MS * 2 ** (intento - 1))) / 1000.0
+                if (intento >= AGENT_RETRY_MAX_ATTEMPTS or time.monotonic() + backoff >= deadline
+                        or not self.budget.withdraw()):
+                    self.counts["failed"] += 1
+                    raise
+                self.counts["retries"] += 1
+                logger.warning("Reintento %s/%s del agente '%s' en %.0f ms: %s",
+                               intento, AGENT_RETRY_MAX_ATTEMPTS - 1, self.name, backoff * 1000, e)
+                await asyncio.sleep(backoff)
+                continue
+            self.breaker.record(True)
+            self.counts["ok"] += 1
+            return response
+
+    @contextmanager
+    def tracked(self):
+        """Para llamadas que no se pueden reintentar (streaming): solo breaker y contadores."""
+        self.counts["calls"] += 1
+        self._check()
+        try:
+            yield
+        except (asyncio.CancelledError, GeneratorExit):
+            self.breaker.release()
+            raise
+        except Exception as e:
+            self.breaker.record(not _agent_failure(e))
+            self.counts["failed"] += 1
+            raise
+        self.breaker.record(True)
+        self.counts["ok"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        p50, p95 = self.latency_quantile(0.5), self.latency_quantile(0.95)
+        delay = self.hedge_delay()
+        return {
+            **self.counts,
+            "breaker": {"state": self.breaker.state, "failure_rate": self.breaker.failure_rate(),
+                        "opened_total": self.breaker.opened_total,
+                        "retry_after_s": round(self.breaker.retry_after(), 1) if self.breaker.state == "open" else 0.0},
+            "latency_ms": {"p50": round(p50 * 1000, 1) if p50 is not None else None,
+                           "p95": round(p95 * 1000, 1) if p95 is not None else None,
+                           "samples": len(self.latencies)},
+            "hedge": {"enabled": self.hedge, "delay_ms": round(delay * 1000, 1) if delay is not None else None},
+        }
+
+
+agent_retry_budget = RetryBudget(AGENT_RETRY_BUDGET_RATIO, AGENT_RETRY_BUDGET_MIN_PER_S, AGENT_RETRY_BUDGET_MAX)
+agent_callers = {
+    "query": ResilientCaller("query", agent_retry_budget),      # call_agent_api (NL->SQL y respuesta)
+    "summary": ResilientCaller("summary", agent_retry_budget),  # summarize (batch de resúmenes)
+}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    start_log_listener()
+    http_client = build_http_client()
+    logger.info("Cliente HTTP iniciado (max_conn=%s, keepalive=%s, http2=%s)", HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE, HTTP2_ENABLED)
+    index_task = asyncio.create_task(_ensure_indexes_background()) if MONGO_ENSURE_INDEXES else None
+    if LEAD_WRITE_BEHIND:
+        lead_writer.start()
+    summary_jobs.start_scheduler()
+    try:
+        yield
+    finally:
+        await summary_jobs.shutdown()  # El job queda 'interrupted' con su checkpoint
+        await lead_writer.stop()  # No perder leads en el buffer
+        if index_task and not index_task.done():
+            index_task.cancel()
+        await http_client.aclose()
+        http_client = None
+        logger.info("Cliente HTTP cerrado.")
+        await engine.dispose()
+        stop_log_listener()
+
+
+app = FastAPI(title="Marketing Agent Tool API", lifespan=lifespan)
+
+
+@app.middleware("http")
+async def request_id_middleware(request, call_next):
+    """ID de correlación por request (X-Request-ID entrante o uno nuevo) para los logs."""
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex[:12]
+    token = request_id_var.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        request_id_var.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+
+@app.middleware("http")
+async def metrics_middleware(request, call_next):
+    """Latencia por ruta y, si SERVER_TIMING_ENABLED, cabecera Server-Timing con las etapas."""
+    timings = []
+    token = server_timing_var.set(timings)
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        server_timing_var.reset(token)
+        elapsed = time.perf_counter() - started
+        path = getattr(request.scope.get("route"), "path", "unmatched")
+        metrics.inc("http_requests_total", {"method": request.method, "path": path, "status": str(status_code)})
+        metrics.observe("http_request_duration_seconds", {"path": path}, elapsed)
+    if SERVER_TIMING_ENABLED:
+        # En respuestas en stream solo aparecen las etapas terminadas antes de las cabeceras
+        totales: Dict[str, float] = {}
+        for stage, seconds in timings:
+            totales[stage] = totales.get(stage, 0.0) + seconds
+        partes = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in totales.items()]
+        partes.append(f"total;dur={elapsed * 1000:.1f}")
+        response.headers["Server-Timing"] = ", ".join(partes)
+    return response
 
 # 2. Configuración de Base de Datos
 client = AsyncIOMotorClient(MONGO_URI)
 db = client.marketing_db
 users_collection = db.users
+sql_cache_collection = db.sql_cache
+summary_jobs_collection = db.summary_jobs
+job_locks_collection = db.job_locks
+
+# --- ÍNDICES DE MONGO ---
+# Única fuente de verdad de los índices: se crean al arrancar y se comparan
+# contra los existentes (drift). El barrido del batch por _id usa el índice
+# implícito de _id.
+MONGO_ENSURE_INDEXES = os.getenv("MONGO_ENSURE_INDEXES", "true").lower() == "true"
+MONGO_INDEX_FIX_DRIFT = os.getenv("MONGO_INDEX_FIX_DRIFT", "false").lower() == "true"  # drop + create
+
+MONGO_INDEXES = {
+    "users": [
+        # save_lead (upsert), get_lead (find_one) y el filtro {"$exists": True} del batch
+        {"name": "phone_number_unique", "keys": [("phone_number", 1)], "unique": True},
+        # Batch por antigüedad (?stale_hours=): rango sobre last_summary_at en orden estable
+        {"name": "summary_staleness", "keys": [("last_summary_at", 1), ("_id", 1)]},
+    ],
+    "summary_jobs": [
+        # Programador: último job por trigger y búsqueda de huérfanos por estado
+        {"name": "status_created", "keys": [("status", 1), ("created_at", -1)]},
+        {"name": "trigger_created", "keys": [("trigger", 1), ("created_at", -1)]},
+    ],
+    "sql_cache": [
+        # Sin esto solo el LRU en memoria expulsa: las traducciones persistidas crecerían sin fin
+        {"name": "created_at_ttl", "keys": [("created_at", 1)], "expireAfterSeconds": SQL_CACHE_PERSIST_TTL},
+    ],
+}
+
+mongo_index_state: Dict[str, Any] = {"checked_at": None, "collections": {}}
+
+
+def _index_options(spec: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in spec.items() if k not in ("name", "keys")}
+
+
+def _index_drift(spec: Dict[str, Any], actual: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Motivo por el que el índice existente no coincide con la declaración (o None)."""
+    if actual is None:
+        return "missing"
+    if [tuple(k) for k in actual.get("key", [])] != [tuple(k) for k in spec["keys"]]:
+        return f"keys {actual.get('key')} != {spec['keys']}"
+    for option, value in _index_options(spec).items():
+        if actual.get(option, False) != value:
+            return f"{option}={actual.get(option, False)} (esperado {value})"
+    return None
+
+
+async def ensure_mongo_indexes(fix_drift: bool = MONGO_INDEX_FIX_DRIFT) -> Dict[str, Any]:
+    """Crea los índices faltantes y reporta los que difieren o sobran."""
+    resumen: Dict[str, Any] = {}
+    for coll_name, specs in MONGO_INDEXES.items():
+        collection = db[coll_name]
+        existentes = await collection.index_information()
+        estado = {"created": [], "ok": [], "drift": {}, "extra": [], "errors": {}}
+        for spec in specs:
+            motivo = _index_drift(spec, existentes.get(spec["name"]))
+            if motivo is None:
+                estado["ok"].append(spec["name"])
+                continue
+            if motivo != "missing":
+                if not fix_drift:
+                    estado["drift"][spec["name"]] = motivo
+                    logger.warning("Índice %s.%s con drift: %s", coll_name, spec["name"], motivo)
+                    continue
+                await collection.drop_index(spec["name"])
+            try:
+                await collection.create_index(spec["keys"], name=spec["name"], **_index_options(spec))
+                estado["created"].append(spec["name"])
+                logger.info("Índice creado: %s.%s", coll_name, spec["name"])
+            except Exception as e:
+                # p.ej. teléfonos duplicados impiden el índice único
+                estado["errors"][spec["name"]] = str(e)
+                logger.error("No se pudo crear el índice %s.%s: %s", coll_name, spec["name"], e)
+        declarados = {spec["name"] for spec in specs} | {"_id_"}
+        estado["extra"] = sorted(set(existentes) - declarados)
+        resumen[coll_name] = estado
+    mongo_index_state.update(checked_at=datetime.utcnow().isoformat(), collections=resumen)
+    return resumen
+
+
+async def _ensure_indexes_background():
+    # En segundo plano: un Mongo lento o caído no retrasa el arranque de la API
+    try:
+        await ensure_mongo_indexes()
+    except Exception as e:
+        mongo_index_state["error"] = str(e)
+        logger.error("Error asegurando índices de Mongo: %s", e)
+
 
 # --- CONFIG SQL (Nueva) ---
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
@@ -63,8 +900,35 @@ if not SQLALCHEMY_DATABASE_URL:
     # Agrega un fallback o lanza error si no hay URL, sino crasheará create_engine
     print("ADVERTENCIA: DATABASE_URL no seteada") 
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))   # Segundos
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_PREPARED_CACHE_SIZE = int(os.getenv("DB_PREPARED_CACHE_SIZE", "500"))  # Prepared statements por conexión (asyncpg)
+
+
+def async_database_url(url: str) -> str:
+    """Convierte 'postgresql://...' (docker-compose) al driver asíncrono asyncpg."""
+    if not url:
+        return url
+    for prefix in ("postgresql+psycopg2://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix):]
+    return url
+
+
+# Motor asíncrono: las consultas ya no bloquean el event loop de uvicorn
+engine = create_async_engine(
+    async_database_url(SQLALCHEMY_DATABASE_URL),
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_timeout=DB_POOL_TIMEOUT,
+    connect_args={"prepared_statement_cache_size": DB_PREPARED_CACHE_SIZE}
+)
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 
@@ -205,10 +1069,24 @@ class MobileDevice(Base):
 class QueryRequest(BaseModel):
     nlp_query: str
     function_call_username: Optional[str] = None
+    stream: bool = False  # True = eventos NDJSON por etapa (equivale a ?stream=ndjson)
 
 class SqlRequest(BaseModel):
     sql: str
 
+class CatalogFilter(BaseModel):
+    column: str
+    op: str = Field("==", description="<, <=, >, >=, ==, != o contains (texto)")
+    value: Any
+
+class CatalogQuery(BaseModel):
+    table: str = Field(..., description="especificaciones_producto o dispositivos_moviles")
+    filters: list[CatalogFilter] = []
+    sort_by: Optional[str] = None
+    descending: bool = False
+    limit: Optional[int] = Field(None, ge=1)
+    columns: Optional[list[str]] = None
+
 class UserProfile(BaseModel):
     function_call_username: str = Field(..., description="Identificador o teléfono del usuario (puede incluir prefijos con --)")
     #preferences: str = Field(..., description="Texto libre con preferencias o resumen")
@@ -226,19 +1104,80 @@ class AgentResponse(BaseModel):
 
 # 4. Helper de Respuesta (Tu nuevo método)
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-def responder(status_code: int, title: str, raw_data: Dict[str, Any]):
+# --- SERIALIZACIÓN JSON (una sola pasada) ---
+
+def json_bytes(obj: Any) -> bytes:
+    """Codifica a JSON UTF-8 una sola vez; tipos desconocidos -> str (como default=str)."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str)
+    return json.dumps(obj, default=str, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def json_text(obj: Any) -> str:
+    return json_bytes(obj).decode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse que renderiza con orjson (o json si no está instalado)."""
+
+    def render(self, content: Any) -> bytes:
+        return json_bytes(content)
+
+
+_JSON_NATIVE = (str, int, float, bool, dict, list)
+
+
+def _column_converter(sample: Any):
+    """Convertidor para una columna según el tipo de su primer valor no nulo (None = ya es JSON nativo)."""
+    if isinstance(sample, _JSON_NATIVE):
+        return None
+    # Decimal (Numeric), datetime, date, time, UUID...: misma salida que json.dumps(default=str)
+    return str
+
+
+def row_converters(keys, rows) -> list:
+    """Elige (índice, columna, convertidor) una vez por columna a partir de una muestra de filas."""
+    converters = []
+    for i, key in enumerate(keys):
+        sample = next((row[i] for row in rows if row[i] is not None), None)
+        converter = _column_converter(sample) if sample is not None else None
+        if converter is not None:
+            converters.append((i, key, converter))
+    return converters
+
+
+def rows_to_dicts(keys, rows, converters) -> list:
+    data = []
+    for row in rows:
+        item = dict(zip(keys, row))
+        for i, key, converter in converters:
+            value = row[i]
+            if value is not None:
+                item[key] = converter(value)
+        data.append(item)
+    return data
+
+
+def serialize_rows(result) -> list:
+    """
+    Convierte un Result de SQLAlchemy en lista de dicts JSON-nativos en una sola pasada.
+    Los convertidores se eligen una vez por columna (a partir de result.keys() y
+    del tipo de sus valores), no por celda; las columnas nativas no se tocan.
+    """
+    keys = list(result.keys())
+    rows = result.all()
+    return rows_to_dicts(keys, rows, row_converters(keys, rows))
+
+
+def envelope(status_code: int, title: str, raw_data: Dict[str, Any]) -> Dict[str, Any]:
     """
     Estandariza la respuesta según tus requerimientos:
     - Inyecta 'status': 'exito'/'error' en raw.
     - Genera markdown y desc combinando title y mensaje.
-    - Retorna JSONResponse.
     """
     # Buscamos el mensaje en las claves comunes o usamos un default
     mensaje = raw_data.get("mensaje") or raw_data.get("msgRetorno") or "Operación completada."
@@ -246,137 +1185,328 @@ def responder(status_code: int, title: str, raw_data: Dict[str, Any]):
     # Determinamos status basado en el código HTTP
     status_str = "error" if status_code >= 400 else "exito"
     
-    return JSONResponse(status_code=status_code, content={
+    return {
         "raw": {"status": status_str, **raw_data},
         "markdown": f"**{title}**\n\n{mensaje}",
         "type": "markdown",
         "desc": f"{mensaje}\n\n"
-    })
+    }
 
-async def get_chat(telefono_objetivo):
+def responder(status_code: int, title: str, raw_data: Dict[str, Any]):
+    """Retorna JSONResponse con el formato estándar de envelope()."""
+    return FastJSONResponse(status_code=status_code, content=envelope(status_code, title, raw_data))
+
+AGENT_SEGMENT_LIST_URL = 'https://agents.dyna.ai/openapi/v1/conversation/segment/get_list/'
+AGENT_SEGMENT_DETAIL_URL = 'https://agents.dyna.ai/openapi/v1/conversation/segment/detail_list/'
+
+
+def _clean_env(name: str) -> str:
+    # A veces .env carga comillas extra o saltos de linea que rompen la API
+    return os.getenv(name, "").replace('"', '').replace("'", "").strip()
+
+
+def main_bot_credentials():
+    """Devuelve (AS_ACCOUNT, headers) del MAIN BOT o None si faltan datos."""
+    MAIN_AGENTID = _clean_env("MAIN_AGENTID")
+    MAIN_TOKEN = _clean_env("MAIN_TOKEN")
+    AS_ACCOUNT = _clean_env("AS_ACCOUNT")
+
+    # Validación rápida para no hacer petición si faltan datos
+    if not all([MAIN_AGENTID, MAIN_TOKEN, AS_ACCOUNT]):
+        chat_logger.error("Faltan credenciales en variables de entorno")
+        return None
+
+    headers = {
+        'Content-Type': 'application/json',
+        'cybertron-robot-key': MAIN_AGENTID,
+        'cybertron-robot-token': MAIN_TOKEN
+    }
+    return AS_ACCOUNT, headers
+
+
+def extract_phone(username: str) -> str:
+    """Teléfono del function_call_username ('wa--5215512345678' -> '5215512345678')."""
+    return username.split("--")[-1] if "--" in username else username
+
+
+def normalize_phone(value: str) -> str:
+    """Deja solo los dígitos del teléfono ('+52 55-1060-9610' -> '525510609610')."""
+    return "".join(ch for ch in (value or "") if ch.isdigit())
+
+
+class SegmentIndex:
     """
-    Obtiene el historial del MAIN BOT.
-    Args:
-        telefono_objetivo (str): Número de teléfono (ej: '525510609610' o '+525510609610')
+    Mapa teléfono normalizado -> segment_code construido con un solo barrido
+    paginado (y concurrente) de segment/get_list. Se reconstruye por TTL.
+    Un solo barrido en vuelo (los demás lo esperan) y, salvo force, al menos
+    SEGMENT_INDEX_MISS_REFRESH segundos entre intentos, aunque el anterior fallara.
     """
-    try:
-        # 1. Carga y Limpieza AGRESIVA de credenciales
-        # A veces .env carga comillas extra o saltos de linea que rompen la API
-        MAIN_AGENTID = os.getenv("MAIN_AGENTID", "").replace('"', '').replace("'", "").strip()
-        MAIN_TOKEN = os.getenv("MAIN_TOKEN", "").replace('"', '').replace("'", "").strip()
-        AS_ACCOUNT = os.getenv("AS_ACCOUNT", "").replace('"', '').replace("'", "").strip()
-
-        # Validación rápida para no hacer petición si faltan datos
-        if not all([MAIN_AGENTID, MAIN_TOKEN, AS_ACCOUNT]):
-            logger.error("Faltan credenciales en variables de entorno")
-            return None
 
-        # Headers comunes
-        headers = {
-            'Content-Type': 'application/json',
-            'cybertron-robot-key': MAIN_AGENTID,
-            'cybertron-robot-token': MAIN_TOKEN
-        }
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._by_phone: Dict[str, str] = {}
+        self._by_suffix: Dict[str, str] = {}
+        self._built_at = 0.0
+        self._last_attempt = 0.0
+        self._inflight: Optional[asyncio.Task] = None
+        self.truncated = False
 
-        # ---------------------------------------------------------
-        # PASO 1: OBTENER LISTA DE CHATS
-        # ---------------------------------------------------------
-        url_list = 'https://agents.dyna.ai/openapi/v1/conversation/segment/get_list/'
-        
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self._built_at if self._built_at else float("inf")
+
+    def __len__(self):
+        return len(self._by_phone)
+
+    async def _fetch_page(self, client: httpx.AsyncClient, account: str, headers: Dict[str, str], page: int):
         payload_list = {
-            "username": AS_ACCOUNT, # Ya limpio
+            "username": account,
             "filter_mode": 0,
             "filter_user_code": "",
             "create_start_time": "",
             "create_end_time": "",
             "message_source": "",
-            "page": 1,
-            "pagesize": 20 
+            "page": page,
+            "pagesize": SEGMENT_PAGE_SIZE
         }
+        resp = await client.post(AGENT_SEGMENT_LIST_URL, headers=headers, json=payload_list, timeout=endpoint_timeout(TIMEOUT_CHAT))
+        resp.raise_for_status() # Lanza error si no es 200 OK
+        data = resp.json()
+        if data.get("code") != "000000":
+            raise RuntimeError(f"API Error Code: {data.get('code')} - {data.get('message')}")
+        body = data.get("data") or {}
+        return body.get("list", []) or [], body.get("total")
 
-        # Debug: Ver exactamente qué enviamos (comparar con Postman)
-        # logger.info(f"Enviando Payload List: {json.dumps(payload_list)}")
+    async def _sweep(self):
+        creds = main_bot_credentials()
+        if not creds:
+            return None
+        account, headers = creds
+        client = get_http_client()
 
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            resp_list = await client.post(url_list, headers=headers, json=payload_list)
-            resp_list.raise_for_status() # Lanza error si no es 200 OK
-            
-            data = resp_list.json()
+        # La primera página nos dice cuántas hay (si la API reporta 'total')
+        first, total = await self._fetch_page(client, account, headers, 1)
+        items = list(first)
+        if len(first) >= SEGMENT_PAGE_SIZE:
+            sem = asyncio.Semaphore(SEGMENT_PAGE_CONCURRENCY)
 
-            if data.get("code") != "000000":
-                logger.error(f"API Error Code: {data.get('code')} - {data.get('message')}")
-                return None
+            async def fetch(page):
+                async with sem:
+                    chats, _ = await self._fetch_page(client, account, headers, page)
+                    return chats
 
-            lista_chats = data.get("data", {}).get("list", [])
-            
-            # Debug: Ver cuántos chats devolvió la API
-            logger.info(f"Chats encontrados en la cuenta {AS_ACCOUNT}: {len(lista_chats)}")
-            
-            if not lista_chats:
-                logger.warning("La API devolvió una lista vacía. Verifica que AS_ACCOUNT coincida con el Postman.")
-                return None
+            truncated = False
+            if total:
+                pages = -(-int(total) // SEGMENT_PAGE_SIZE)
+                last_page = min(SEGMENT_MAX_PAGES, pages)
+                truncated = pages > SEGMENT_MAX_PAGES
+                for chats in await asyncio.gather(*(fetch(p) for p in range(2, last_page + 1))):
+                    items.extend(chats)
+            else:
+                # Sin 'total': pedimos ventanas de páginas hasta encontrar una incompleta
+                page = 2
+                truncated = True
+                while page <= SEGMENT_MAX_PAGES:
+                    window = range(page, min(page + SEGMENT_PAGE_CONCURRENCY, SEGMENT_MAX_PAGES + 1))
+                    results = await asyncio.gather(*(fetch(p) for p in window))
+                    for chats in results:
+                        items.extend(chats)
+                    if any(len(chats) < SEGMENT_PAGE_SIZE for chats in results):
+                        truncated = False
+                        break
+                    page += SEGMENT_PAGE_CONCURRENCY
+            self.truncated = truncated
+            if truncated:
+                # Los chats más viejos quedan fuera: sus leads no tendrán historial
+                chat_logger.warning("Barrido de segmentos truncado en SEGMENT_MAX_PAGES=%s (%s chats, total reportado %s)",
+                                    SEGMENT_MAX_PAGES, len(items), total)
+        else:
+            self.truncated = False
+        return items
 
-            # ---------------------------------------------------------
-            # FILTRADO INTELIGENTE DEL TELÉFONO
-            # ---------------------------------------------------------
-            # Limpiamos el telefono objetivo de espacios o guiones para buscar mejor
-            phone_clean = telefono_objetivo.replace(" ", "").replace("-", "").strip()
-            # Si el input no trae '+', probamos buscar con y sin él si es necesario, 
-            # pero 'in' suele ser suficiente si user_code es largo.
-            
-            segment_code = None
-            
-            for item in lista_chats:
-                user_code = item.get("user_code", "")
-                # Log para ver contra qué estamos comparando
-                # logger.info(f"Comparando {phone_clean} en {user_code}")
-                
-                if phone_clean in user_code:
-                    segment_code = item.get("segment_code")
-                    logger.info(f"MATCH ENCONTRADO: {segment_code} para usuario {user_code}")
-                    break
-            
-            if not segment_code:
-                logger.warning(f"No se encontró chat para el teléfono: {telefono_objetivo}")
-                return None
+    async def refresh(self, force: bool = False, max_age: Optional[float] = None) -> bool:
+        """
+        Reconstruye el índice si es más viejo que max_age (por defecto el TTL)
+        o si force=True. Devuelve True si se reconstruyó.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        if self._inflight is None or self._inflight.done():
+            if not force and (self.age < max_age
+                              or time.monotonic() - self._last_attempt < SEGMENT_INDEX_MISS_REFRESH):
+                return False
+            self._last_attempt = time.monotonic()
+            self._inflight = asyncio.create_task(self._rebuild())
+        # Los callers concurrentes comparten el mismo barrido; shield: cancelar a uno no lo aborta
+        return await asyncio.shield(self._inflight)
 
-            # ---------------------------------------------------------
-            # PASO 2: OBTENER DETALLE
-            # ---------------------------------------------------------
-            url_detail = 'https://agents.dyna.ai/openapi/v1/conversation/segment/detail_list/'
-
-            payload_detail = {
-                "username": AS_ACCOUNT, 
-                "segment_code": segment_code,
-                "create_start_time": "",
-                "create_end_time": "",
-                "message_source": "",
-                "question": "",
-                "page": 1,
-                "pagesize": 20 
-            }
+    async def _rebuild(self) -> bool:
+        items = await self._sweep()
+        if items is None:
+            return False
+        by_phone: Dict[str, str] = {}
+        by_suffix: Dict[str, str] = {}
+        # La API devuelve primero los chats más recientes: el primero gana
+        for item in items:
+            digits = normalize_phone(item.get("user_code", ""))
+            segment_code = item.get("segment_code")
+            if not digits or not segment_code:
+                continue
+            by_phone.setdefault(digits, segment_code)
+            by_suffix.setdefault(digits[-PHONE_SUFFIX_DIGITS:], segment_code)
+        self._by_phone, self._by_suffix = by_phone, by_suffix
+        self._built_at = time.monotonic()
+        chat_logger.info("Índice de segmentos reconstruido: %s teléfonos (%s chats)", len(by_phone), len(items))
+        return True
 
-            resp_detail = await client.post(url_detail, headers=headers, json=payload_detail)
-            resp_detail.raise_for_status()
-            
-            return resp_detail.json()
+    def get(self, telefono: str) -> Optional[str]:
+        digits = normalize_phone(telefono)
+        if not digits:
+            return None
+        return self._by_phone.get(digits) or self._by_suffix.get(digits[-PHONE_SUFFIX_DIGITS:])
 
-    except httpx.HTTPStatusError as e:
-        logger.error(f"Error HTTP: {e.response.status_code} - {e.response.text}")
-        return None
-    except Exception as e:
-        logger.error(f"Excepción en get_chat: {e}")
+    async def lookup(self, telefono: str) -> Optional[str]:
+        """Busca el segment_code en O(1); reconstruye si expiró o ante un fallo con índice viejo."""
+        if self.age >= self.ttl:
+            await self.refresh()
+        segment_code = self.get(telefono)
+        if segment_code is None and self.age >= SEGMENT_INDEX_MISS_REFRESH:
+            # Puede ser un chat nuevo desde el último barrido
+            await self.refresh(max_age=SEGMENT_INDEX_MISS_REFRESH)
+            segment_code = self.get(telefono)
+        return segment_code
+
+
+segment_index = SegmentIndex(SEGMENT_INDEX_TTL)
+
+
+@timed_stage("get_chat")
+async def get_chat(telefono_objetivo):
+    """
+    Obtiene el historial del MAIN BOT.
+    Args:
+        telefono_objetivo (str): Número de teléfono (ej: '525510609610' o '+525510609610')
+    """
+    try:
+        creds = main_bot_credentials()
+        if not creds:
+            return None
+        AS_ACCOUNT, headers = creds
+
+        # ---------------------------------------------------------
+        # PASO 1: BUSCAR EL SEGMENTO EN EL ÍNDICE (sin listar chats)
+        # ---------------------------------------------------------
+        segment_code = await segment_index.lookup(telefono_objetivo)
+
+        if not segment_code:
+            chat_logger.warning("No se encontró chat para el teléfono: %s", telefono_objetivo)
+            return None
+
+        # ---------------------------------------------------------
+        # PASO 2: OBTENER DETALLE
+        # ---------------------------------------------------------
+        payload_detail = {
+            "username": AS_ACCOUNT, 
+            "segment_code": segment_code,
+            "create_start_time": "",
+            "create_end_time": "",
+            "message_source": "",
+            "question": "",
+            "page": 1,
+            "pagesize": 20 
+        }
+
+        resp_detail = await get_http_client().post(
+            AGENT_SEGMENT_DETAIL_URL, headers=headers, json=payload_detail, timeout=endpoint_timeout(TIMEOUT_CHAT)
+        )
+        resp_detail.raise_for_status()
+        
+        return resp_detail.json()
+
+    except httpx.HTTPStatusError as e:
+        chat_logger.error("Error HTTP: %s - %s", e.response.status_code, e.response.text)
         return None
+    except Exception as e:
+        chat_logger.error("Excepción en get_chat: %s", e)
+        return None
+
+def chat_messages(chat_info) -> list:
+    """Extrae la lista de mensajes de la respuesta de detail_list."""
+    if not isinstance(chat_info, dict):
+        return []
+    return (chat_info.get("data") or {}).get("list", []) or []
+
+
+def _message_time(message: Dict[str, Any]) -> str:
+    return str(message.get("create_time") or message.get("created_at") or message.get("time") or "")
+
+
+_MESSAGE_TIME_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y/%m/%d %H:%M:%S", "%d/%m/%Y %H:%M:%S")
+
 
-async def summarize(conversation):
+def parse_message_time(value: Any) -> Optional[datetime]:
+    """
+    Fecha de un mensaje como datetime UTC sin zona, o None si no se reconoce.
+    Acepta 'YYYY-MM-DD HH:MM:SS', ISO 8601 (con T, Z u offset) y epoch en s o ms.
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        texto = str(value).strip()
+        try:
+            if re.fullmatch(r"\d+(?:\.\d+)?", texto):
+                epoch = float(texto)
+                parsed = datetime.fromtimestamp(epoch / 1000 if epoch > 1e11 else epoch, timezone.utc)
+            else:
+                parsed = datetime.fromisoformat(texto.replace("Z", "+00:00"))
+        except (ValueError, OverflowError, OSError):
+            parsed = None
+        if parsed is None:
+            # Horas sin cero a la izquierda ("2026-10-01 9:30:00") que fromisoformat rechaza
+            for fmt in _MESSAGE_TIME_FORMATS:
+                try:
+                    parsed = datetime.strptime(texto, fmt)
+                    break
+                except ValueError:
+                    continue
+            else:
+                return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def chat_fingerprint(chat_info):
+    """
+    Devuelve (hash del contenido, fecha del último mensaje) de un chat.
+    El hash es estable ante el orden de las llaves del JSON.
+    """
+    messages = chat_messages(chat_info)
+    payload = json.dumps(messages, sort_keys=True, ensure_ascii=False, default=str)
+    chat_hash = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    # Se guarda el texto original del mensaje más reciente (comparado ya parseado)
+    fechas = [(parse_message_time(t), t) for t in (_message_time(m) for m in messages)]
+    fechados = [f for f in fechas if f[0] is not None]
+    if fechados:
+        last_message_at = max(fechados, key=lambda f: f[0])[1]
+    else:
+        last_message_at = max((t for _, t in fechas), default="")
+    return chat_hash, last_message_at
+
+
+@timed_stage("summarize")
+async def summarize(conversation) -> Optional[str]:
     """
     Envía un texto (conversation) a la API del agente para obtener un resumen.
+    Devuelve None ante cualquier falla: el llamador no debe guardar nada y
+    el usuario se reintenta en la siguiente corrida.
     """
     
     # 1. Validar que tengamos datos para enviar
     if not conversation:
-        logger.warning("Intento de resumir una conversación vacía.")
-        return "No hay datos para resumir."
+        summary_logger.warning("Intento de resumir una conversación vacía.")
+        return None
 
     # 2. Obtener credenciales (se cargan al inicio con load_dotenv)
     AGENT_API_URL = os.getenv("AGENT_API_URL")
@@ -397,68 +1527,273 @@ async def summarize(conversation):
     }
 
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            # 4. Llamada a la API con httpx (asíncrono)
-            response = await client.post(AGENT_API_URL, headers=headers, json=payload)
-            
-            # Verificar códigos de error (4xx, 5xx)
-            response.raise_for_status()
+        # 4. Llamada a la API con httpx (asíncrono) usando el cliente compartido
+        # (reintentos y circuit breaker; los errores 4xx/5xx llegan como HTTPStatusError)
+        response = await agent_callers["summary"].post(AGENT_API_URL, headers, payload, TIMEOUT_SUMMARY)
 
-            # 5. Procesar respuesta
-            data = response.json()
-            
-            # Extraer la respuesta de forma segura
-            answer = data.get("data", {}).get("answer")
-            
-            if answer:
-                return answer
-            else:
-                logger.warning(f"La API respondió OK pero sin respuesta: {data}")
-                return "No se pudo generar el resumen."
+        # 5. Procesar respuesta
+        data = response.json()
+        
+        # Extraer la respuesta de forma segura
+        answer = data.get("data", {}).get("answer")
+        
+        if answer:
+            return answer
+        else:
+            summary_logger.warning("La API respondió OK pero sin respuesta: %s", data)
+            return None
+
+    except AgentUnavailable as e:
+        summary_logger.warning("Resumen omitido: %s", e)
+        return None
 
     except httpx.TimeoutException:
-        logger.error("Timeout al conectar con el agente de resúmenes.")
-        return "El servicio de resumen tardó demasiado en responder."
+        summary_logger.error("Timeout al conectar con el agente de resúmenes.")
+        return None
         
     except httpx.HTTPStatusError as e:
-        logger.error(f"Error HTTP al resumir: {e}")
-        return f"Error de la API de resumen: {e.response.status_code}"
+        summary_logger.error("Error HTTP al resumir: %s", e)
+        return None
         
     except Exception as e:
-        logger.error(f"Error inesperado en summarize: {e}")
-        return "Ocurrió un error interno al procesar el resumen."
+        summary_logger.error("Error inesperado en summarize: %s", e)
+        return None
 
 # 5. Endpoints
 
+# --- CACHÉ DE LEADS ---
+# /get-lead se consulta en casi cada turno: se guarda el cuerpo JSON ya
+# renderizado. save_lead y el batch de resúmenes invalidan el teléfono; el TTL
+# acota lo desactualizado si hay varios procesos (cada uno con su caché).
+LEAD_CACHE_SIZE = int(os.getenv("LEAD_CACHE_SIZE", "5000"))              # 0 = desactivada
+LEAD_CACHE_TTL = float(os.getenv("LEAD_CACHE_TTL", "60"))                # segundos
+LEAD_CACHE_NEGATIVE_TTL = float(os.getenv("LEAD_CACHE_NEGATIVE_TTL", "10"))  # números desconocidos
+
+
+class LeadCache:
+    """
+    LRU con TTL teléfono -> cuerpo de respuesta serializado.
+    Cada invalidación sube la generación del teléfono: una lectura de Mongo
+    iniciada antes de una escritura no puede volver a poblar la caché con datos viejos.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()   # phone -> (body, found, expira)
+        self._generations: "OrderedDict[str, int]" = OrderedDict()
+        self._counter = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, phone: str) -> Optional[bytes]:
+        if self.maxsize <= 0:
+            return None
+        entry = self._data.get(phone)
+        if entry and time.monotonic() < entry[2]:
+            self._data.move_to_end(phone)
+            if entry[1]:
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+            return entry[0]
+        if entry:
+            del self._data[phone]
+        self.misses += 1
+        return None
+
+    def generation(self, phone: str) -> int:
+        return self._generations.get(phone, 0)
+
+    def set(self, phone: str, body: bytes, found: bool, generation: int):
+        if self.maxsize <= 0 or self.generation(phone) != generation:
+            return  # Invalidado mientras se leía de Mongo
+        ttl = self.ttl if found else self.negative_ttl
+        self._data[phone] = (body, found, time.monotonic() + ttl)
+        self._data.move_to_end(phone)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, phone: str):
+        if not phone:
+            return
+        self._data.pop(phone, None)
+        self._counter += 1
+        self._generations[phone] = self._counter
+        self._generations.move_to_end(phone)
+        while len(self._generations) > max(self.maxsize, 1):
+            self._generations.popitem(last=False)
+        self.invalidations += 1
+
+    def clear(self):
+        for phone in list(self._data):
+            self.invalidate(phone)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.negative_hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl_s": self.ttl,
+            "negative_ttl_s": self.negative_ttl,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_ratio": round((self.hits + self.negative_hits) / total, 4) if total else 0.0
+        }
+
+
+lead_cache = LeadCache(LEAD_CACHE_SIZE, LEAD_CACHE_TTL, LEAD_CACHE_NEGATIVE_TTL)
+
+
+# --- WRITE-BEHIND DE LEADS ---
+# Upserts de /save-lead agrupados por teléfono y escritos con bulk_write
+# desordenado. Cada request espera el flush de su lote, así que la respuesta
+# (created/updated) es la misma que con update_one directo.
+LEAD_WRITE_BEHIND = os.getenv("LEAD_WRITE_BEHIND", "false").lower() == "true"
+LEAD_WRITE_BATCH = int(os.getenv("LEAD_WRITE_BATCH", "200"))             # flush por tamaño
+LEAD_WRITE_DELAY_MS = float(os.getenv("LEAD_WRITE_DELAY_MS", "50"))      # flush por tiempo
+
+
+class LeadWriteBuffer:
+    """Coalesce de upserts por phone_number con flush por tamaño o tiempo."""
+
+    def __init__(self, max_batch: int, max_delay_s: float):
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay_s
+        self._pending: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.stats = {"requests": 0, "coalesced": 0, "ops": 0, "flushes": 0, "errors": 0}
+
+    @property
+    def active(self) -> bool:
+        return self._task is not None and not self._task.done() and not self._closing
+
+    def start(self):
+        if not self.active:
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Escribe lo pendiente y detiene el flusher (shutdown)."""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        self._full.set()
+        await self._task
+        self._task = None
+
+    async def upsert(self, phone: str, fields: Dict[str, Any]):
+        """Encola el $set del lead; devuelve ('created', _id) o ('updated', phone) tras el flush."""
+        future = asyncio.get_running_loop().create_future()
+        self.stats["requests"] += 1
+        entry = self._pending.get(phone)
+        if entry is None:
+            self._pending[phone] = {"fields": dict(fields), "waiters": [future]}
+        else:
+            # Mismo teléfono dentro de la ventana: el último valor gana, como en upserts secuenciales
+            entry["fields"].update(fields)
+            entry["waiters"].append(future)
+            self.stats["coalesced"] += 1
+        self._wakeup.set()
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        return await future
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            if not self._closing:
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout=self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            self._full.clear()
+            while self._pending:
+                await self._flush()
+            if self._closing:
+                return
+
+    async def _flush(self):
+        lote = list(self._pending.items())[:self.max_batch]
+        for phone, _ in lote:
+            del self._pending[phone]
+        ops = [UpdateOne({"phone_number": phone}, {"$set": entry["fields"]}, upsert=True) for phone, entry in lote]
+        upserted: Dict[int, Any] = {}
+        fallidos: Dict[int, Exception] = {}
+        try:
+            with stage_timer("mongo_save_lead_flush"):
+                result = await users_collection.bulk_write(ops, ordered=False)
+            upserted = dict(result.upserted_ids or {})
+        except BulkWriteError as e:
+            # Desordenado: el resto del lote sí se escribió
+            upserted = {u["index"]: u["_id"] for u in e.details.get("upserted", [])}
+            fallidos = {err["index"]: Exception(err.get("errmsg", "bulk_write error")) for err in e.details.get("writeErrors", [])}
+        except Exception as e:
+            fallidos = {i: e for i in range(len(lote))}
+        self.stats["ops"] += len(ops)
+        self.stats["flushes"] += 1
+        self.stats["errors"] += len(fallidos)
+        lead_logger.info("Leads escritos en bloque: %s ops (%s fallidos)", len(ops), len(fallidos))
+
+        for i, (phone, entry) in enumerate(lote):
+            for n, future in enumerate(entry["waiters"]):
+                if future.done():
+                    continue
+                if i in fallidos:
+                    future.set_exception(fallidos[i])
+                elif i in upserted and n == 0:
+                    future.set_result(("created", str(upserted[i])))
+                else:
+                    future.set_result(("updated", phone))
+
+
+lead_writer = LeadWriteBuffer(LEAD_WRITE_BATCH, LEAD_WRITE_DELAY_MS / 1000.0)
+
+
 @app.post("/save-lead", response_model=AgentResponse)
 async def save_lead(user: UserProfile):
-    logger.info(f"Save lead: {user}")
+    lead_logger.info("Save lead: %s", user)
     """
     Guarda información extrayendo el teléfono limpio.
     """
     try:
         # Lógica de extracción de teléfono
-        full_username = user.function_call_username
-        raw_phone = full_username.split("--")[-1] if "--" in full_username else full_username
+        raw_phone = extract_phone(user.function_call_username)
         
         user_dict = user.model_dump()
         user_dict["phone_number"] = raw_phone
 
-        logger.info(f"Intentando guardar/actualizar lead: {raw_phone}")
+        lead_logger.info("Intentando guardar/actualizar lead: %s", raw_phone)
 
-        # Upsert en Mongo
-        result = await users_collection.update_one(
-            {"phone_number": raw_phone},
-            {"$set": user_dict},
-            upsert=True
-        )
+        # Upsert en Mongo (directo o agrupado por el write-behind)
+        if lead_writer.active:
+            action, lead_id = await lead_writer.upsert(raw_phone, user_dict)
+        else:
+            with stage_timer("mongo_save_lead"):
+                result = await users_collection.update_one(
+                    {"phone_number": raw_phone},
+                    {"$set": user_dict},
+                    upsert=True
+                )
+            action, lead_id = ("created", str(result.upserted_id)) if result.upserted_id else ("updated", raw_phone)
+        lead_cache.invalidate(raw_phone)
 
-        logger.info(f"Lead procesado: {raw_phone}")
+        lead_logger.info("Lead procesado: %s", raw_phone)
 
-        if result.upserted_id:
+        if action == "created":
             # Preparamos datos para responder()
             raw_data = {
-                "id": str(result.upserted_id),
+                "id": lead_id,
                 "action": "created",
                 "phone": raw_phone,
                 "mensaje": f"¡Hola! ¿En qué podemos ayudarle hoy?\n Estamos aquí para darte cualquier información a cerca de los productos que ofrecemos"
@@ -474,7 +1809,7 @@ async def save_lead(user: UserProfile):
             return responder(200, "Actualización Exitosa", raw_data)
 
     except Exception as e:
-        logger.error(f"Error DB save_lead: {str(e)}")
+        lead_logger.error("Error DB save_lead: %s", str(e))
         # Usamos responder para devolver el error formateado
         return responder(500, "Error Interno", {"mensaje": f"Error al guardar datos: {str(e)}"})
 
@@ -484,12 +1819,18 @@ async def get_lead(phone_number: str):
     """
     Busca usuario y retorna formato estandarizado usando responder().
     """
-    logger.info(f"Buscando lead: {phone_number}")
-    
-    user = await users_collection.find_one(
-        {"phone_number": phone_number},
-        {"_id": 0}
-    )
+    lead_logger.info("Buscando lead: %s", phone_number)
+
+    cached = lead_cache.get(phone_number)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+    generation = lead_cache.generation(phone_number)
+
+    with stage_timer("mongo_get_lead"):
+        user = await users_collection.find_one(
+            {"phone_number": phone_number},
+            {"_id": 0}
+        )
     
     if user:
         if "created_at" in user and isinstance(user["created_at"], datetime):
@@ -497,14 +1838,16 @@ async def get_lead(phone_number: str):
         if "last_summary_at" in user and isinstance(user["last_summary_at"], datetime):
             user["last_summary_at"] = user["last_summary_at"].isoformat()
 
-        logger.info(f"Lead encontrado: {phone_number}")
+        lead_logger.info("Lead encontrado: %s", phone_number)
         
         # Agregamos 'mensaje' al dict del usuario para que responder() lo use
         user["mensaje"] = f"Información encontrada. Intereses: {user.get('preferences', 'Sin datos')}"
         
-        return responder(200, "Usuario Encontrado", user)
+        response = responder(200, "Usuario Encontrado", user)
+        lead_cache.set(phone_number, response.body, True, generation)
+        return response
     else:
-        logger.warning(f"Lead no encontrado: {phone_number}")
+        lead_logger.warning("Lead no encontrado: %s", phone_number)
         
         raw_data = {
             "found": False, 
@@ -513,116 +1856,1907 @@ async def get_lead(phone_number: str):
         }
         # Retornamos 200 (éxito en la consulta) pero indicando que no se encontró en el mensaje
         # Si prefieres que sea un error http, cambia 200 por 404
-        return responder(200, "Usuario No Encontrado", raw_data)
+        response = responder(200, "Usuario No Encontrado", raw_data)
+        lead_cache.set(phone_number, response.body, False, generation)  # Caché negativa (TTL corto)
+        return response
+
+
+@app.get("/lead-cache/stats")
+async def lead_cache_stats():
+    """Estadísticas de la caché de /get-lead (aciertos, negativos, invalidaciones)."""
+    return responder(200, "Caché de Leads", lead_cache.stats())
+
+
+@app.delete("/lead-cache")
+async def lead_cache_clear():
+    """Vacía la caché de leads (solo la de este proceso)."""
+    lead_cache.clear()
+    return responder(200, "Caché de Leads", {"mensaje": "Caché de leads vaciada."})
+
+
+# --- IMPORTACIÓN / EXPORTACIÓN MASIVA DE LEADS ---
+LEAD_IMPORT_CHUNK = int(os.getenv("LEAD_IMPORT_CHUNK", "1000"))   # ops por bulk_write
+LEAD_IMPORT_MAX_ERRORS = 50                                       # errores detallados en la respuesta
+LEAD_EXPORT_BATCH = int(os.getenv("LEAD_EXPORT_BATCH", "1000"))   # documentos por lote del cursor
+LEAD_EXPORT_FIELDS = ("phone_number", "function_call_username", "source", "created_at",
+                      "summary", "last_summary_at", "last_message_at")
+
+
+async def _body_lines(request: Request):
+    """Líneas del cuerpo (bytes) conforme llegan, sin cargar el archivo completo."""
+    resto = b""
+    async for chunk in request.stream():
+        resto += chunk
+        *lineas, resto = resto.split(b"\n")
+        for linea in lineas:
+            yield linea
+    if resto:
+        yield resto
+
+
+async def _import_records(request: Request, fmt: str):
+    """Genera (número de línea, dict | Exception) desde NDJSON o CSV con encabezado."""
+    numero = 0
+    encabezado = None
+    pendiente = ""
+    async for linea in _body_lines(request):
+        numero += 1
+        try:
+            texto = linea.decode("utf-8-sig" if numero == 1 else "utf-8").rstrip("\r")
+        except UnicodeDecodeError as e:
+            yield numero, e
+            continue
+        if fmt == "ndjson":
+            if texto.strip():
+                try:
+                    yield numero, json.loads(texto)
+                except ValueError as e:
+                    yield numero, e
+            continue
+        # CSV: un campo entre comillas puede contener saltos de línea
+        pendiente = pendiente + "\n" + texto if pendiente else texto
+        if pendiente.count('"') % 2:
+            continue
+        fila = next(csv.reader([pendiente]), [])
+        pendiente = ""
+        if encabezado is None:
+            encabezado = [col.strip() for col in fila]
+        elif any(fila):
+            yield numero, {k: v for k, v in zip(encabezado, fila) if v != ""}
+    if pendiente:
+        yield numero, ValueError("CSV terminado dentro de un campo entre comillas")
+
+
+@app.post("/leads/import")
+async def import_leads(request: Request,
+                       format: Optional[str] = Query(None, description="ndjson o csv (por defecto según Content-Type)")):
+    """
+    Importa leads desde un cuerpo NDJSON (un UserProfile por línea) o CSV con encabezado.
+    Mismas reglas que /save-lead (validación y teléfono después de '--'); se escriben
+    con bulk_write desordenado en bloques de LEAD_IMPORT_CHUNK teléfonos.
+    """
+    fmt = (format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")).lower()
+    if fmt not in ("ndjson", "csv"):
+        return responder(400, "Error", {"mensaje": "format debe ser 'ndjson' o 'csv'."})
+
+    stats = {"received": 0, "invalid": 0, "duplicates": 0, "created": 0, "updated": 0, "failed": 0, "chunks": 0}
+    errores = []
+    lote: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+    started = time.perf_counter()
+
+    async def flush():
+        if not lote:
+            return
+        phones = list(lote)
+        ops = [UpdateOne({"phone_number": phone}, {"$set": datos}, upsert=True) for phone, datos in lote.items()]
+        lote.clear()
+        fallidos = []
+        try:
+            with stage_timer("mongo_import_leads"):
+                result = await users_collection.bulk_write(ops, ordered=False)
+            creados = len(result.upserted_ids or {})
+        except BulkWriteError as e:
+            creados = len(e.details.get("upserted", []))
+            fallidos = e.details.get("writeErrors", [])
+            for err in fallidos[:max(0, LEAD_IMPORT_MAX_ERRORS - len(errores))]:
+                errores.append({"phone": phones[err["index"]], "error": err.get("errmsg", "")[:200]})
+        stats["created"] += creados
+        stats["updated"] += len(ops) - creados - len(fallidos)
+        stats["failed"] += len(fallidos)
+        stats["chunks"] += 1
+        for phone in phones:
+            lead_cache.invalidate(phone)
+
+    try:
+        async for numero, registro in _import_records(request, fmt):
+            stats["received"] += 1
+            try:
+                if isinstance(registro, Exception):
+                    raise registro
+                lead = UserProfile.model_validate(registro)
+            except Exception as e:
+                stats["invalid"] += 1
+                if len(errores) < LEAD_IMPORT_MAX_ERRORS:
+                    errores.append({"linea": numero, "error": str(e)[:200]})
+                continue
+
+            user_dict = lead.model_dump()
+            raw_phone = extract_phone(lead.function_call_username)
+            user_dict["phone_number"] = raw_phone
+            if raw_phone in lote:
+                # Mismo teléfono repetido en el bloque: gana la última fila (como upserts secuenciales)
+                stats["duplicates"] += 1
+            lote[raw_phone] = user_dict
+            if len(lote) >= LEAD_IMPORT_CHUNK:
+                await flush()
+        await flush()
+    except Exception as e:
+        lead_logger.error("Error importando leads tras %s registros: %s", stats["received"], e)
+        return responder(500, "Error Interno", {
+            "mensaje": f"Importación interrumpida: {e}", **stats, "errores": errores
+        })
+
+    elapsed = time.perf_counter() - started
+    lead_logger.info("Importación de leads (%s): %s", fmt, stats)
+    return responder(200, "Importación Completada", {
+        **stats,
+        "elapsed_s": round(elapsed, 3),
+        "rows_per_s": round(stats["received"] / elapsed, 1) if elapsed > 0 else 0.0,
+        "errores": errores,
+        "mensaje": f"Se importaron {stats['created'] + stats['updated']} leads "
+                   f"({stats['created']} nuevos, {stats['updated']} actualizados, {stats['invalid']} inválidos)."
+    })
+
+
+def _csv_value(value: Any) -> Any:
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json_text(value)
+    return value
+
+
+async def _lead_export_stream(filtro: Dict[str, Any], fields: Optional[list], fmt: str):
+    """Recorre users con cursor por lotes y emite NDJSON/CSV; memoria de un lote."""
+    columnas = fields or (list(LEAD_EXPORT_FIELDS) if fmt == "csv" else None)
+    projection = None
+    if columnas:
+        projection = {campo: 1 for campo in columnas}
+        if "_id" not in columnas:
+            projection["_id"] = 0
+    enviados = 0
+    try:
+        cursor = users_collection.find(filtro, projection).sort("_id", 1).batch_size(LEAD_EXPORT_BATCH)
+        if fmt == "csv":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerow(columnas)
+            yield buffer.getvalue().encode("utf-8")
+        lote = []
+        async for doc in cursor:
+            lote.append(doc)
+            if len(lote) < LEAD_EXPORT_BATCH:
+                continue
+            yield _encode_leads(lote, columnas, fmt)
+            enviados += len(lote)
+            lote = []
+        if lote:
+            yield _encode_leads(lote, columnas, fmt)
+            enviados += len(lote)
+        lead_logger.info("Exportación de leads terminada: %s documentos (%s)", enviados, fmt)
+    except Exception as e:
+        lead_logger.error("Error en exportación de leads tras %s documentos: %s", enviados, e)
+        # El status 200 ya se envió: avisamos dentro del propio stream
+        if fmt == "csv":
+            yield f"# ERROR: {e}\n".encode("utf-8")
+        else:
+            yield json_bytes({"error": str(e), "documentos_enviados": enviados}) + b"\n"
+
+
+def _encode_leads(docs: list, columnas: Optional[list], fmt: str) -> bytes:
+    if fmt == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows([_csv_value(doc.get(c)) for c in columnas] for doc in docs)
+        return buffer.getvalue().encode("utf-8")
+    return b"".join(json_bytes(doc) + b"\n" for doc in docs)
+
+
+@app.get("/leads/export")
+async def export_leads(format: str = Query("ndjson", description="ndjson o csv"),
+                       fields: Optional[str] = Query(None, description="Campos separados por coma"),
+                       source: Optional[str] = None,
+                       created_since: Optional[datetime] = Query(None, description="Solo leads con created_at >= fecha")):
+    """Exporta la colección users en stream (NDJSON o CSV) sin cargarla en memoria."""
+    fmt = format.lower()
+    if fmt not in ("ndjson", "csv"):
+        return responder(400, "Error", {"mensaje": "format debe ser 'ndjson' o 'csv'."})
+    filtro: Dict[str, Any] = {}
+    if source:
+        filtro["source"] = source
+    if created_since:
+        filtro["created_at"] = {"$gte": created_since}
+    columnas = [c.strip() for c in fields.split(",") if c.strip()] if fields else None
+    lead_logger.info("Exportando leads (%s) filtro=%s campos=%s", fmt, filtro, columnas)
+    return StreamingResponse(
+        _lead_export_stream(filtro, columnas, fmt),
+        media_type="text/csv" if fmt == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="leads.{fmt}"'}
+    )
+
+
+# --- CONSULTA DE LOGS ---
+# Los archivos rotados (app.log.AAAA-MM-DD) son inmutables: su índice disperso
+# ts->offset se calcula una vez; el archivo activo se indexa de forma incremental.
+LOG_INDEX_STRIDE = int(os.getenv("LOG_INDEX_STRIDE", str(64 * 1024)))  # bytes entre puntos del índice
+LOG_READ_CHUNK = 64 * 1024
+LOG_QUERY_MAX_LINES = int(os.getenv("LOG_QUERY_MAX_LINES", "50000"))
+LOG_TAIL_MAX = 10000
+
+# JSON: {"ts": "2026-10-18T00:38:09.030Z", ...}  |  texto: 2026-10-18 00:38:09,030 - ...
+_LOG_TS = re.compile(rb'^(?:\{"ts": ")?(\d{4}-\d\d-\d\d)[T ](\d\d:\d\d:\d\d)')
+_LOG_WINDOW = re.compile(r"^\d{4}-\d\d-\d\d([T ]\d\d(:\d\d(:\d\d)?)?)?$")
+
+
+def _log_line_ts(line: bytes) -> Optional[str]:
+    match = _LOG_TS.match(line)
+    if not match:
+        return None
+    return match.group(1).decode() + "T" + match.group(2).decode()
+
+
+def log_files() -> list:
+    """Archivos de log del más antiguo al más reciente (rotados + activo)."""
+    directory, base = os.path.split(os.path.abspath(LOG_FILE_PATH))
+    if not os.path.isdir(directory):
+        return []
+    rotated = sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith(base + ".") and not name.endswith(".tmp")
+    )
+    current = os.path.join(directory, base)
+    return rotated + ([current] if os.path.exists(current) else [])
+
+
+class LogOffsetIndex:
+    """
+    Índice disperso por archivo: un punto (ts, offset) cada LOG_INDEX_STRIDE bytes.
+    Permite saltar directo a la zona de una ventana de tiempo sin leer el archivo
+    completo. Se invalida si cambia el inode o el archivo se trunca.
+    """
+
+    def __init__(self, stride: int):
+        self.stride = stride
+        self._files: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def update(self, path: str) -> dict:
+        path = os.path.abspath(path)
+        with self._lock:
+            st = os.stat(path)
+            entry = self._files.get(path)
+            if entry is None or entry["ino"] != st.st_ino or st.st_size < entry["size"]:
+                entry = {"ino": st.st_ino, "size": 0, "points": [], "first": None, "last": None}
+                self._files[path] = entry
+            if st.st_size > entry["size"]:
+                self._scan(path, entry)
+            return dict(entry, points=len(entry["points"]))
+
+    def _scan(self, path: str, entry: dict):
+        next_point = entry["size"] if not entry["points"] else entry["points"][-1][1] + self.stride
+        pos = entry["size"]
+        with open(path, "rb") as f:
+            f.seek(pos)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # Línea a medio escribir: se indexa en la próxima pasada
+                ts = _log_line_ts(line)
+                if ts:
+                    if entry["first"] is None:
+                        entry["first"] = ts
+                    entry["last"] = ts
+                    if pos >= next_point:
+                        entry["points"].append((ts, pos))
+                        next_point = pos + self.stride
+                pos += len(line)
+        entry["size"] = pos
+
+    def seek(self, path: str, since: str) -> int:
+        """Offset de un inicio de línea anterior a la primera línea con ts >= since."""
+        self.update(path)
+        with self._lock:
+            points = self._files[os.path.abspath(path)]["points"]
+            i = bisect.bisect_left(points, since, key=lambda p: p[0])
+            return points[i - 1][1] if i > 0 else 0
+
+    def on_rollover(self, base_path: str):
+        """Reasigna el índice del archivo activo al rotado que conserva su inode."""
+        base_path = os.path.abspath(base_path)
+        with self._lock:
+            entry = self._files.pop(base_path, None)
+            vigentes = set(log_files())
+            for path in list(self._files):
+                if path not in vigentes:
+                    del self._files[path]  # Borrado por backupCount
+            if entry is None:
+                return
+            for path in vigentes:
+                try:
+                    if path != base_path and os.stat(path).st_ino == entry["ino"]:
+                        self._files[path] = entry
+                        break
+                except OSError:
+                    continue
+
+
+log_index = LogOffsetIndex(LOG_INDEX_STRIDE)
+
+
+def _tail_lines(path: str, n: int) -> list:
+    """Últimas n líneas leyendo bloques desde el final del archivo."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+        while pos > 0 and data.count(b"\n") <= n:
+            step = min(LOG_READ_CHUNK, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    lines = data.splitlines(keepends=True)
+    return lines[-n:] if n else []
+
+
+def _log_file_lines(path: str, start: int, end: Optional[int]):
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if end is not None and pos >= end:
+                break
+            yield line
+            pos += len(line)
+
+
+def _log_query_lines(paths: list, since: Optional[str], until: Optional[str], matcher,
+                     offset: Optional[int], length: Optional[int], max_lines: int):
+    """Generador (se itera en el threadpool) de líneas que pasan ventana + grep."""
+    emitidas = 0
+    for path in paths:
+        if since and offset is None:
+            start = log_index.seek(path, since)
+        else:
+            start = offset or 0
+        end = start + length if length else None
+        current_ts = None
+        for line in _log_file_lines(path, start, end):
+            current_ts = _log_line_ts(line) or current_ts  # Trazas multilínea heredan el ts
+            if since and (current_ts is None or current_ts < since):
+                continue
+            if until and current_ts and current_ts[:len(until)] > until:
+                break  # Archivo ordenado por tiempo: no hay más coincidencias
+            if matcher and not matcher(line):
+                continue
+            yield line
+            emitidas += 1
+            if max_lines and emitidas >= max_lines:
+                return
+
+
+def _gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> contenedor gzip
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= LOG_READ_CHUNK:
+            yield compressor.compress(bytes(buffer))
+            buffer.clear()
+    yield compressor.compress(bytes(buffer)) + compressor.flush()
+
+
+def _batched(lines):
+    buffer = bytearray()
+    for line in lines:
+        buffer += line
+        if len(buffer) >= LOG_READ_CHUNK:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
 
 
 @app.post("/get-logs")
-async def get_system_logs():
+async def get_system_logs(
+    request: Request,
+    file: Optional[str] = Query(None, description="Archivo: app.log (default) o rotado, p.ej. app.log.2026-10-17; 'all' = todos"),
+    tail: Optional[int] = Query(None, ge=1, le=LOG_TAIL_MAX, description="Últimas N líneas (tras filtros)"),
+    offset: Optional[int] = Query(None, ge=0, description="Byte inicial"),
+    length: Optional[int] = Query(None, ge=1, description="Bytes a leer desde offset"),
+    since: Optional[str] = Query(None, description="Desde (AAAA-MM-DD[THH[:MM[:SS]]])"),
+    until: Optional[str] = Query(None, description="Hasta, inclusive (mismo formato)"),
+    grep: Optional[str] = Query(None, description="Texto (o regex con regex=true) que deben contener las líneas"),
+    regex: bool = False,
+    gzip: Optional[bool] = Query(None, description="Comprimir; por defecto según Accept-Encoding"),
+):
     """
     Endpoint POST para descargar/ver los logs del sistema.
+    Sin parámetros devuelve el archivo activo completo (soporta cabecera Range);
+    con tail/offset/since/until/grep lee solo lo necesario y lo envía en stream.
     """
     try:
-        if os.path.exists(LOG_FILE_PATH):
-            logger.info("Acceso a descarga de logs solicitado.")
-            return FileResponse(
-                path=LOG_FILE_PATH, 
-                filename="system_logs.txt", 
-                media_type="text/plain"
-            )
-        else:
+        archivos = log_files()
+        if not archivos:
             return responder(404, "Logs No Disponibles", {
                 "error": "no_logs",
                 "mensaje": "No hay archivo de logs disponible actualmente."
             })
+
+        por_nombre = {os.path.basename(p): p for p in archivos}
+        if file in (None, "", os.path.basename(LOG_FILE_PATH)):
+            seleccion = [archivos[-1]] if not (since or until) else archivos
+        elif file == "all":
+            seleccion = archivos
+        elif file in por_nombre:
+            seleccion = [por_nombre[file]]
+        else:
+            return responder(404, "Logs No Disponibles", {
+                "error": "unknown_file", "mensaje": f"Archivo no encontrado: {file}",
+                "archivos": list(por_nombre)
+            })
+
+        for nombre, valor in (("since", since), ("until", until)):
+            if valor and not _LOG_WINDOW.match(valor):
+                return responder(422, "Parámetro Inválido", {
+                    "error": "bad_window", "mensaje": f"'{nombre}' debe tener formato AAAA-MM-DD[THH[:MM[:SS]]]"
+                })
+        since = since.replace(" ", "T") if since else None
+        until = until.replace(" ", "T") if until else None
+        if (offset is not None or length) and len(seleccion) != 1:
+            return responder(422, "Parámetro Inválido", {
+                "error": "bad_range", "mensaje": "offset/length requieren un único archivo ('file')."
+            })
+
+        matcher = None
+        if grep:
+            if regex:
+                try:
+                    patron = re.compile(grep.encode())
+                except re.error as e:
+                    return responder(422, "Parámetro Inválido", {"error": "bad_regex", "mensaje": str(e)})
+                matcher = patron.search
+            else:
+                aguja = grep.encode()
+                matcher = lambda line: aguja in line
+
+        comprimir = gzip if gzip is not None else "gzip" in request.headers.get("accept-encoding", "")
+        sin_filtros = not any((tail, offset is not None, length, since, until, grep))
+
+        if sin_filtros and (request.headers.get("range") or not comprimir):
+            logger.info("Acceso a descarga de logs solicitado: %s", os.path.basename(seleccion[0]))
+            return FileResponse(
+                path=seleccion[0],
+                filename="system_logs.txt",
+                media_type="text/plain"
+            )
+
+        # Ventana de tiempo: descarta archivos completos usando el rango del índice
+        if since or until:
+            vigentes = []
+            for path in seleccion:
+                info = await asyncio.to_thread(log_index.update, path)
+                if since and info["last"] and info["last"] < since:
+                    continue
+                if until and info["first"] and info["first"][:len(until)] > until:
+                    continue
+                vigentes.append(path)
+            seleccion = vigentes
+
+        logger.info("Consulta de logs: archivos=%s tail=%s offset=%s length=%s since=%s until=%s grep=%r",
+                    [os.path.basename(p) for p in seleccion], tail, offset, length, since, until, grep)
+
+        if tail and not any((offset is not None, length, since, until, grep)):
+            lineas = []
+            for path in reversed(seleccion):
+                lineas = await asyncio.to_thread(_tail_lines, path, tail - len(lineas)) + lineas
+                if len(lineas) >= tail:
+                    break
+            cuerpo = iter(lineas)
+        elif tail:
+            lineas = _log_query_lines(seleccion, since, until, matcher, offset, length, 0)  # deque acota la memoria
+            cuerpo = iter(await asyncio.to_thread(deque, lineas, tail))
+        else:
+            cuerpo = _log_query_lines(seleccion, since, until, matcher, offset, length, LOG_QUERY_MAX_LINES)
+
+        chunks = _batched(cuerpo)
+        headers = {"X-Log-Files": ",".join(os.path.basename(p) for p in seleccion)}
+        if comprimir:
+            chunks = _gzip_stream(chunks)
+            headers["Content-Encoding"] = "gzip"
+            headers["Vary"] = "Accept-Encoding"
+        return StreamingResponse(chunks, media_type="text/plain; charset=utf-8", headers=headers)
     except Exception as e:
-        logger.error(f"Error al leer logs: {e}")
+        logger.error("Error al leer logs: %s", e)
         return responder(500, "Error de Sistema", {"mensaje": "Error crítico leyendo logs."})
 
 
-@app.get("/generate_summary_batch")
-async def generate_summary_batch():
+@app.get("/get-logs/files")
+async def list_log_files():
+    """Archivos de log disponibles con su rango de tiempo (según el índice ts->offset)."""
+    try:
+        archivos = [await asyncio.to_thread(log_index.update, p) | {"file": os.path.basename(p)}
+                    for p in log_files()]
+        return responder(200, "Archivos de Log", {
+            "archivos": [{k: a[k] for k in ("file", "size", "first", "last", "points")} for a in archivos],
+            "index_stride": LOG_INDEX_STRIDE,
+        })
+    except Exception as e:
+        logger.error("Error listando logs: %s", e)
+        return responder(500, "Error de Sistema", {"mensaje": "Error crítico leyendo logs."})
+
+
+# --- PIPELINE DE RESÚMENES MASIVOS ---
+# productor (cursor Mongo) -> N workers (get_chat + summarize) -> escritor (bulk_write)
+
+_BATCH_DONE = object()
+
+
+async def _summary_producer(queue: asyncio.Queue, filtro: Dict[str, Any], workers: int, sort=None,
+                            tracker: Optional["ScanCheckpoint"] = None):
+    """Lee el cursor de Mongo y alimenta la cola de trabajo."""
+    projection = {"phone_number": 1, "chat_hash": 1, "last_message_at": 1}
+    cursor = users_collection.find(filtro, projection)
+    if sort:
+        cursor = cursor.sort(sort)
+    cursor = cursor.batch_size(SUMMARY_CURSOR_BATCH)
+    async for user_doc in cursor:
+        if tracker is not None:
+            tracker.dispatch(user_doc["_id"])
+        await queue.put(user_doc)
+    for _ in range(workers):
+        await queue.put(_BATCH_DONE)
+
+
+def _has_new_messages(user_doc: Dict[str, Any], chat_info) -> bool:
     """
-    Recorre la base de datos, busca usuarios con teléfono,
-    descarga sus chats y actualiza sus resúmenes masivamente.
+    ¿Hay mensajes posteriores al último resumido? Compara fechas ya parseadas
+    (no texto). Si alguna fecha no se reconoce, decide el hash del chat.
     """
-    logger.info("Iniciando generación masiva de resúmenes...")
-    
-    processed_count = 0
-    skipped_count = 0
-    
-    # Iteramos asíncronamente sobre todos los usuarios que tengan el campo phone_number
-    async for user_doc in users_collection.find({"phone_number": {"$exists": True}}):
+    resumido = parse_message_time(user_doc.get("last_message_at"))
+    if resumido is None:
+        return True
+    fechas = [parse_message_time(_message_time(m)) for m in chat_messages(chat_info)]
+    if not fechas or any(f is None for f in fechas):
+        return True
+    return any(f > resumido for f in fechas)
+
+
+async def _summary_worker(queue: asyncio.Queue, writes: asyncio.Queue, stats: Dict[str, int], incremental: bool = True,
+                         tracker: Optional["ScanCheckpoint"] = None):
+    """Descarga el chat y genera el resumen de cada usuario de la cola."""
+    while True:
+        user_doc = await queue.get()
+        if user_doc is _BATCH_DONE:
+            break
         phone = user_doc.get("phone_number")
-        
+        terminado = True  # Para el checkpoint: False si queda en manos del escritor o se cancela
         try:
-            # 1. Obtener Chat del Main Bot
+            # 1. Obtener Chat del Main Bot (una sola descarga: sirve para detectar cambios y resumir)
             # Si no hay chat reciente, saltamos al siguiente usuario
-            logger.info(f"Obteniendo chat {phone}")
+            summary_logger.info("Obteniendo chat %s", phone)
             chat_info = await get_chat(phone)
             if not chat_info:
-                logger.info(f"Sin historial de chat para: {phone}")
-                skipped_count += 1
+                summary_logger.info("Sin historial de chat para: %s", phone)
+                stats["skipped"] += 1
+                continue
+
+            # 1b. Detección de cambios: sin mensajes nuevos no hay llamada al LLM
+            if incremental and not _has_new_messages(user_doc, chat_info):
+                summary_logger.info("Sin mensajes nuevos para: %s", phone)
+                stats["unchanged"] += 1
+                continue
+
+            chat_hash, last_message_at = chat_fingerprint(chat_info)
+            if incremental and chat_hash == user_doc.get("chat_hash"):
+                summary_logger.info("Conversación sin cambios para: %s", phone)
+                stats["unchanged"] += 1
+                continue
+
+            # 2. Generar Resumen con el Summary Bot
+            summary_logger.info("Obteniendo generando resumen %s", phone)
+            summary_text = await summarize(chat_info)
+            if summary_text is None:
+                # Sin resumen no se toca chat_hash/last_message_at: se reintenta la próxima corrida
+                stats["skipped"] += 1
+                continue
+
+            # 3. Encolar la actualización para el escritor
+            await writes.put((phone, user_doc["_id"], UpdateOne(
+                {"_id": user_doc["_id"]},
+                {"$set": {
+                    "summary": summary_text,
+                    "last_summary_at": datetime.utcnow(),
+                    "chat_hash": chat_hash,
+                    "last_message_at": last_message_at or None
+                }}
+            )))
+            terminado = False
+
+        except asyncio.CancelledError:
+            terminado = False  # Sin marcar: al reanudar se vuelve a procesar
+            raise
+        except Exception as e:
+            # Capturamos el error para que no detenga el bucle completo, solo este usuario
+            summary_logger.error("Error procesando usuario %s: %s", phone, e)
+            stats["skipped"] += 1
+        finally:
+            # Lo encolado se marca como terminado cuando el escritor lo guarda
+            if tracker is not None and terminado:
+                tracker.complete(user_doc["_id"])
+
+
+async def _summary_writer(writes: asyncio.Queue, stats: Dict[str, int], tracker: Optional["ScanCheckpoint"] = None):
+    """Agrupa las actualizaciones y las escribe con bulk_write desordenado."""
+    pending = []
+
+    async def flush():
+        if not pending:
+            return
+        ops = [op for _, _, op in pending]
+        try:
+            await users_collection.bulk_write(ops, ordered=False)
+            for phone, _, _ in pending:
+                lead_cache.invalidate(phone)
+            stats["processed"] += len(ops)
+            stats["bulk_writes"] += 1
+            summary_logger.info("Resúmenes guardados en bloque: %s", len(ops))
+        except Exception as e:
+            summary_logger.error("Error en bulk_write de resúmenes (%s ops): %s", len(ops), e)
+            stats["skipped"] += len(ops)
+        if tracker is not None:
+            for _, user_id, _ in pending:
+                tracker.complete(user_id)
+        pending.clear()
+
+    while True:
+        item = await writes.get()
+        if item is _BATCH_DONE:
+            break
+        pending.append(item)
+        if len(pending) >= SUMMARY_BULK_SIZE:
+            await flush()
+    await flush()
+
+
+def stale_summary_filter(stale_before: Optional[datetime] = None) -> Dict[str, Any]:
+    """Usuarios con teléfono; con stale_before, solo resúmenes anteriores o inexistentes (índice summary_staleness)."""
+    filtro: Dict[str, Any] = {"phone_number": {"$exists": True}}
+    if stale_before is not None:
+        filtro["$or"] = [{"last_summary_at": None}, {"last_summary_at": {"$lt": stale_before}}]
+    return filtro
+
+
+async def run_summary_batch(filtro: Optional[Dict[str, Any]] = None, concurrency: Optional[int] = None,
+                            incremental: Optional[bool] = None, sort=None,
+                            tracker: Optional["ScanCheckpoint"] = None) -> Dict[str, Any]:
+    """
+    Ejecuta el pipeline completo y devuelve contadores y throughput.
+    Con incremental=True solo se resumen las conversaciones que cambiaron.
+    Con tracker, cada usuario se marca al terminar (checkpoint de los jobs).
+    """
+    filtro = filtro if filtro is not None else {"phone_number": {"$exists": True}}
+    workers = max(1, concurrency or SUMMARY_CONCURRENCY)
+    incremental = SUMMARY_INCREMENTAL if incremental is None else incremental
+    stats = {"processed": 0, "skipped": 0, "unchanged": 0, "bulk_writes": 0}
+    if tracker is not None:
+        tracker.stats = stats
+
+    queue: asyncio.Queue = asyncio.Queue(maxsize=workers * 4)
+    writes: asyncio.Queue = asyncio.Queue(maxsize=SUMMARY_BULK_SIZE * 2)
+
+    started = time.perf_counter()
+    # Un solo barrido de segmentos por corrida; los workers buscan en O(1)
+    try:
+        await segment_index.refresh(force=True)
+    except Exception as e:
+        summary_logger.error("No se pudo construir el índice de segmentos: %s", e)
+    writer = asyncio.create_task(_summary_writer(writes, stats, tracker))
+    producer = asyncio.create_task(_summary_producer(queue, filtro, workers, sort, tracker))
+    pool = [asyncio.create_task(_summary_worker(queue, writes, stats, incremental, tracker)) for _ in range(workers)]
+    try:
+        await asyncio.gather(producer, *pool)
+    finally:
+        for task in (producer, *pool):
+            task.cancel()
+        await writes.put(_BATCH_DONE)
+        await writer
+    elapsed = time.perf_counter() - started
+
+    total = stats["processed"] + stats["skipped"] + stats["unchanged"]
+    return {
+        **stats,
+        "total": total,
+        "concurrency": workers,
+        "incremental": incremental,
+        "segments_indexed": len(segment_index),
+        "elapsed_s": round(elapsed, 3),
+        "users_per_s": round(total / elapsed, 2) if elapsed > 0 else 0.0
+    }
+
+
+# --- JOBS DE RESUMEN MASIVO ---
+# Cada corrida es un job en Mongo (summary_jobs) que avanza en orden de _id y
+# guarda como checkpoint el último _id con todo lo anterior ya terminado. Un
+# lease en job_locks impide corridas simultáneas, también entre procesos.
+SUMMARY_JOB_LEASE_S = float(os.getenv("SUMMARY_JOB_LEASE_S", "120"))          # vida del lock sin heartbeat
+SUMMARY_JOB_CHECKPOINT_S = float(os.getenv("SUMMARY_JOB_CHECKPOINT_S", "5"))  # cada cuánto se persiste el avance
+SUMMARY_JOB_INTERVAL_MIN = float(os.getenv("SUMMARY_JOB_INTERVAL_MIN", "0"))  # 0 = sin corridas programadas
+SUMMARY_JOB_AUTO_RESUME = os.getenv("SUMMARY_JOB_AUTO_RESUME", "true").lower() == "true"
+SUMMARY_JOB_TICK_S = float(os.getenv("SUMMARY_JOB_TICK_S", "30"))            # cada cuánto revisa programación/huérfanos
+SUMMARY_JOB_LOCK_ID = "summary_batch"
+INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+class JobConflict(Exception):
+    """Ya hay una corrida del resumen masivo en curso (aquí o en otra instancia)."""
+
+    def __init__(self, job_id: Optional[str]):
+        super().__init__(f"Job en curso: {job_id}")
+        self.job_id = job_id
+
+
+class ScanCheckpoint:
+    """
+    Marca de agua del barrido en orden de _id: los workers terminan fuera de
+    orden, así que solo avanza cuando todo lo despachado antes ya terminó.
+    """
+
+    def __init__(self, start_id=None):
+        self.watermark = start_id
+        self._order: deque = deque()
+        self._done: set = set()
+        self.dispatched = 0
+        self.completed = 0
+        self.stats: Dict[str, int] = {}
+
+    def dispatch(self, user_id):
+        self._order.append(user_id)
+        self.dispatched += 1
+
+    def complete(self, user_id):
+        self._done.add(user_id)
+        self.completed += 1
+        while self._order and self._order[0] in self._done:
+            head = self._order.popleft()
+            self._done.discard(head)
+            self.watermark = head
+
+
+class SummaryJobRunner:
+    """Inicia, reanuda, programa y reporta los jobs de resumen masivo (uno a la vez)."""
+
+    def __init__(self, jobs, locks):
+        self.jobs = jobs
+        self.locks = locks
+        self.job_id: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self.tracker: Optional[ScanCheckpoint] = None
+        self._started_at = 0.0
+        self._scheduler: Optional[asyncio.Task] = None
+        self._cancel_requested = False
+        # Serializa start(): entre el chequeo de running y create_task hay varios await
+        self._start_lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    # --- lock entre procesos (lease con heartbeat) ---
+    async def _acquire(self, job_id: str) -> bool:
+        now = datetime.utcnow()
+        try:
+            await self.locks.find_one_and_update(
+                # Un lease propio solo se reutiliza al reanudar ese mismo job
+                {"_id": SUMMARY_JOB_LOCK_ID, "$or": [{"expires_at": {"$lt": now}},
+                                                     {"owner": INSTANCE_ID, "job_id": job_id}]},
+                {"$set": {"owner": INSTANCE_ID, "job_id": job_id,
+                          "expires_at": now + timedelta(seconds=SUMMARY_JOB_LEASE_S)}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False  # Lo tiene otra instancia y no ha expirado
+
+    async def _release(self, job_id: str):
+        await self.locks.delete_one({"_id": SUMMARY_JOB_LOCK_ID, "owner": INSTANCE_ID, "job_id": job_id})
+
+    # --- ciclo de vida ---
+    async def start(self, params: Dict[str, Any], trigger: str = "manual", resume_doc: Optional[Dict[str, Any]] = None) -> str:
+        """Crea (o reanuda) un job y lo lanza en segundo plano. JobConflict si ya hay uno."""
+        async with self._start_lock:
+            return await self._start(params, trigger, resume_doc)
+
+    async def _start(self, params: Dict[str, Any], trigger: str, resume_doc: Optional[Dict[str, Any]]) -> str:
+        if self.running:
+            raise JobConflict(self.job_id)
+        job_id = resume_doc["_id"] if resume_doc else uuid.uuid4().hex[:16]
+        if not await self._acquire(job_id):
+            lock = await self.locks.find_one({"_id": SUMMARY_JOB_LOCK_ID})
+            raise JobConflict((lock or {}).get("job_id"))
+
+        try:
+            if resume_doc is None:
+                await self.jobs.insert_one({
+                    "_id": job_id, "status": "queued", "trigger": trigger, "params": params,
+                    "created_at": datetime.utcnow(), "checkpoint_id": None, "done": 0,
+                    "stats": {"processed": 0, "skipped": 0, "unchanged": 0, "bulk_writes": 0}, "runs": 0,
+                })
+            doc = resume_doc or await self.jobs.find_one({"_id": job_id})
+        except Exception:
+            await self._release(job_id)
+            raise
+        self.job_id = job_id
+        self.tracker = ScanCheckpoint(doc.get("checkpoint_id"))
+        self.task = asyncio.create_task(self._run(doc))
+        summary_logger.info("Job de resúmenes %s %s (%s)", job_id, "reanudado" if resume_doc else "iniciado", trigger)
+        return job_id
+
+    async def _run(self, doc: Dict[str, Any]) -> Dict[str, Any]:
+        job_id, params, tracker = doc["_id"], doc.get("params") or {}, self.tracker
+        previos = dict(doc.get("stats") or {})
+        done_previo = int(doc.get("done") or 0)
+        filtro = stale_summary_filter(params.get("stale_before"))
+        if tracker.watermark is not None:
+            filtro["_id"] = {"$gt": tracker.watermark}
+
+        async def persistir(extra: Optional[Dict[str, Any]] = None):
+            acumulado = {k: previos.get(k, 0) + tracker.stats.get(k, 0) for k in ("processed", "skipped", "unchanged", "bulk_writes")}
+            await self.jobs.update_one({"_id": job_id}, {"$set": {
+                "checkpoint_id": tracker.watermark, "done": done_previo + tracker.completed,
+                "done_run": tracker.completed,
+                "stats": acumulado, "heartbeat_at": datetime.utcnow(), **(extra or {}),
+            }})
+
+        async def cerrar(extra: Dict[str, Any]):
+            # Mejor esfuerzo: si Mongo falla aquí no debe ocultar el error original ni el release
+            try:
+                await persistir({**extra, "finished_at": datetime.utcnow()})
+            except Exception as e:
+                summary_logger.error("No se pudo guardar el estado final del job %s: %s", job_id, e)
+
+        async def heartbeat():
+            while True:
+                await asyncio.sleep(SUMMARY_JOB_CHECKPOINT_S)
+                try:
+                    await persistir()
+                    await self.locks.update_one(
+                        {"_id": SUMMARY_JOB_LOCK_ID, "owner": INSTANCE_ID, "job_id": job_id},
+                        {"$set": {"expires_at": datetime.utcnow() + timedelta(seconds=SUMMARY_JOB_LEASE_S)}}
+                    )
+                except Exception as e:
+                    summary_logger.error("Error guardando checkpoint del job %s: %s", job_id, e)
+
+        latido = None
+        try:
+            try:
+                restantes = await users_collection.count_documents(filtro)
+            except Exception as e:
+                summary_logger.error("No se pudo estimar el total del job %s: %s", job_id, e)
+                restantes = None
+            self._started_at = time.monotonic()
+            await self.jobs.update_one({"_id": job_id}, {"$set": {
+                "status": "running", "owner": INSTANCE_ID, "started_at": doc.get("started_at") or datetime.utcnow(),
+                "heartbeat_at": datetime.utcnow(), "total": None if restantes is None else done_previo + restantes,
+                "error": None, "runs": int(doc.get("runs") or 0) + 1, "done_run": 0,
+            }})
+            latido = asyncio.create_task(heartbeat())
+
+            result = await run_summary_batch(
+                filtro=filtro, concurrency=params.get("concurrency"), incremental=params.get("incremental"),
+                sort=[("_id", 1)], tracker=tracker
+            )
+            await persistir({"status": "completed", "finished_at": datetime.utcnow(), "result": result})
+            summary_logger.info("Job de resúmenes %s terminado: %s", job_id, result)
+            return result
+        except asyncio.CancelledError:
+            # cancel() del usuario o apagado del servidor: el checkpoint permite reanudar
+            estado = "cancelled" if self._cancel_requested else "interrupted"
+            await asyncio.shield(cerrar({"status": estado}))
+            summary_logger.warning("Job de resúmenes %s %s en _id=%s", job_id, estado, tracker.watermark)
+            raise
+        except Exception as e:
+            await cerrar({"status": "failed", "error": str(e)})
+            summary_logger.error("Job de resúmenes %s falló: %s", job_id, e)
+            raise
+        finally:
+            if latido is not None:
+                latido.cancel()
+            self._cancel_requested = False
+            try:
+                await asyncio.shield(self._release(job_id))
+            except Exception as e:
+                summary_logger.error("No se pudo liberar el lock del job %s: %s", job_id, e)
+
+    async def cancel(self, job_id: str) -> bool:
+        if not self.running or self.job_id != job_id:
+            return False
+        self._cancel_requested = True
+        self.task.cancel()
+        try:
+            await self.task
+        except (asyncio.CancelledError, Exception):
+            pass
+        return True
+
+    async def resume(self, job_id: str, trigger: str = "resume") -> str:
+        doc = await self.jobs.find_one({"_id": job_id})
+        if doc is None:
+            raise KeyError(job_id)
+        if doc.get("status") == "completed":
+            raise ValueError("El job ya terminó.")
+        return await self.start(doc.get("params") or {}, trigger=trigger, resume_doc=doc)
+
+    # --- progreso ---
+    @staticmethod
+    def _public(doc: Dict[str, Any]) -> Dict[str, Any]:
+        info = {k: v for k, v in doc.items() if k not in ("_id", "status", "checkpoint_id", "done_run")}
+        info["job_id"] = doc["_id"]
+        info["job_status"] = doc.get("status")  # "status" lo ocupa el envelope
+        info["checkpoint_id"] = str(doc["checkpoint_id"]) if doc.get("checkpoint_id") is not None else None
+        return info
+
+    async def progress(self, job_id: str) -> Optional[Dict[str, Any]]:
+        doc = await self.jobs.find_one({"_id": job_id})
+        if doc is None:
+            return None
+        info = self._public(doc)
+        info["rate_per_s"] = None
+        if self.running and self.job_id == job_id:
+            # En memoria va por delante del último checkpoint persistido
+            tracker = self.tracker
+            previo = int(doc.get("done") or 0) - int(doc.get("done_run") or 0)
+            elapsed = time.monotonic() - self._started_at
+            info["done"] = previo + tracker.completed
+            info["in_flight"] = tracker.dispatched - tracker.completed
+            info["rate_per_s"] = round(tracker.completed / elapsed, 2) if elapsed > 0 else 0.0
+            if tracker.watermark is not None:
+                info["checkpoint_id"] = str(tracker.watermark)
+        total, done = info.get("total"), info.get("done") or 0
+        info["percent"] = round(min(100.0, 100.0 * done / total), 1) if total else None
+        rate = info["rate_per_s"]
+        info["eta_s"] = round(max(0, total - done) / rate, 1) if total and rate else None
+        return info
+
+    async def recent(self, limit: int = 20) -> list:
+        cursor = self.jobs.find({}, {"result": 0}).sort("created_at", -1).limit(limit)
+        return [self._public(doc) async for doc in cursor]
+
+    # --- programación y recuperación ---
+    async def _orphan(self) -> Optional[Dict[str, Any]]:
+        """Job interrumpido (apagado) o 'running' sin heartbeat: su dueño murió."""
+        limite = datetime.utcnow() - timedelta(seconds=SUMMARY_JOB_LEASE_S)
+        return await self.jobs.find_one(
+            {"$or": [{"status": "interrupted"}, {"status": "running", "heartbeat_at": {"$lt": limite}}]},
+            sort=[("created_at", -1)]
+        )
+
+    def next_scheduled_run(self, last: Optional[datetime]) -> Optional[datetime]:
+        if SUMMARY_JOB_INTERVAL_MIN <= 0:
+            return None
+        if last is None:
+            return datetime.utcnow()
+        return last + timedelta(minutes=SUMMARY_JOB_INTERVAL_MIN)
+
+    async def _last_scheduled(self) -> Optional[datetime]:
+        doc = await self.jobs.find_one({"trigger": "schedule"}, sort=[("created_at", -1)])
+        return doc.get("created_at") if doc else None
+
+    async def _tick(self):
+        if self.running:
+            return
+        if SUMMARY_JOB_AUTO_RESUME:
+            huerfano = await self._orphan()
+            if huerfano:
+                await self.resume(huerfano["_id"], trigger="auto_resume")
+                return
+        proxima = self.next_scheduled_run(await self._last_scheduled())
+        if proxima and proxima <= datetime.utcnow():
+            await self.start({"concurrency": None, "incremental": None}, trigger="schedule")
+
+    async def _scheduler_loop(self):
+        while True:
+            try:
+                await self._tick()
+            except JobConflict:
+                pass  # Otra instancia lo está corriendo
+            except Exception as e:
+                summary_logger.error("Error en el programador de resúmenes: %s", e)
+            await asyncio.sleep(SUMMARY_JOB_TICK_S)
+
+    def start_scheduler(self):
+        if (SUMMARY_JOB_AUTO_RESUME or SUMMARY_JOB_INTERVAL_MIN > 0) and self._scheduler is None:
+            self._scheduler = asyncio.create_task(self._scheduler_loop())
+
+    async def shutdown(self):
+        """Apagado: detiene el programador e interrumpe el job (queda reanudable)."""
+        if self._scheduler:
+            self._scheduler.cancel()
+            self._scheduler = None
+        if self.running:
+            self.task.cancel()
+            try:
+                await self.task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+
+summary_jobs = SummaryJobRunner(summary_jobs_collection, job_locks_collection)
+
+
+def _job_params(concurrency: Optional[int], full: bool, stale_hours: Optional[float]) -> Dict[str, Any]:
+    return {
+        "concurrency": concurrency,
+        "incremental": False if full else None,
+        # Fijo al crear el job: al reanudar se usa el mismo corte
+        "stale_before": datetime.utcnow() - timedelta(hours=stale_hours) if stale_hours else None,
+    }
+
+
+def _job_conflict_response(e: JobConflict):
+    return responder(409, "Resumen Masivo en Curso", {
+        "job_id": e.job_id,
+        "mensaje": f"Ya hay un resumen masivo en curso (job {e.job_id}). Consulta /summary-jobs/{e.job_id}."
+    })
+
+
+@app.get("/generate_summary_batch")
+async def generate_summary_batch(concurrency: Optional[int] = None, full: bool = False,
+                                 stale_hours: Optional[float] = Query(None, gt=0)):
+    """
+    Recorre la base de datos, busca usuarios con teléfono,
+    descarga sus chats y actualiza sus resúmenes masivamente.
+    Los usuarios se procesan en paralelo (máx. SUMMARY_CONCURRENCY) y
+    las actualizaciones se escriben en bloques con bulk_write.
+    Solo se re-resumen conversaciones con cambios, salvo con ?full=true.
+    Con ?stale_hours=N solo entran los resúmenes más viejos que N horas (o inexistentes).
+    Corre como job (con checkpoint) y espera a que termine; para no esperar usa POST /summary-jobs.
+    """
+    summary_logger.info("Iniciando generación masiva de resúmenes...")
+
+    try:
+        job_id = await summary_jobs.start(_job_params(concurrency, full, stale_hours), trigger="http")
+    except JobConflict as e:
+        return _job_conflict_response(e)
+    except Exception as e:
+        summary_logger.error("No se pudo iniciar el resumen masivo: %s", e)
+        return responder(500, "Error de Sistema", {"mensaje": f"No se pudo iniciar el resumen masivo: {e}"})
+
+    task = summary_jobs.task
+    try:
+        # shield: si el cliente se desconecta el job sigue corriendo
+        stats = await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise  # Se canceló este request, no el job
+        # Cancelado por /cancel o por el apagado: queda reanudable desde su checkpoint
+        try:
+            estado = (await summary_jobs.progress(job_id) or {}).get("job_status", "cancelled")
+        except Exception:
+            estado = "cancelled"
+        return responder(409, "Resumen Masivo Detenido", {
+            "job_id": job_id,
+            "job_status": estado,
+            "mensaje": f"El job {job_id} se detuvo antes de terminar ({estado}). Reanúdalo con POST /summary-jobs/{job_id}/resume."
+        })
+    except Exception as e:
+        summary_logger.error("Resumen masivo %s falló: %s", job_id, e)
+        return responder(500, "Error de Sistema", {
+            "job_id": job_id,
+            "job_status": "failed",
+            "mensaje": f"El resumen masivo falló: {e}. Reanúdalo con POST /summary-jobs/{job_id}/resume."
+        })
+    summary_logger.info("Resumen masivo terminado: %s", stats)
+
+    # Retornamos el reporte final
+    raw_data = {
+        "job_id": job_id,
+        "processed": stats["processed"],
+        "skipped_or_failed": stats["skipped"],
+        "unchanged": stats["unchanged"],
+        "throughput": {
+            "total": stats["total"],
+            "concurrency": stats["concurrency"],
+            "elapsed_s": stats["elapsed_s"],
+            "users_per_s": stats["users_per_s"],
+            "bulk_writes": stats["bulk_writes"]
+        },
+        "mensaje": f"Proceso finalizado. Se actualizaron {stats['processed']} usuarios."
+    }
+    
+    return responder(200, "Resumen Masivo Completado", raw_data)
+
+
+@app.post("/summary-jobs")
+async def start_summary_job(concurrency: Optional[int] = Query(None, ge=1), full: bool = False,
+                            stale_hours: Optional[float] = Query(None, gt=0)):
+    """Inicia el resumen masivo en segundo plano y devuelve el job_id (409 si ya hay uno)."""
+    try:
+        job_id = await summary_jobs.start(_job_params(concurrency, full, stale_hours), trigger="manual")
+    except JobConflict as e:
+        return _job_conflict_response(e)
+    return responder(202, "Resumen Masivo Iniciado", {
+        "job_id": job_id,
+        "mensaje": f"Job {job_id} iniciado. Progreso en /summary-jobs/{job_id}."
+    })
+
+
+@app.get("/summary-jobs")
+async def list_summary_jobs(limit: int = Query(20, ge=1, le=200)):
+    """Últimos jobs, el que está en curso y la próxima corrida programada."""
+    try:
+        last = await summary_jobs._last_scheduled()
+        proxima = summary_jobs.next_scheduled_run(last)
+        return responder(200, "Jobs de Resumen", {
+            "running": summary_jobs.job_id if summary_jobs.running else None,
+            "schedule": {"interval_min": SUMMARY_JOB_INTERVAL_MIN or None, "last_run_at": last,
+                         "next_run_at": proxima, "auto_resume": SUMMARY_JOB_AUTO_RESUME},
+            "jobs": await summary_jobs.recent(limit),
+        })
+    except Exception as e:
+        summary_logger.error("Error listando jobs de resumen: %s", e)
+        return responder(500, "Error de Sistema", {"mensaje": f"No se pudieron listar los jobs: {e}"})
+
+
+@app.get("/summary-jobs/{job_id}")
+async def summary_job_progress(job_id: str):
+    """Estado, avance (done/total, %), velocidad, ETA y checkpoint de un job."""
+    info = await summary_jobs.progress(job_id)
+    if info is None:
+        return responder(404, "Job No Encontrado", {"mensaje": f"No existe el job {job_id}."})
+    return responder(200, "Progreso del Resumen Masivo", info)
+
+
+@app.post("/summary-jobs/{job_id}/cancel")
+async def cancel_summary_job(job_id: str):
+    """Detiene el job en curso guardando su checkpoint (se puede reanudar)."""
+    if not await summary_jobs.cancel(job_id):
+        return responder(409, "Job No Activo", {"mensaje": f"El job {job_id} no está corriendo en esta instancia."})
+    return responder(200, "Job Cancelado", await summary_jobs.progress(job_id))
+
+
+@app.post("/summary-jobs/{job_id}/resume")
+async def resume_summary_job(job_id: str):
+    """Reanuda un job cancelado, interrumpido o fallido desde su último checkpoint."""
+    try:
+        await summary_jobs.resume(job_id)
+    except KeyError:
+        return responder(404, "Job No Encontrado", {"mensaje": f"No existe el job {job_id}."})
+    except ValueError as e:
+        return responder(409, "Job Terminado", {"mensaje": str(e)})
+    except JobConflict as e:
+        return _job_conflict_response(e)
+    return responder(202, "Resumen Masivo Reanudado", {
+        "job_id": job_id,
+        "mensaje": f"Job {job_id} reanudado. Progreso en /summary-jobs/{job_id}."
+    })
+
+
+
+@app.get("/mongo/indexes")
+async def mongo_indexes(recheck: bool = False):
+    """Índices declarados vs. existentes (drift) y uso por índice ($indexStats)."""
+    try:
+        if recheck or not mongo_index_state["checked_at"]:
+            await ensure_mongo_indexes(fix_drift=False)
+        uso = {}
+        for coll_name in MONGO_INDEXES:
+            stats = await db[coll_name].aggregate([{"$indexStats": {}}]).to_list(None)
+            uso[coll_name] = {
+                s["name"]: {"ops": s.get("accesses", {}).get("ops", 0), "since": s.get("accesses", {}).get("since")}
+                for s in stats
+            }
+        return responder(200, "Índices de Mongo", {
+            "declared": {c: [{**spec, "keys": [list(k) for k in spec["keys"]]} for spec in specs]
+                         for c, specs in MONGO_INDEXES.items()},
+            "state": mongo_index_state,
+            "usage": uso,
+        })
+    except Exception as e:
+        logger.error("Error consultando índices de Mongo: %s", e)
+        return responder(500, "Error de Sistema", {"mensaje": f"No se pudieron consultar los índices: {e}"})
+
+
+
+
+async def enviar_whatsapp_logic(phone: str, image_url: str):
+    """Simulación de envío de WhatsApp"""
+    query_logger.info("--- ENVIANDO WHATSAPP a %s: %s ---", phone, image_url)
+    # Aquí tu código real de Twilio/Meta
+    pass
+
+async def call_agent_api(prompt: str, AGENT_API_URL) -> str:
+    """Función auxiliar para llamar al agente y obtener texto limpio"""
+    query_logger.info("Llamando api agent studio")
+    response = await agent_callers["query"].post(
+        AGENT_API_URL,
+        {
+            'Content-Type': 'application/json',
+            'cybertron-robot-key': os.getenv("QUERY_KEY") ,   # Usando las keys solicitadas
+            'cybertron-robot-token': os.getenv("QUERY_TOKEN")
+        },
+        {"username": os.getenv("AS_ACCOUNT"), "question": prompt},
+        TIMEOUT_QUERY # Un poco más de tiempo para análisis
+    )
+    data = response.json()
+    return data.get("data", {}).get("answer", "")
+
+async def call_agent_api_stream(prompt: str, AGENT_API_URL):
+    """
+    Igual que call_agent_api pero entrega la respuesta por fragmentos.
+    Si AGENT_STREAMING está activo se pide 'stream' al agente y se leen los
+    eventos SSE conforme llegan; si el agente responde JSON normal, se entrega
+    la respuesta completa en un solo fragmento.
+    """
+    query_logger.info("Llamando api agent studio (stream)")
+    payload = {"username": os.getenv("AS_ACCOUNT"), "question": prompt}
+    if AGENT_STREAMING:
+        payload["stream"] = True
+    # Una vez entregados fragmentos no se puede reintentar: solo circuit breaker
+    with agent_callers["query"].tracked():
+        async for delta in _agent_stream(AGENT_API_URL, payload):
+            yield delta
+
+
+async def _agent_stream(AGENT_API_URL, payload):
+    async with get_http_client().stream(
+        "POST",
+        AGENT_API_URL,
+        headers={
+            'Content-Type': 'application/json',
+            'cybertron-robot-key': os.getenv("QUERY_KEY"),
+            'cybertron-robot-token': os.getenv("QUERY_TOKEN")
+        },
+        json=payload,
+        timeout=endpoint_timeout(TIMEOUT_QUERY)
+    ) as response:
+        response.raise_for_status()
+        if "text/event-stream" not in response.headers.get("content-type", ""):
+            data = json.loads(await response.aread())
+            yield data.get("data", {}).get("answer", "")
+            return
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            chunk = line[5:].strip()
+            if not chunk or chunk == "[DONE]":
                 continue
+            try:
+                data = json.loads(chunk)
+            except ValueError:
+                yield chunk
+                continue
+            body = data.get("data", data) if isinstance(data, dict) else {}
+            delta = body.get("delta") or body.get("answer") or body.get("content") or ""
+            if delta:
+                yield delta
+
+async def generate_sql(question: str, AGENT_API_URL) -> str:
+    """PASO 1 de query_generator: pide al agente el SQL y lo valida (solo SELECT)."""
+    schema_prompt = f"""
+    Actúa como un ingeniero de datos experto. Convierte la siguiente pregunta en lenguaje natural a una consulta SQL PostgreSQL válida.
+    Pregunta: "{question}"
+
+    REGLAS:
+    1. Devuelve SOLO el código SQL (SELECT).
+    2. No uses Markdown (```sql).
+    3. Si no puedes, devuelve "ERROR".
+    """
+    
+    sql_generated = await call_agent_api(schema_prompt,AGENT_API_URL)
+    
+    # Limpieza de la respuesta del agente
+    sql_clean = sql_generated.replace("```sql", "").replace("```", "").replace(";", "").strip()
+    
+    if not sql_clean.upper().startswith("SELECT"):
+        query_logger.info("SQL inválido del agente: %s", sql_clean)
+        raise Exception(f"El agente no generó un SQL válido: {sql_clean}")
+    return sql_clean
+
+
+# --- CACHÉ NL -> SQL ---
+
+CATALOG_TABLES = ("especificaciones_producto", "dispositivos_moviles")
+_catalog_version: Dict[str, Any] = {"value": None, "checked_at": 0.0}
+
+
+async def get_catalog_version(db: AsyncSession) -> str:
+    """
+    Huella de las tablas del catálogo a partir de pg_stat_user_tables
+    (relid + inserciones/actualizaciones/borrados). Cambia cuando se modifica
+    o se recrea alguna tabla. Se consulta como máximo cada CATALOG_VERSION_CHECK s.
+    """
+    now = time.monotonic()
+    if _catalog_version["value"] and now - _catalog_version["checked_at"] < CATALOG_VERSION_CHECK:
+        return _catalog_version["value"]
+    rows = (await db.execute(text(
+        "SELECT relname, relid, n_tup_ins, n_tup_upd, n_tup_del "
+        "FROM pg_stat_user_tables WHERE relname IN :tables ORDER BY relname"
+    ).bindparams(bindparam("tables", expanding=True)), {"tables": list(CATALOG_TABLES)})).fetchall()
+    firma = "|".join(":".join(str(v) for v in row) for row in rows)
+    version = hashlib.sha1(firma.encode("utf-8")).hexdigest()[:16]
+    if _catalog_version["value"] and version != _catalog_version["value"]:
+        query_logger.info("Catálogo modificado (%s -> %s)", _catalog_version['value'], version)
+    _catalog_version.update(value=version, checked_at=now)
+    return version
+
+
+def fold_text(texto: str) -> str:
+    """Minúsculas y sin acentos ('Batería' -> 'bateria')."""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    return "".join(ch for ch in texto if not unicodedata.combining(ch))
+
+
+def normalize_question(question: str) -> str:
+    """Minúsculas, sin acentos, sin signos y con espacios colapsados."""
+    texto = fold_text(question)
+    texto = re.sub(r"[¿?¡!.,;:\"']", " ", texto)
+    return " ".join(texto.split())
+
+
+class SqlTranslationCache:
+    """
+    Caché pregunta normalizada -> SQL validado.
+    Nivel 1: LRU en memoria con TTL. Nivel 2 (opcional): colección sql_cache en Mongo.
+    Las entradas guardan la versión del catálogo y se descartan si ésta cambia.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, collection=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.collection = collection
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._version: Optional[str] = None
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(question: str) -> str:
+        return hashlib.sha1(normalize_question(question).encode("utf-8")).hexdigest()
+
+    def _check_version(self, version: str):
+        if self._version != version:
+            if self._data:
+                query_logger.info("Caché SQL invalidada por cambio de catálogo (%s entradas)", len(self._data))
+            self._data.clear()
+            self._version = version
+
+    async def get(self, question: str, version: str) -> Optional[str]:
+        self._check_version(version)
+        key = self.key(question)
+        entry = self._data.get(key)
+        if entry and time.monotonic() - entry[1] < self.ttl:
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        if entry:
+            del self._data[key]
+
+        if self.collection is not None:
+            try:
+                doc = await self.collection.find_one({"_id": key, "catalog_version": version})
+                if doc and (datetime.utcnow() - doc["created_at"]).total_seconds() < self.ttl:
+                    self._store_local(key, doc["sql"])
+                    self.persistent_hits += 1
+                    return doc["sql"]
+            except Exception as e:
+                query_logger.error("Error leyendo caché SQL persistente: %s", e)
+
+        self.misses += 1
+        return None
+
+    def _store_local(self, key: str, sql: str):
+        self._data[key] = (sql, time.monotonic())
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def set(self, question: str, sql: str, version: str):
+        self._check_version(version)
+        key = self.key(question)
+        self._store_local(key, sql)
+        if self.collection is not None:
+            try:
+                await self.collection.replace_one(
+                    {"_id": key},
+                    {"_id": key, "question": normalize_question(question), "sql": sql,
+                     "catalog_version": version, "created_at": datetime.utcnow()},
+                    upsert=True
+                )
+            except Exception as e:
+                query_logger.error("Error guardando caché SQL persistente: %s", e)
+
+    async def clear(self):
+        self._data.clear()
+        if self.collection is not None:
+            await self.collection.delete_many({})
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.persistent_hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl_s": self.ttl,
+            "persistent": self.collection is not None,
+            "catalog_version": self._version,
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.persistent_hits) / total, 4) if total else 0.0
+        }
+
+
+sql_cache = SqlTranslationCache(SQL_CACHE_SIZE, SQL_CACHE_TTL, sql_cache_collection if SQL_CACHE_PERSIST else None)
+
+
+@app.get("/sql-cache/stats")
+async def sql_cache_stats():
+    """Contadores de la caché NL -> SQL."""
+    stats = sql_cache.stats()
+    return responder(200, "Caché SQL", {**stats, "mensaje": f"Hit ratio: {stats['hit_ratio']}"})
+
+
+@app.delete("/sql-cache")
+async def sql_cache_clear():
+    """Vacía la caché NL -> SQL (memoria y Mongo)."""
+    await sql_cache.clear()
+    return responder(200, "Caché SQL", {"mensaje": "Caché vaciada."})
+
+
+# --- SNAPSHOT COLUMNAR DEL CATÁLOGO (NumPy) ---
+# El catálogo es pequeño y cambia poco: lo mantenemos en memoria como arreglos
+# por columna y respondemos filtros/orden/top-k sin ir a Postgres.
+
+CATALOG_OPS = {
+    "<": np.less, "<=": np.less_equal, ">": np.greater, ">=": np.greater_equal,
+    "==": np.equal, "!=": np.not_equal
+}
+
+
+class CatalogTable:
+    """Columnas de una tabla del catálogo: numéricas en float64 (NaN = NULL) y texto en object."""
+
+    def __init__(self, model):
+        self.model = model
+        self.name = model.__tablename__
+        columns = list(model.__table__.columns)
+        self.columns = [c.name for c in columns]
+        self.numeric_cols = [c.name for c in columns if isinstance(c.type, (Integer, Float, Numeric))]
+        self.integer_cols = {c.name for c in columns if isinstance(c.type, Integer)}
+        self.text_cols = [c for c in self.columns if c not in self.numeric_cols]
+        self.numeric: Dict[str, np.ndarray] = {}
+        self.text: Dict[str, np.ndarray] = {}
+        self._folded: Dict[str, np.ndarray] = {}
+        self.size = 0
+
+    def load(self, rows):
+        self.size = len(rows)
+        self.numeric = {
+            col: np.array([np.nan if r[col] is None else float(r[col]) for r in rows], dtype=np.float64)
+            for col in self.numeric_cols
+        }
+        self.text = {
+            col: np.array([r[col] if r[col] is None or isinstance(r[col], str) else str(r[col]) for r in rows], dtype=object)
+            for col in self.text_cols
+        }
+        # Texto sin acentos/minúsculas para búsquedas 'contains'
+        self._folded = {
+            col: np.array([fold_text(v) if v else "" for v in values], dtype=object)
+            for col, values in self.text.items()
+        }
+
+    def mask(self, filters) -> np.ndarray:
+        mask = np.ones(self.size, dtype=bool)
+        for col, op, value in filters:
+            if col in self.numeric:
+                if op not in CATALOG_OPS:
+                    raise ValueError(f"Operador '{op}' no válido para columna numérica '{col}'")
+                mask &= CATALOG_OPS[op](self.numeric[col], float(value))
+            elif col in self.text:
+                folded = self._folded[col]
+                needle = fold_text(str(value))
+                if op == "contains":
+                    mask &= np.fromiter((needle in v for v in folded), dtype=bool, count=self.size)
+                elif op == "==":
+                    mask &= folded == needle
+                elif op == "!=":
+                    mask &= folded != needle
+                else:
+                    raise ValueError(f"Operador '{op}' no válido para columna de texto '{col}'")
+            else:
+                raise ValueError(f"Columna desconocida en {self.name}: {col}")
+        return mask
+
+    def record(self, i: int, columns) -> Dict[str, Any]:
+        row = {}
+        for col in columns:
+            if col in self.numeric:
+                v = self.numeric[col][i]
+                row[col] = None if np.isnan(v) else (int(v) if col in self.integer_cols else float(v))
+            else:
+                row[col] = self.text[col][i]
+        return row
+
+    def query(self, filters=(), sort_by: Optional[str] = None, descending: bool = False,
+              limit: Optional[int] = None, columns=None):
+        columns = list(columns) if columns else self.columns
+        unknown = [c for c in columns if c not in self.numeric and c not in self.text]
+        if unknown:
+            raise ValueError(f"Columnas desconocidas en {self.name}: {unknown}")
+        idx = np.flatnonzero(self.mask(filters))
+        if sort_by:
+            if sort_by not in self.numeric:
+                raise ValueError(f"Solo se puede ordenar por columnas numéricas: {sort_by}")
+            values = self.numeric[sort_by][idx]
+            keys = -values if descending else values
+            if limit and limit < len(idx):
+                # top-k: argpartition O(n) y luego ordenamos solo los k elegidos (NaN al final)
+                keys = np.where(np.isnan(keys), np.inf, keys)
+                part = np.argpartition(keys, limit - 1)[:limit]
+                idx = idx[part[np.argsort(keys[part], kind="stable")]]
+            else:
+                idx = idx[np.argsort(keys, kind="stable")]
+        if limit:
+            idx = idx[:limit]
+        return [self.record(i, columns) for i in idx]
+
+
+class CatalogSnapshot:
+    """Snapshot en proceso de VehicleSpec y MobileDevice; se recarga cuando cambia la versión del catálogo."""
+
+    def __init__(self, models):
+        self.tables: Dict[str, CatalogTable] = {m.__tablename__: CatalogTable(m) for m in models}
+        self.version: Optional[str] = None
+        self.loaded_at: Optional[datetime] = None
+        self._lock = asyncio.Lock()
+
+    async def ensure_fresh(self, db: AsyncSession) -> "CatalogSnapshot":
+        version = await get_catalog_version(db)
+        if version == self.version:
+            return self
+        async with self._lock:
+            if version != self.version:
+                started = time.perf_counter()
+                for table in self.tables.values():
+                    rows = (await db.execute(select(table.model.__table__))).mappings().all()
+                    table.load(rows)
+                self.version = version
+                self.loaded_at = datetime.utcnow()
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                query_logger.info("Snapshot del catálogo cargado (v%s) en %.1f ms: %s", version, elapsed_ms,
+                                  {name: t.size for name, t in self.tables.items()})
+        return self
+
+    def table(self, name: str) -> CatalogTable:
+        if name not in self.tables:
+            raise ValueError(f"Tabla desconocida: {name}. Opciones: {list(self.tables)}")
+        return self.tables[name]
+
+    def query(self, table: str, filters=(), sort_by: Optional[str] = None, descending: bool = False,
+              limit: Optional[int] = None, columns=None):
+        return self.table(table).query(filters, sort_by, descending, limit, columns)
+
+    def top_k(self, table: str, column: str, k: int = 1, descending: bool = True, filters=(), columns=None):
+        return self.query(table, filters, sort_by=column, descending=descending, limit=k, columns=columns)
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "tables": {name: {"rows": t.size, "numeric_cols": len(t.numeric_cols), "text_cols": len(t.text_cols)}
+                       for name, t in self.tables.items()}
+        }
+
+
+catalog_snapshot = CatalogSnapshot([VehicleSpec, MobileDevice])
+
+
+@app.post("/catalog/query")
+async def catalog_query(request: CatalogQuery, db: AsyncSession = Depends(get_db)):
+    """
+    Consulta estructurada sobre el snapshot en memoria (sin round trip a Postgres).
+    Uso: {"table": "dispositivos_moviles", "filters": [{"column": "precio_num", "op": "<", "value": 5000}],
+          "sort_by": "ram_gb", "descending": true, "limit": 3}
+    """
+    try:
+        await catalog_snapshot.ensure_fresh(db)
+        started = time.perf_counter()
+        rows = catalog_snapshot.query(
+            request.table,
+            [(f.column, f.op, f.value) for f in request.filters],
+            sort_by=request.sort_by,
+            descending=request.descending,
+            limit=request.limit,
+            columns=request.columns
+        )
+        elapsed_us = (time.perf_counter() - started) * 1_000_000
+        return responder(200, "Consulta de Catálogo", {
+            "filas_encontradas": len(rows),
+            "resultados": rows,
+            "snapshot_version": catalog_snapshot.version,
+            "elapsed_us": round(elapsed_us, 1),
+            "mensaje": f"{len(rows)} resultados en {elapsed_us:.0f} µs."
+        })
+    except ValueError as e:
+        return responder(400, "Consulta Inválida", {"mensaje": str(e)})
+    except Exception as e:
+        query_logger.error("Error en catalog_query: %s", e)
+        return responder(500, "Error de Catálogo", {"mensaje": f"Error consultando el catálogo: {str(e)}"})
+
+
+@app.get("/catalog/snapshot")
+async def catalog_snapshot_info(db: AsyncSession = Depends(get_db)):
+    """Estado del snapshot (versión, filas por tabla). Lo recarga si el catálogo cambió."""
+    await catalog_snapshot.ensure_fresh(db)
+    info = catalog_snapshot.info()
+    return responder(200, "Snapshot de Catálogo", {**info, "mensaje": f"Versión {info['version']}"})
+
+
+# --- RUTA RÁPIDA SIN LLM (parser determinista de intención) ---
+# Preguntas tipo "celulares de menos de $5000 con 8GB de RAM" o "la moto con más
+# autonomía" se compilan directo a SQL parametrizado / consulta al snapshot.
+# Si queda cualquier palabra que el parser no entiende, se usa el agente.
+
+FAST_PATH_TABLES = {
+    "dispositivos_moviles": {
+        "keywords": r"\b(?:celular(?:es)?|telefonos?|smartphones?|moviles?|phones?|cel)\b",
+        "name_cols": ["marca", "modelo"],
+        "units": {
+            "gb": "ram_gb", "mah": "bateria_mah", "mp": "camara_principal_mp", "hz": "refresco_pantalla_hz",
+            "w": "carga_w", "pulgadas": "pantalla_pulgadas", "$": "precio_num"
+        },
+        # Otras columnas válidas para la unidad si un calificador las pide ("256GB de almacenamiento")
+        "unit_alternatives": {"gb": ("rom_gb",)},
+        "qualifiers": {"ram": "ram_gb", "memoria": "ram_gb", "almacenamiento": "rom_gb", "rom": "rom_gb",
+                       "storage": "rom_gb", "bateria": "bateria_mah", "camara": "camara_principal_mp",
+                       "carga": "carga_w", "pantalla": "pantalla_pulgadas", "precio": "precio_num"},
+        "display": [("precio_num", "${:,.2f}"), ("ram_gb", "{} GB RAM"), ("rom_gb", "{} GB"),
+                    ("bateria_mah", "{} mAh"), ("camara_principal_mp", "cámara {} MP"), ("carga_w", "carga {} W")],
+        "default_sort": ("precio_num", False),
+    },
+    "especificaciones_producto": {
+        "keywords": r"\b(?:motos?|motocicletas?|scooters?|bicicletas?|bicis?|vehiculos?|patinetas?|motonetas?)\b",
+        "name_cols": ["nombre_comercial", "modelo_interno"],
+        "units": {
+            "km/h": "velocidad_max_kmh", "kmh": "velocidad_max_kmh", "km": "autonomia_km_num", "kg": "carga_max_kg",
+            "w": "potencia_pico_w", "v": "bateria_voltaje_v", "ah": "bateria_amperaje_ah", "nm": "torque_nm",
+            "horas": "tiempo_carga_horas", "h": "tiempo_carga_horas"
+        },
+        "qualifiers": {"autonomia": "autonomia_km_num", "alcance": "autonomia_km_num", "range": "autonomia_km_num",
+                       "velocidad": "velocidad_max_kmh", "carga": "carga_max_kg", "potencia": "potencia_pico_w",
+                       "torque": "torque_nm"},
+        "display": [("autonomia_km_num", "{} km de autonomía"), ("velocidad_max_kmh", "{} km/h"),
+                    ("potencia_pico_w", "{} W"), ("carga_max_kg", "{} kg de carga"),
+                    ("tiempo_carga_horas", "{} h de carga")],
+        "default_sort": ("autonomia_km_num", True),
+    },
+}
+
+# (regex, tabla o None para ambas, columna, descendente)
+FAST_PATH_SUPERLATIVES = [
+    (r"\b(?:mas barat[oa]s?|mas economic[oa]s?|menor precio|cheapest|least expensive)\b", "dispositivos_moviles", "precio_num", False),
+    (r"\b(?:mas car[oa]s?|mayor precio|most expensive)\b", "dispositivos_moviles", "precio_num", True),
+    (r"\b(?:(?:con )?(?:mas|mayor) ram|most ram)\b", "dispositivos_moviles", "ram_gb", True),
+    (r"\b(?:(?:con )?(?:mas|mayor) almacenamiento|most storage)\b", "dispositivos_moviles", "rom_gb", True),
+    (r"\b(?:(?:con )?(?:mas|mayor|mejor) bateria|most battery|biggest battery)\b", "dispositivos_moviles", "bateria_mah", True),
+    (r"\b(?:(?:con )?mejor camara|best camera)\b", "dispositivos_moviles", "camara_principal_mp", True),
+    (r"\b(?:(?:con )?(?:mas|mayor) (?:autonomia|alcance)|most range|longest range)\b", "especificaciones_producto", "autonomia_km_num", True),
+    (r"\b(?:mas rapid[oa]s?|(?:con )?(?:mas|mayor) velocidad|fastest)\b", "especificaciones_producto", "velocidad_max_kmh", True),
+    (r"\b(?:mas potentes?|(?:con )?(?:mas|mayor) potencia|most powerful)\b", "especificaciones_producto", "potencia_pico_w", True),
+    (r"\b(?:(?:con )?(?:mas|mayor) capacidad de carga|(?:que )?(?:aguanta|carga) mas peso)\b", "especificaciones_producto", "carga_max_kg", True),
+    (r"\b(?:mas liger[oa]s?|lightest)\b", "especificaciones_producto", "peso_total_kg", False),
+    (r"\b(?:carga mas rapida|fastest charging)\b", "dispositivos_moviles", "carga_w", True),
+    (r"\b(?:carga mas rapida|fastest charging)\b", "especificaciones_producto", "tiempo_carga_horas", False),
+]
+
+# (operador, alternativas). Las preposiciones sueltas ("con 8GB", "de 5000 pesos")
+# no fijan operador: se usa el default de la columna.
+_FP_CMP = [
+    ("<", r"menos de|menor a|menor que|por debajo de|debajo de|below|less than|under|cheaper than"),
+    ("<=", r"no mas de|hasta|maximo|max|bajo|up to|at most"),
+    (">", r"mas de|mayor a|mayor que|arriba de|por encima de|superior a|over|more than|above"),
+    (">=", r"de por lo menos|al menos|minimo|min|desde|at least"),
+    (None, r"con|with|de"),
+]
+_FP_CMP_RE = "|".join(f"(?P<c{i}>{alt})" for i, (_, alt) in enumerate(_FP_CMP))
+_FP_CONDITION = re.compile(
+    rf"(?:\b(?:{_FP_CMP_RE})\s+)?(?P<cur>\$\s*)?(?P<num>\d+(?:\.\d+)?)\s*(?P<mult>k|mil)?\s*"
+    r"(?P<unit>km/h|kmh|km|kg|gb|mah|mp|hz|ah|nm|w|v|pulgadas|horas|h|pesos|mxn)?\b"
+    r"(?:\s+(?:de\s+)?(?P<qual>ram|memoria|almacenamiento|rom|storage|bateria|camara|autonomia|alcance|range|velocidad|potencia|carga|torque))?"
+)
+_FP_LIMIT = re.compile(r"\b(?:top|los|las|the)\s+(?P<k>\d{1,2})\b(?!\s*(?:k|mil|km|kg|gb|mah|mp|hz|w|v|ah|nm|pulgadas|horas|h|pesos)\b)")
+# Palabras de relleno permitidas en lo que sobra tras reconocer la intención
+_FP_FILLER = set("""
+    que cual cuales cuanto cuantos hay tienen tienes tiene quiero busco buscando necesito dame muestrame muestra
+    ensename ver recomiendame recomienda me puedes podrias por favor el la los las un una unos unas de del con
+    y o en para a al su sus modelo modelos opcion opciones producto productos precio precios cuesta cuestan
+    es son sea sean mas menos mejor mejores ram gb memoria almacenamiento bateria camara autonomia alcance
+    velocidad potencia carga pesos mxn disponible disponibles tengan tenga cuente cuenten
+    which what show me i want need looking for the a an with of and or any some list find phone phones
+    is are that have has price prices dispositivos
+""".split())
+
+
+class CatalogIntent:
+    """Intención estructurada: tabla, filtros (col, op, valor), orden y límite."""
+
+    def __init__(self, table: str):
+        self.table = table
+        self.filters: list = []
+        self.sort_by: Optional[str] = None
+        self.descending = False
+        self.limit: Optional[int] = None
+
+    @property
+    def spec(self) -> Dict[str, Any]:
+        return FAST_PATH_TABLES[self.table]
+
+    def columns(self) -> list:
+        cols = ["id", *self.spec["name_cols"]]
+        for col, _ in self.spec["display"]:
+            cols.append(col)
+        for col, _, _ in self.filters:
+            cols.append(col)
+        if self.sort_by:
+            cols.append(self.sort_by)
+        cols.append("imagen")
+        return list(dict.fromkeys(cols))
 
-            # 2. Generar Resumen con el Summary Bot
-            logger.info(f"Obteniendo generando resumen {phone}")
-            summary_text = await summarize(chat_info)
+    def to_sql(self):
+        """Compila la intención a SQL parametrizado (texto, parámetros)."""
+        select_cols = ", ".join("imagen AS image_url" if c == "imagen" else c for c in self.columns())
+        sql = f"SELECT {select_cols} FROM {self.table}"
+        params: Dict[str, Any] = {}
+        where = []
+        for i, (col, op, value) in enumerate(self.filters):
+            params[f"p{i}"] = value
+            where.append(f"{col} {op} :p{i}")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if self.sort_by:
+            sql += f" ORDER BY {self.sort_by} {'DESC' if self.descending else 'ASC'} NULLS LAST"
+        if self.limit:
+            params["limit"] = self.limit
+            sql += " LIMIT :limit"
+        return sql, params
 
-            # 3. Actualizar en Base de Datos
-            await users_collection.update_one(
-                {"_id": user_doc["_id"]},
-                {
-                    "$set": {
-                        "summary": summary_text,
-                        "last_summary_at": datetime.utcnow()
-                    }
-                }
-            )
-            
-            logger.info(f"Resumen actualizado para: {phone}")
-            processed_count += 1
+    def describe(self) -> Dict[str, Any]:
+        return {"table": self.table, "filters": [list(f) for f in self.filters],
+                "sort_by": self.sort_by, "descending": self.descending, "limit": self.limit}
 
-        except Exception as e:
-            # Capturamos el error para que no detenga el bucle completo, solo este usuario
-            logger.error(f"Error procesando usuario {phone}: {e}")
-            skipped_count += 1
+
+def _fast_path_text(question: str) -> str:
+    texto = fold_text(question)
+    texto = re.sub(r"(\d)[,](\d{3})\b", r"\1\2", texto)         # 5,000 -> 5000
+    texto = re.sub(r"(\d)\.(\d{3})\b(?!\s*(?:\.|\d))", r"\1\2", texto)  # 5.000 -> 5000
+    texto = re.sub(r"[¿?¡!,;:\"']", " ", texto)
+    return " ".join(texto.split())
+
+
+def parse_catalog_intent(question: str) -> Optional[CatalogIntent]:
+    """
+    Intenta interpretar la pregunta sin LLM. Devuelve None si no la entiende
+    por completo (tabla ambigua, unidad desconocida o palabras sin reconocer).
+    """
+    texto = _fast_path_text(question)
+
+    tables = [name for name, spec in FAST_PATH_TABLES.items() if re.search(spec["keywords"], texto)]
+    if len(tables) != 1:
+        return None
+    intent = CatalogIntent(tables[0])
+    spec = intent.spec
+    texto = re.sub(spec["keywords"], " ", texto)
+
+    m = _FP_LIMIT.search(texto)
+    if m:
+        intent.limit = max(1, int(m.group("k")))
+        texto = texto[:m.start()] + " " + texto[m.end():]
+
+    for pattern, table, column, descending in FAST_PATH_SUPERLATIVES:
+        if table != intent.table:
             continue
+        m = re.search(pattern, texto)
+        if m:
+            if intent.sort_by:
+                return None  # Dos superlativos: lo dejamos al agente
+            intent.sort_by, intent.descending = column, descending
+            intent.limit = intent.limit or 1
+            texto = texto[:m.start()] + " " + texto[m.end():]
 
-    # Retornamos el reporte final
-    raw_data = {
-        "processed": processed_count,
-        "skipped_or_failed": skipped_count,
-        "mensaje": f"Proceso finalizado. Se actualizaron {processed_count} usuarios."
-    }
-    
-    return responder(200, "Resumen Masivo Completado", raw_data)
+    restante = []
+    pos = 0
+    for m in _FP_CONDITION.finditer(texto):
+        op = next((op for i, (op, _) in enumerate(_FP_CMP) if m.group(f"c{i}")), None)
+        value = float(m.group("num"))
+        if m.group("mult"):
+            value *= 1000
+        unit = m.group("unit")
+        qual = m.group("qual")
+        if m.group("cur") or unit in ("pesos", "mxn"):
+            unit = "$"
+        if unit and unit != "$" and unit not in spec["units"]:
+            return None
+        unit_column = spec["units"].get(unit) if unit else None
+        qual_column = spec["qualifiers"].get(qual) if qual else None
+        if qual and qual_column is None:
+            return None  # Calificador de la otra tabla ("moto ... de ram")
+        if (unit_column and qual_column and qual_column != unit_column
+                and qual_column not in spec.get("unit_alternatives", {}).get(unit, ())):
+            return None  # Unidad y calificador se contradicen ("3 horas de carga" en kg)
+        column = qual_column or unit_column
+        if unit == "gb" and qual_column is None and value > FAST_PATH_MAX_RAM_GB:
+            return None  # "256 GB" a secas es almacenamiento, no RAM: que decida el agente
+        if column is None:
+            # Número sin unidad: solo lo aceptamos como precio si hay comparador explícito
+            if op in ("<", "<=") and "precio_num" in spec["units"].values():
+                column = "precio_num"
+            else:
+                return None
+        if op is None:
+            op = "<=" if column == "precio_num" else ">="
+        intent.filters.append((column, op, value))
+        restante.append(texto[pos:m.start()])
+        pos = m.end()
+    restante.append(texto[pos:])
 
+    # Dos filtros en el mismo sentido sobre una columna ("8gb ... y 256gb") no son un rango
+    sentidos = [(col, op[0]) for col, op, _ in intent.filters]
+    if len(sentidos) != len(set(sentidos)):
+        return None
 
+    if not intent.filters and not intent.sort_by:
+        return None
+    sobrantes = [w for w in " ".join(restante).split() if w not in _FP_FILLER]
+    if sobrantes:
+        query_logger.info("Ruta rápida descartada, palabras no reconocidas: %s", sobrantes)
+        return None
 
+    if not intent.sort_by:
+        intent.sort_by, intent.descending = spec["default_sort"]
+    intent.limit = min(intent.limit or FAST_PATH_MAX_ROWS, FAST_PATH_MAX_ROWS)
+    return intent
 
-async def enviar_whatsapp_logic(phone: str, image_url: str):
-    """Simulación de envío de WhatsApp"""
-    logger.info(f"--- ENVIANDO WHATSAPP a {phone}: {image_url} ---")
-    # Aquí tu código real de Twilio/Meta
-    pass
 
-async def call_agent_api(prompt: str, AGENT_API_URL) -> str:
-    """Función auxiliar para llamar al agente y obtener texto limpio"""
-    logger.info("Llamando api agent studio")
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            AGENT_API_URL,
-            headers={
-                'Content-Type': 'application/json',
-                'cybertron-robot-key': os.getenv("QUERY_KEY") ,   # Usando las keys solicitadas
-                'cybertron-robot-token': os.getenv("QUERY_TOKEN")
-            },
-            json={"username": os.getenv("AS_ACCOUNT"), "question": prompt},
-            timeout=45.0 # Un poco más de tiempo para análisis
-        )
-        response.raise_for_status()
-        data = response.json()
-        return data.get("data", {}).get("answer", "")
+def fast_path_answer(intent: CatalogIntent, rows) -> str:
+    """Respuesta en plantilla (sin LLM) a partir de las filas encontradas."""
+    if not rows:
+        return "No encontré productos que cumplan con esos criterios. ¿Quieres que ajustemos la búsqueda?"
+    spec = intent.spec
+    lineas = [f"Encontré {len(rows)} opción(es) para ti:" if len(rows) > 1 else "Esta es la mejor opción para ti:"]
+    for row in rows:
+        nombre = " ".join(str(row[c]) for c in spec["name_cols"] if row.get(c)) or f"Producto {row.get('id')}"
+        detalles = [fmt.format(row[col]) for col, fmt in spec["display"] if row.get(col) is not None]
+        lineas.append(f"- **{nombre}**" + (f": {' · '.join(detalles)}" if detalles else ""))
+    return "\n".join(lineas)
+
+
+query_path_counts = {"fast_path": 0, "search": 0, "cache": 0, "agent": 0}
+
+
+@app.get("/query-generator/stats")
+async def query_generator_stats():
+    """Cuántas peticiones sirvió cada ruta (fast_path / search / cache / agent) y llamadas LLM evitadas."""
+    total = sum(query_path_counts.values())
+    llm_por_fast_path = 1 if FAST_PATH_LLM_ANSWER else 2
+    evitadas = (query_path_counts["fast_path"] * llm_por_fast_path + query_path_counts["search"] * 2
+                + query_path_counts["cache"])
+    return responder(200, "Rutas de Query Generator", {
+        "paths": dict(query_path_counts),
+        "total": total,
+        "llm_calls_avoided": evitadas,
+        "fast_path_ratio": round(query_path_counts["fast_path"] / total, 4) if total else 0.0,
+        "mensaje": f"{evitadas} llamadas al LLM evitadas de {total} peticiones."
+    })
+
 
 # --- 4. ENDPOINT PRINCIPAL ---
 
@@ -652,50 +3786,50 @@ async def openapi_test(data: TestPrompt):
         "key_len": len(QUERY_KEY) if QUERY_KEY else 0
     }
 
-    logger.info(f"--- INICIANDO TEST DE CONEXIÓN A: {AGENT_API_URL} ---")
+    logger.info("--- INICIANDO TEST DE CONEXIÓN A: %s ---", AGENT_API_URL)
 
     try:
-        async with httpx.AsyncClient() as client:
-            # Hacemos la petición manual aquí para tener control total
-            response = await client.post(
-                AGENT_API_URL,
-                headers={
-                    'Content-Type': 'application/json',
-                    'cybertron-robot-key': QUERY_KEY,
-                    'cybertron-robot-token': QUERY_TOKEN
-                },
-                json={"username": AS_ACCOUNT, "question": prompt},
-                timeout=15.0 
-            )
-            
-            # Intentamos leer el JSON, si no es JSON, leemos texto crudo
-            try:
-                resp_json = response.json()
-            except:
-                resp_json = "No es un JSON válido"
-
-            # Construimos el reporte de resultados
-            resultado = {
-                "exito_tecnico": True, # Significa que hubo respuesta HTTP (aunque sea error 400/500)
-                "status_code": response.status_code,
-                "debug_info": debug_info,
-                "respuesta_servidor": resp_json,
-                "respuesta_texto_raw": response.text[:500] # Primeros 500 caracteres por si es HTML de error
-            }
+        # Hacemos la petición manual aquí para tener control total
+        client = get_http_client()
+        response = await client.post(
+            AGENT_API_URL,
+            headers={
+                'Content-Type': 'application/json',
+                'cybertron-robot-key': QUERY_KEY,
+                'cybertron-robot-token': QUERY_TOKEN
+            },
+            json={"username": AS_ACCOUNT, "question": prompt},
+            timeout=endpoint_timeout(TIMEOUT_TEST)
+        )
+        
+        # Intentamos leer el JSON, si no es JSON, leemos texto crudo
+        try:
+            resp_json = response.json()
+        except:
+            resp_json = "No es un JSON válido"
 
-            # ANÁLISIS AUTOMÁTICO DE ERRORES COMUNES
-            if response.status_code == 200:
-                resultado["diagnostico"] = "✅ CONEXIÓN EXITOSA. Todo funciona correctamente."
-            elif response.status_code == 401:
-                resultado["diagnostico"] = "❌ ERROR DE AUTH (401). Tus Tokens/Keys son incorrectos o expiraron."
-            elif response.status_code == 403:
-                resultado["diagnostico"] = "🚫 PROHIBIDO (403). Posible error de WHITELIST. Tu IP o Usuario no tiene permisos."
-            elif response.status_code == 404:
-                resultado["diagnostico"] = "❌ URL NO ENCONTRADA (404). Verifica AGENT_API_URL."
-            elif response.status_code >= 500:
-                resultado["diagnostico"] = "🔥 ERROR DEL SERVIDOR REMOTO (500+). El problema es de ellos, no tuyo."
-            
-            return resultado
+        # Construimos el reporte de resultados
+        resultado = {
+            "exito_tecnico": True, # Significa que hubo respuesta HTTP (aunque sea error 400/500)
+            "status_code": response.status_code,
+            "debug_info": debug_info,
+            "respuesta_servidor": resp_json,
+            "respuesta_texto_raw": response.text[:500] # Primeros 500 caracteres por si es HTML de error
+        }
+
+        # ANÁLISIS AUTOMÁTICO DE ERRORES COMUNES
+        if response.status_code == 200:
+            resultado["diagnostico"] = "✅ CONEXIÓN EXITOSA. Todo funciona correctamente."
+        elif response.status_code == 401:
+            resultado["diagnostico"] = "❌ ERROR DE AUTH (401). Tus Tokens/Keys son incorrectos o expiraron."
+        elif response.status_code == 403:
+            resultado["diagnostico"] = "🚫 PROHIBIDO (403). Posible error de WHITELIST. Tu IP o Usuario no tiene permisos."
+        elif response.status_code == 404:
+            resultado["diagnostico"] = "❌ URL NO ENCONTRADA (404). Verifica AGENT_API_URL."
+        elif response.status_code >= 500:
+            resultado["diagnostico"] = "🔥 ERROR DEL SERVIDOR REMOTO (500+). El problema es de ellos, no tuyo."
+        
+        return resultado
 
     except httpx.ConnectError:
         return {
@@ -711,85 +3845,710 @@ async def openapi_test(data: TestPrompt):
         }
 
 
-@app.post("/query-generator")
-async def query_generator(request: QueryRequest, db: Session = Depends(get_db)):
-    AGENT_API_URL = "https://agents.dyna.ai/openapi/v1/conversation/dialog/" # Reemplazar con URL real
-    QUERY_KEY = os.getenv("QUERY_KEY")     # Claves específicas solicitadas
-    QUERY_TOKEN = os.getenv("QUERY_TOKEN")
-    AS_ACCOUNT = os.getenv("AS_ACCOUNT", "").replace('"', '').replace("'", "").strip()
+# --- BÚSQUEDA DE TEXTO SOBRE EL CATÁLOGO (índice invertido en proceso) ---
+# Preguntas por palabra clave ("moto con GPS antirrobo", "celular con NFC") se
+# resuelven con un índice invertido (BM25) construido desde el snapshot, con
+# tokenización en español sin acentos, en lugar de ILIKE '%...%' sin índice.
 
-    question = request.nlp_query
-    
-    # --- VALIDACIÓN INICIAL ---
-    if not question or not isinstance(question, str) or not question.strip():
-        return JSONResponse(status_code=400, content={
-            "raw": {"error": "Bad Request", "details": 'El campo "question" es requerido.'},
-            "markdown": "No hay datos.", "type": "markdown", "desc": "⚠️ Error: Pregunta vacía."
+SEARCH_STOPWORDS = set("""
+    a al algo algun alguna algunas alguno algunos ante con contra cual cuales de del desde donde e el ella
+    en entre era es esa ese eso esta este esto estos hay la las le les lo los mas me mi mis muy no o os
+    para pero por que se sea ser si sin sobre son su sus tambien te tiene tienen tienes tu un una unas uno
+    unos y ya cuenta cuentan incluye incluyen trae traen quiero busco dame muestrame modelo modelos
+    the and or of with for which what has have is are any show me i want phone scooter
+""".split())
+# Columnas de nombre: pesan más en el ranking
+SEARCH_FIELD_WEIGHTS = {"nombre_comercial": 2.0, "modelo_interno": 2.0, "marca": 2.0, "modelo": 2.0}
+SEARCH_SKIP_COLS = {"imagen", "fecha_creacion"}
+# El nombre de la columna también se indexa (peso bajo): 'sistema_antirrobo' responde a "antirrobo"
+SEARCH_COLUMN_NAME_WEIGHT = 0.5
+
+
+def search_tokens(texto: str) -> list:
+    """Tokeniza en minúsculas sin acentos, sin stopwords y con plural simple ('frenos' -> 'freno')."""
+    tokens = []
+    for tok in re.findall(r"[a-z0-9ñ]+", fold_text(texto or "")):
+        if tok in SEARCH_STOPWORDS or len(tok) < 2:
+            continue
+        if len(tok) > 4 and tok.endswith("es") and tok[-3] not in "aeiou":
+            tok = tok[:-2]
+        elif len(tok) > 3 and tok.endswith("s"):
+            tok = tok[:-1]
+        tokens.append(tok)
+    return tokens
+
+
+class CatalogSearchIndex:
+    """Índice invertido BM25 por tabla sobre las columnas de texto del snapshot."""
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.version: Optional[str] = None
+        self._postings: Dict[str, Dict[str, Dict[int, float]]] = {}
+        self._doc_len: Dict[str, np.ndarray] = {}
+        self._avg_len: Dict[str, float] = {}
+        self._lock = asyncio.Lock()
+
+    def build(self, snapshot: CatalogSnapshot):
+        started = time.perf_counter()
+        for name, table in snapshot.tables.items():
+            postings: Dict[str, Dict[int, float]] = {}
+            doc_len = np.zeros(table.size, dtype=np.float64)
+            for col, values in table.text.items():
+                if col in SEARCH_SKIP_COLS:
+                    continue
+                peso = SEARCH_FIELD_WEIGHTS.get(col, 1.0)
+                col_tokens = [t for t in search_tokens(col.replace("_", " ")) if t not in ("texto", "num")]
+                for i, value in enumerate(values):
+                    if not value:
+                        continue
+                    for tok in search_tokens(value):
+                        docs = postings.setdefault(tok, {})
+                        docs[i] = docs.get(i, 0.0) + peso
+                        doc_len[i] += 1
+                    for tok in col_tokens:
+                        docs = postings.setdefault(tok, {})
+                        docs[i] = docs.get(i, 0.0) + SEARCH_COLUMN_NAME_WEIGHT
+            self._postings[name] = postings
+            self._doc_len[name] = doc_len
+            self._avg_len[name] = float(doc_len.mean()) if table.size else 0.0
+        self.version = snapshot.version
+        query_logger.info("Índice de búsqueda construido en %.1f ms: %s términos", (time.perf_counter() - started) * 1000,
+                          {name: len(p) for name, p in self._postings.items()})
+
+    async def ensure_fresh(self, db: AsyncSession) -> "CatalogSearchIndex":
+        await catalog_snapshot.ensure_fresh(db)
+        if self.version != catalog_snapshot.version:
+            async with self._lock:
+                if self.version != catalog_snapshot.version:
+                    self.build(catalog_snapshot)
+        return self
+
+    def known_terms(self, table: str, terms) -> bool:
+        postings = self._postings.get(table, {})
+        return all(t in postings for t in terms)
+
+    def search(self, query: str, table: Optional[str] = None, limit: int = 5, require_all: bool = False) -> list:
+        terms = list(dict.fromkeys(search_tokens(query)))
+        if not terms:
+            return []
+        resultados = []
+        for name in ([table] if table else list(self._postings)):
+            postings = self._postings.get(name, {})
+            snapshot_table = catalog_snapshot.table(name)
+            n_docs = snapshot_table.size
+            scores = np.zeros(n_docs, dtype=np.float64)
+            matched = np.zeros(n_docs, dtype=np.int32)
+            doc_len, avg_len = self._doc_len[name], self._avg_len[name] or 1.0
+            for term in terms:
+                docs = postings.get(term)
+                if not docs:
+                    continue
+                idf = np.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                idx = np.fromiter(docs.keys(), dtype=np.int64, count=len(docs))
+                tf = np.fromiter(docs.values(), dtype=np.float64, count=len(docs))
+                norm = self.K1 * (1 - self.B + self.B * doc_len[idx] / avg_len)
+                scores[idx] += idf * tf * (self.K1 + 1) / (tf + norm)
+                matched[idx] += 1
+            candidatos = np.flatnonzero(matched == len(terms) if require_all else scores > 0)
+            for i in candidatos:
+                resultados.append((float(scores[i]), name, int(i)))
+        resultados.sort(key=lambda r: r[0], reverse=True)
+        return [self._hit(name, i, score, terms) for score, name, i in resultados[:limit]]
+
+    def _hit(self, name: str, i: int, score: float, terms) -> Dict[str, Any]:
+        table = catalog_snapshot.table(name)
+        spec = FAST_PATH_TABLES.get(name, {})
+        nombre = " ".join(str(table.text[c][i]) for c in spec.get("name_cols", []) if table.text[c][i])
+        coincidencias = {}
+        for col, values in table.text.items():
+            value = values[i]
+            if col in SEARCH_SKIP_COLS or not value:
+                continue
+            if set(search_tokens(f"{value} {col.replace('_', ' ')}")) & set(terms):
+                coincidencias[col] = value if len(value) <= 160 else value[:160].rstrip() + "…"
+        return {
+            "table": name,
+            "id": int(table.numeric["id"][i]),
+            "nombre": nombre,
+            "score": round(score, 4),
+            "coincidencias": coincidencias,
+            "image_url": table.text["imagen"][i] if "imagen" in table.text else None
+        }
+
+
+catalog_search = CatalogSearchIndex()
+
+
+async def search_route(question: str, db: AsyncSession) -> Optional[list]:
+    """
+    Ruta de búsqueda para preguntas por palabra clave: exige una sola tabla
+    mencionada, pocos términos y que todos existan en el índice. None = no aplica.
+    """
+    texto = fold_text(question)
+    tables = [name for name, spec in FAST_PATH_TABLES.items() if re.search(spec["keywords"], texto)]
+    if len(tables) != 1:
+        return None
+    for spec in FAST_PATH_TABLES.values():
+        texto = re.sub(spec["keywords"], " ", texto)
+    terms = [t for t in dict.fromkeys(search_tokens(texto)) if t not in _FP_FILLER]
+    if not terms or len(terms) > SEARCH_ROUTE_MAX_TERMS:
+        return None
+    await catalog_search.ensure_fresh(db)
+    if not catalog_search.known_terms(tables[0], terms):
+        return None
+    hits = catalog_search.search(" ".join(terms), table=tables[0], limit=FAST_PATH_MAX_ROWS, require_all=True)
+    return hits or None
+
+
+def search_answer(hits) -> str:
+    """Respuesta en plantilla para la ruta de búsqueda."""
+    lineas = [f"Encontré {len(hits)} opción(es) que coinciden con tu búsqueda:"]
+    for hit in hits:
+        col, valor = next(iter(hit["coincidencias"].items()), ("", ""))
+        detalle = f"{col.replace('_', ' ')}: {valor}" if valor else ""
+        lineas.append(f"- **{hit['nombre'] or 'Producto ' + str(hit['id'])}**" + (f": {detalle}" if detalle else ""))
+    return "\n".join(lineas)
+
+
+@app.get("/catalog/search")
+async def catalog_search_endpoint(q: str, table: Optional[str] = None, limit: int = Query(10, ge=1, le=100),
+                                  db: AsyncSession = Depends(get_db)):
+    """
+    Búsqueda rankeada (BM25, sin acentos) sobre los campos de texto del catálogo.
+    Uso: /catalog/search?q=gps antirrobo&table=especificaciones_producto
+    """
+    try:
+        await catalog_search.ensure_fresh(db)
+        started = time.perf_counter()
+        hits = catalog_search.search(q, table=table, limit=limit)
+        elapsed_us = (time.perf_counter() - started) * 1_000_000
+        return responder(200, "Búsqueda en Catálogo", {
+            "query": q,
+            "terms": search_tokens(q),
+            "resultados": hits,
+            "elapsed_us": round(elapsed_us, 1),
+            "mensaje": f"{len(hits)} resultados para '{q}'."
         })
+    except ValueError as e:
+        return responder(400, "Búsqueda Inválida", {"mensaje": str(e)})
+    except Exception as e:
+        query_logger.error("Error en catalog_search: %s", e)
+        return responder(500, "Error de Búsqueda", {"mensaje": f"Error buscando en el catálogo: {str(e)}"})
+
+
+# --- COMPACTACIÓN DE RESULTADOS PARA EL PROMPT (presupuesto de tokens) ---
+# El agente no necesita las ~60 columnas de especificaciones_producto: proyectamos
+# las relevantes, quitamos nulos y duplicados texto/número, truncamos y limitamos filas.
+
+# Columnas que identifican al producto: siempre se envían
+COMPACT_IDENTITY_COLS = ("nombre_comercial", "modelo_interno", "marca", "modelo", "categoria",
+                         "precio_num", "precio_promocion_texto")
+# Columnas que nunca aportan a la respuesta
+COMPACT_DROP_COLS = {"id", "imagen", "image_url", "fecha_creacion"}
+# Columna de texto -> su equivalente numérico (si están ambas, se envía solo la numérica)
+COMPACT_TEXT_NUMERIC_PAIRS = {
+    "autonomia_texto": "autonomia_km_num", "velocidad_maxima_texto": "velocidad_max_kmh",
+    "carga_maxima_texto": "carga_max_kg", "torque_maximo_texto": "torque_nm",
+    "potencia_pico_texto": "potencia_pico_w", "potencia_nominal_texto": "potencia_nominal_w",
+    "capacidad_escalada_texto": "grado_escalada_deg", "distancia_al_suelo_texto": "despeje_suelo_mm",
+    "tiempo_carga_texto": "tiempo_carga_horas", "peso_seco_texto": "peso_seco_kg",
+    "peso_total_texto": "peso_total_kg", "cantidad_carga_40hq_texto": "cantidad_40hq_num",
+    "pantalla_texto": "pantalla_pulgadas", "bateria_texto": "bateria_mah", "carga_texto": "carga_w",
+}
+# Palabras de la pregunta -> fragmentos de nombre de columna
+COMPACT_SYNONYMS = {
+    "rapid": "velocidad", "veloz": "velocidad", "alcance": "autonomia", "km": "autonomia", "range": "autonomia",
+    "peso": "peso", "pesa": "peso", "cargar": "carga", "app": "funciones_app", "robo": "antirrobo",
+    "seguridad": "seguridad", "gps": "antirrobo", "memoria": "ram", "almacenamiento": "rom", "foto": "camara",
+    "camara": "camara", "pantalla": "pantalla", "precio": "precio", "cuesta": "precio", "barato": "precio",
+    "color": "colores", "colores": "colores", "frenos": "frenos", "llanta": "llanta", "motor": "motor",
+    "bateria": "bateria", "suspension": "suspension", "asiento": "asiento", "agua": "impermeabilidad",
+}
+
+
+def _estimate_tokens(texto: str) -> int:
+    return len(texto) // 4 + 1  # ~4 caracteres por token
+
+
+def _relevant_columns(question: str, columns) -> list:
+    palabras = {p for p in normalize_question(question).split()
+                if not any(re.fullmatch(spec["keywords"], p) for spec in FAST_PATH_TABLES.values())}
+    fragmentos = {COMPACT_SYNONYMS.get(p, p) for p in palabras if len(p) > 2}
+    for p in palabras:
+        for raiz, frag in COMPACT_SYNONYMS.items():
+            if p.startswith(raiz):
+                fragmentos.add(frag)
+    relevantes = [c for c in columns if c in COMPACT_IDENTITY_COLS]
+    for col in columns:
+        partes = col.split("_")
+        if col not in relevantes and any(f in partes or (len(f) >= 4 and f in col) for f in fragmentos):
+            relevantes.append(col)
+    return relevantes
+
+
+def compact_rows_for_prompt(question: str, rows) -> str:
+    """
+    Devuelve el JSON compacto de las filas para analysis_prompt, respetando
+    COMPACT_TOKEN_BUDGET, y registra el tamaño antes/después.
+    """
+    if not rows:
+        return "[]"
+    columns = [c for c in rows[0].keys() if c not in COMPACT_DROP_COLS]
+
+    # 1. Proyección: solo si el SELECT trajo más columnas de las que vale la pena enviar
+    if len(columns) > COMPACT_MAX_COLUMNS:
+        relevantes = _relevant_columns(question, columns)
+        if len(relevantes) <= len([c for c in columns if c in COMPACT_IDENTITY_COLS]):
+            # La pregunta no menciona atributos: priorizamos las columnas numéricas
+            resumen = [c for c in columns if c not in relevantes and not c.endswith("_texto")]
+            resumen.sort(key=lambda c: not isinstance(rows[0].get(c), (int, float)))
+            relevantes += resumen[:COMPACT_MAX_COLUMNS - len(relevantes)]
+        columns = relevantes[:COMPACT_MAX_COLUMNS]
+
+    # 2. Duplicados texto/número
+    presentes = set(columns)
+    columns = [c for c in columns if COMPACT_TEXT_NUMERIC_PAIRS.get(c) not in presentes]
+
+    # 3. Filas sin nulos y con texto truncado, hasta agotar el presupuesto
+    compactas = []
+    usados = 2
+    for row in rows:
+        item = {}
+        for col in columns:
+            value = row.get(col)
+            if value is None or value == "":
+                continue
+            if isinstance(value, str) and len(value) > COMPACT_MAX_TEXT:
+                value = value[:COMPACT_MAX_TEXT].rstrip() + "…"
+            item[col] = value
+        costo = _estimate_tokens(json_text(item)) + 1
+        if compactas and usados + costo > COMPACT_TOKEN_BUDGET:
+            break
+        compactas.append(item)
+        usados += costo
+
+    omitidas = len(rows) - len(compactas)
+    data_string = json_text(compactas)
+    if omitidas:
+        data_string += f"\n(+{omitidas} resultados más omitidos por espacio)"
+    query_logger.info(
+        "Prompt compactado: %s filas x %s cols -> %s filas x %s cols, ~%s tokens",
+        len(rows), len(rows[0]), len(compactas), len(columns), _estimate_tokens(data_string)
+    )
+    if query_logger.isEnabledFor(logging.DEBUG):
+        # Medir el original cuesta serializar todas las filas otra vez: solo en DEBUG
+        query_logger.debug("Prompt sin compactar: ~%s tokens", _estimate_tokens(json_text(rows)))
+    return data_string
+
+
+# --- PLANTILLAS SQL PARAMETRIZADAS (reuso de prepared statements) ---
+# "precio_num < 5000" y "precio_num < 6000" comparten plantilla "precio_num < :p0".
+# asyncpg prepara cada texto SQL una vez por conexión y lo reutiliza, así que
+# las consultas con la misma forma reutilizan el plan en lugar de re-planearse.
+
+_SQL_LITERAL = re.compile(
+    r"(?P<ident>\"(?:[^\"]|\"\")*\")|(?P<str>'(?:[^']|'')*')|(?P<num>(?<![\w.$:])\d+(?:\.\d+)?(?![\w.]))"
+)
+# Contextos donde un literal NO puede ser parámetro (posiciones en ORDER/GROUP BY, tipos, casts)
+_SQL_KEEP_BEFORE = re.compile(
+    r"(?:\b(?:order|group)\s+by\s+(?:[\w.\"]+(?:\s+(?:asc|desc))?(?:\s+nulls\s+(?:first|last))?\s*,\s*)*"
+    r"|\b(?:numeric|decimal|varchar|char|character varying|float|time|timestamp|interval|bit)\s*\(\s*(?:\d+\s*,\s*)?"
+    r"|\b(?:interval|date|timestamp|timestamptz|time|e))\s*$",
+    re.IGNORECASE
+)
+
+
+def parameterize_sql(sql: str):
+    """
+    Saca los literales del SQL a parámetros. Devuelve (plantilla, params).
+    La plantilla normaliza espacios para que la misma forma dé el mismo texto.
+    """
+    params: Dict[str, Any] = {}
+    partes = []
+    pos = 0
+    for m in _SQL_LITERAL.finditer(sql):
+        if m.group("ident"):
+            continue
+        antes = sql[max(0, m.start() - 120):m.start()]
+        if _SQL_KEEP_BEFORE.search(antes) or sql[m.end():m.end() + 2] == "::":
+            continue
+        if m.group("str") is not None:
+            value = m.group("str")[1:-1].replace("''", "'")
+        else:
+            literal = m.group("num")
+            value = float(literal) if "." in literal else int(literal)
+        nombre = f"p{len(params)}"
+        params[nombre] = value
+        partes.append(sql[pos:m.start()])
+        partes.append(f":{nombre}")
+        pos = m.end()
+    partes.append(sql[pos:])
+    plantilla = "".join(partes)
+    # Espacios colapsados solo si no quedó ningún literal/identificador entre comillas
+    if "'" not in plantilla and '"' not in plantilla:
+        plantilla = " ".join(plantilla.split())
+    return plantilla, params
+
+
+def _slot_type(value: Any) -> str:
+    """Tipo del parámetro tal como lo codifica asyncpg (un int fuera de int4 es otro tipo)."""
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, int):
+        return "int" if -2 ** 31 <= value < 2 ** 31 else "bigint"
+    return "str"
+
+
+# SQLSTATE de errores por tipo de parámetro (la clase 22 se revisa aparte):
+# datatype_mismatch, undefined_function ("operator does not exist: text = integer"), indeterminate_datatype
+_TYPE_MISMATCH_SQLSTATES = {"42804", "42883", "42P18"}
+
+
+def _is_param_type_error(e: Exception) -> bool:
+    """¿El error viene de los tipos de los parámetros? (timeouts, sintaxis o columnas no)."""
+    if not isinstance(e, DBAPIError):
+        return False
+    sqlstate = getattr(e.orig, "sqlstate", None)
+    if sqlstate:
+        return sqlstate.startswith("22") or sqlstate in _TYPE_MISMATCH_SQLSTATES
+    # Sin SQLSTATE: asyncpg rechazó el valor al codificarlo (p.ej. '8' para int4)
+    return isinstance(e, DataError)
+
+
+class SqlTemplateCache:
+    """
+    Plantillas conocidas por forma. Cada plantilla guarda un estado por firma
+    de tipos de sus parámetros ('int,str', ...):
+    'new' (primera vez: se prueba dentro de un SAVEPOINT), 'ok' (se ejecuta directo)
+    o 'literal' (los parámetros no son compatibles con los tipos: se usa el SQL original).
+    Solo los errores de tipo pasan a 'literal'; cualquier otro (timeout, sintaxis,
+    columna inexistente) se propaga sin tocar el estado ni repetir la consulta.
+    Una firma distinta (p.ej. 8 y luego '8' o 8.5 en la misma columna) vuelve a
+    probarse con SAVEPOINT antes de ejecutarse directo.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._templates: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+
+    def _entry(self, plantilla: str) -> Dict[str, Any]:
+        entry = self._templates.get(plantilla)
+        if entry is not None:
+            self._templates.move_to_end(plantilla)
+            entry["hits"] += 1
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry = {"signatures": {}, "hits": 0, "created_at": datetime.utcnow().isoformat()}
+        self._templates[plantilla] = entry
+        while len(self._templates) > self.maxsize:
+            self._templates.popitem(last=False)
+        return entry
+
+    async def execute(self, db: AsyncSession, sql: str):
+        plantilla, params = parameterize_sql(sql)
+        if not params:
+            return await db.execute(text(sql))
+        entry = self._entry(plantilla)
+        firma = ",".join(_slot_type(v) for v in params.values())
+        state = entry["signatures"].get(firma, "new")
+
+        if state == "ok":
+            return await db.execute(text(plantilla), params)
+        if state == "new":
+            try:
+                # SAVEPOINT: si los tipos no cuadran, la transacción sigue usable
+                async with db.begin_nested():
+                    result = await db.execute(text(plantilla), params)
+                    rows = result.all()
+                    keys = result.keys()
+                entry["signatures"][firma] = "ok"
+                return _BufferedResult(keys, rows)
+            except Exception as e:
+                if not _is_param_type_error(e):
+                    raise
+                query_logger.info("Plantilla SQL no parametrizable con tipos (%s), se usará el SQL literal: %s", firma, e)
+                entry["signatures"][firma] = "literal"
+        self.fallbacks += 1
+        return await db.execute(text(sql))
+
+    def stats(self, top: int = 10) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        populares = sorted(self._templates.items(), key=lambda kv: kv[1]["hits"], reverse=True)[:top]
+        firmas = [s for e in self._templates.values() for s in e["signatures"].values()]
+        return {
+            "cardinality": len(self._templates),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "literal_fallbacks": self.fallbacks,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            "states": {s: firmas.count(s) for s in ("ok", "literal")},
+            "top": [{"template": t, **e} for t, e in populares]
+        }
+
+
+class _BufferedResult:
+    """Resultado ya leído (el SAVEPOINT se cerró): expone lo que usa serialize_rows."""
+
+    returns_rows = True
+
+    def __init__(self, keys, rows):
+        self._keys = list(keys)
+        self._rows = rows
+
+    def keys(self):
+        return self._keys
+
+    def all(self):
+        return self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+
+sql_templates = SqlTemplateCache(SQL_TEMPLATE_CACHE_SIZE)
+
+
+@app.get("/sql-templates/stats")
+async def sql_templates_stats():
+    """Cardinalidad de plantillas SQL y tasa de reuso."""
+    stats = sql_templates.stats()
+    return responder(200, "Plantillas SQL", {
+        **stats,
+        "prepared_statement_cache_size": DB_PREPARED_CACHE_SIZE,
+        "mensaje": f"{stats['cardinality']} plantillas, hit ratio {stats['hit_ratio']}"
+    })
+
+
+# --- GUARDRAILS PARA SQL GENERADO ---
+# Entre la generación del SQL y db.execute: una sola sentencia SELECT, LIMIT
+# forzado/acotado, statement_timeout por sentencia y (opcional) tope de costo EXPLAIN.
+
+class GuardrailError(Exception):
+    """SQL rechazado por los guardrails; se responde con responder() en formato de error."""
+
+    def __init__(self, motivo: str, mensaje: str):
+        super().__init__(mensaje)
+        self.motivo = motivo
+        self.mensaje = mensaje
+
+
+# Palabras prohibidas solo en posición de sentencia (inicio o tras "("): como
+# alias o columna ("AS set", "do") son identificadores válidos.
+_GUARD_FORBIDDEN = re.compile(
+    r"(?:^|\()\s*(insert|update|delete|merge|drop|alter|create|truncate|grant|revoke|copy|vacuum|analyze|"
+    r"call|do|execute|prepare|listen|notify|lock|set|reset)\b",
+    re.IGNORECASE
+)
+# Sentencia principal tras la lista de CTEs: WITH x AS (...) DELETE ...
+_GUARD_AFTER_CTE = re.compile(r"\)\s*(insert|update|delete|merge)\b", re.IGNORECASE)
+# SELECT ... INTO crea una tabla; FOR UPDATE/SHARE toma locks
+_GUARD_CLAUSES = re.compile(r"\b(into|for\s+(?:no\s+key\s+)?update|for\s+(?:key\s+)?share)\b", re.IGNORECASE)
+_GUARD_FUNCTIONS = re.compile(
+    r"\b(pg_sleep\w*|pg_terminate_backend|pg_cancel_backend|pg_read_\w+|dblink\w*|set_config|lo_\w+)\s*\(",
+    re.IGNORECASE
+)
+_GUARD_LIMIT = re.compile(r"\blimit\s+(\d+|all)\b(\s+offset\s+\d+)?\s*$", re.IGNORECASE)
+_GUARD_PAGING = re.compile(r"\b(?:limit|offset|fetch)\b", re.IGNORECASE)
+
+
+def _mask_sql_literals(sql: str) -> str:
+    """Reemplaza literales '...' e identificadores "..." por espacios (mismas posiciones)."""
+    return re.sub(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"", lambda m: " " * len(m.group(0)), sql)
+
+
+def _top_level_tail(masked: str) -> int:
+    """Posición desde la que el SQL vuelve a nivel superior (fuera de paréntesis) por última vez."""
+    depth, tail = 0, 0
+    for i, ch in enumerate(masked):
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+            if depth == 0:
+                tail = i + 1
+    return tail
+
+
+def guard_sql(sql: str, max_rows: Optional[int] = None) -> str:
+    """
+    Valida el SQL y devuelve la versión con LIMIT acotado. Lanza GuardrailError si
+    no es una única consulta de solo lectura.
+    """
+    max_rows = max_rows or GUARD_MAX_ROWS
+    sql = sql.strip().rstrip(";").strip()
+    masked = _mask_sql_literals(sql)
+
+    if ";" in masked:
+        raise GuardrailError("multiple_statements", "Solo se permite una sentencia SQL.")
+    if "--" in masked or "/*" in masked:
+        raise GuardrailError("comments", "El SQL generado no puede contener comentarios.")
+    if not re.match(r"\s*(select|with)\b", masked, re.IGNORECASE):
+        raise GuardrailError("not_select", "Solo se permiten consultas SELECT.")
+    for patron in (_GUARD_FORBIDDEN, _GUARD_AFTER_CTE, _GUARD_CLAUSES, _GUARD_FUNCTIONS):
+        prohibida = patron.search(masked)
+        if prohibida:
+            palabra = " ".join(prohibida.group(1).split()).upper()
+            raise GuardrailError("forbidden_keyword", f"Palabra no permitida en la consulta: {palabra}")
+
+    tail = _top_level_tail(masked)
+    m = _GUARD_LIMIT.search(masked, tail)
+    if m:
+        actual = m.group(1).lower()
+        if actual == "all" or int(actual) > max_rows:
+            offset = m.group(2) or ""
+            sql = sql[:m.start()] + f"LIMIT {max_rows}{offset}"
+    elif _GUARD_PAGING.search(masked, tail):
+        # OFFSET ... LIMIT, FETCH FIRST ...: se respeta tal cual y se acota por fuera
+        sql = f"SELECT * FROM (\n{sql}\n) AS guarded_q LIMIT {max_rows}"
+    else:
+        sql = f"{sql}\nLIMIT {max_rows}"
+    return sql
+
+
+async def guarded_execute(db: AsyncSession, sql: str):
+    """
+    Ejecuta el SQL ya validado con statement_timeout local a la transacción y,
+    si GUARD_MAX_COST > 0, rechaza planes más caros que el umbral.
+    """
+    if GUARD_STATEMENT_TIMEOUT_MS > 0:
+        await db.execute(text(f"SET LOCAL statement_timeout = {int(GUARD_STATEMENT_TIMEOUT_MS)}"))
+    if GUARD_MAX_COST > 0:
+        plan = (await db.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"))).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        costo = float(plan[0]["Plan"]["Total Cost"])
+        if costo > GUARD_MAX_COST:
+            raise GuardrailError("cost", f"La consulta es demasiado costosa (costo estimado {costo:.0f} > {GUARD_MAX_COST:.0f}).")
+    # Literales -> parámetros: la misma forma de consulta reutiliza el prepared statement
+    return await sql_templates.execute(db, sql)
+
+
+async def query_pipeline(question: str, function_call_username: Optional[str], db: AsyncSession,
+                         stream_answer: bool = False):
+    """
+    Cadena completa de /query-generator como generador de eventos (evento, datos):
+    'sql' -> 'rows' -> 'answer_delta'* -> 'final'. El evento 'final' trae
+    (status_code, title, raw_data) para responder().
+    """
+    AGENT_API_URL = "https://agents.dyna.ai/openapi/v1/conversation/dialog/" # Reemplazar con URL real
+    sql_clean = None
 
     try:
-        logger.info(f"1. Iniciando proceso para: {question}")
+        query_logger.info("1. Iniciando proceso para: %s", question)
 
         # ==============================================================================
-        # PASO 1: NLP -> SQL (Llamada al Agente)
+        # PASO 1: NLP -> SQL (Ruta rápida, Caché o Llamada al Agente)
         # ==============================================================================
-        schema_prompt = f"""
-        Actúa como un ingeniero de datos experto. Convierte la siguiente pregunta en lenguaje natural a una consulta SQL PostgreSQL válida.
-        Pregunta: "{question}"
-
-        REGLAS:
-        1. Devuelve SOLO el código SQL (SELECT).
-        2. No uses Markdown (```sql).
-        3. Si no puedes, devuelve "ERROR".
-        """
-        
-        sql_generated = await call_agent_api(schema_prompt,AGENT_API_URL)
-        
-        # Limpieza de la respuesta del agente
-        sql_clean = sql_generated.replace("```sql", "").replace("```", "").replace(";", "").strip()
-        
-        if not sql_clean.upper().startswith("SELECT"):
-            logger.info(sql_clean)
-            raise Exception(f"El agente no generó un SQL válido: {sql_clean}")
+        with stage_timer("query_route"):
+            intent = parse_catalog_intent(question) if FAST_PATH_ENABLED else None
+            search_hits = None
+            if not intent and SEARCH_ROUTE_ENABLED:
+                try:
+                    search_hits = await search_route(question, db)
+                except Exception as e:
+                    query_logger.error("Error en la ruta de búsqueda: %s", e)
+        cached_sql = None
 
-        logger.info(f"2. SQL Generado: {sql_clean}")
+        if intent:
+            # Pregunta estructurada: SQL compilado sin LLM y respuesta desde el snapshot
+            path = "fast_path"
+            sql_clean, _ = intent.to_sql()
+            query_logger.info("2. Ruta rápida (%s): %s", intent.describe(), sql_clean)
+            yield "sql", {"sql": sql_clean, "path": path}
 
-        # ==============================================================================
-        # PASO 2: EJECUTAR SQL EN BASE DE DATOS
-        # ==============================================================================
-        result_proxy = db.execute(text(sql_clean))
-        keys = result_proxy.keys()
-        db_results = [dict(zip(keys, row)) for row in result_proxy]
-        db_results = json.loads(json.dumps(db_results, default=str))
-        
-        logger.info(f"3. Resultados DB encontrados: {len(db_results)}")
+            with stage_timer("query_db"):
+                await catalog_snapshot.ensure_fresh(db)
+                db_results = catalog_snapshot.query(
+                    intent.table, intent.filters, sort_by=intent.sort_by,
+                    descending=intent.descending, limit=intent.limit, columns=intent.columns()
+                )
+            for row in db_results:
+                row["image_url"] = row.pop("imagen", None)
+        elif search_hits:
+            # Pregunta por palabra clave: ranking del índice invertido, sin SQL
+            path = "search"
+            query_logger.info("2. Ruta de búsqueda: %s coincidencias", len(search_hits))
+            yield "sql", {"sql": None, "path": path}
+            db_results = search_hits
+        else:
+            try:
+                with stage_timer("query_catalog_version"):
+                    catalog_version = await get_catalog_version(db)
+            except Exception as e:
+                query_logger.error("No se pudo obtener la versión del catálogo: %s", e)
+                catalog_version = None
+
+            with stage_timer("query_sql_cache"):
+                cached_sql = await sql_cache.get(question, catalog_version) if catalog_version else None
+            if cached_sql:
+                query_logger.info("1b. SQL servido desde caché")
+                path = "cache"
+                sql_clean = cached_sql
+            else:
+                path = "agent"
+                with stage_timer("query_nl2sql"):
+                    sql_clean = await generate_sql(question, AGENT_API_URL)
+
+            query_logger.info("2. SQL Generado: %s", sql_clean)
+
+            # ==============================================================================
+            # PASO 2: GUARDRAILS + EJECUTAR SQL EN BASE DE DATOS
+            # ==============================================================================
+            sql_generado = sql_clean
+            sql_clean = guard_sql(sql_generado)
+            yield "sql", {"sql": sql_clean, "path": path}
+
+            with stage_timer("query_db"):
+                result_proxy = await guarded_execute(db, sql_clean)
+                db_results = serialize_rows(result_proxy)
+
+            # Solo guardamos SQL que el agente generó y que Postgres ejecutó sin error
+            if not cached_sql and catalog_version:
+                await sql_cache.set(question, sql_generado, catalog_version)
+
+        query_path_counts[path] += 1
+        query_logger.info("3. Resultados DB encontrados: %s (ruta: %s)", len(db_results), path)
+        yield "rows", {"count": len(db_results), "data_raw": db_results}
 
         # ==============================================================================
         # PASO 3: LÓGICA WHATSAPP (Side Effect)
         # ==============================================================================
         if db_results and "image_url" in db_results[0] and db_results[0]["image_url"]:
-            username = request.function_call_username
+            username = function_call_username
             if username and isinstance(username, str):
                 raw_phone = username.split("--")[-1] if "--" in username else username
                 try:
-                    await enviar_whatsapp_logic(raw_phone, db_results[0]["image_url"])
+                    with stage_timer("query_whatsapp"):
+                        await enviar_whatsapp_logic(raw_phone, db_results[0]["image_url"])
                     # Opcional: Eliminar la URL para que no sature el contexto del agente en el paso 4
                     # Pero a veces es bueno dejarla para que el agente sepa que hay foto.
                     # Si quieres borrarla descomenta abajo:
                     # for row in db_results:
                     #    if "image_url" in row: del row["image_url"]
                 except Exception as e:
-                    logger.error(f"Error enviando WhatsApp: {e}")
+                    query_logger.error("Error enviando WhatsApp: %s", e)
 
         # ==============================================================================
         # PASO 4: DATOS -> LENGUAJE NATURAL (Segunda llamada al Agente)
         # ==============================================================================
         
-        if not db_results:
+        if path == "fast_path" and not FAST_PATH_LLM_ANSWER:
+            final_message = fast_path_answer(intent, db_results)
+        elif path == "search":
+            final_message = search_answer(db_results)
+        elif not db_results:
             final_message = "No encontré información en la base de datos que coincida con tu búsqueda."
         else:
-            # Convertimos los datos a string JSON para pasárselos al agente
-            data_string = json.dumps(db_results, default=str, ensure_ascii=False)
+            # Solo las columnas/filas relevantes, dentro del presupuesto de tokens
+            data_string = compact_rows_for_prompt(question, db_results)
             
             analysis_prompt = f"""
             Actúa como un asistente de ventas experto en movilidad eléctrica.
@@ -807,70 +4566,263 @@ async def query_generator(request: QueryRequest, db: Session = Depends(get_db)):
             - Sé conciso y persuasivo.
             """
             
-            logger.info("4. Enviando datos al agente para interpretación...")
-            final_message = await call_agent_api(analysis_prompt,AGENT_API_URL)
+            query_logger.info("4. Enviando datos al agente para interpretación...")
+            if stream_answer:
+                partes = []
+                started = time.perf_counter()
+                async for delta in call_agent_api_stream(analysis_prompt, AGENT_API_URL):
+                    partes.append(delta)
+                    yield "answer_delta", {"text": delta}
+                record_stage("query_answer", time.perf_counter() - started)
+                final_message = "".join(partes)
+            else:
+                with stage_timer("query_answer"):
+                    final_message = await call_agent_api(analysis_prompt,AGENT_API_URL)
 
         # ==============================================================================
         # PASO 5: RETORNO FINAL
         # ==============================================================================
-        logger.info("5. Paso final, enviando respuesta")
-        return responder(
-            status_code=200,
-            title="Asistente Virtual",
-            raw_data={
-                "mensaje": final_message, # El mensaje generado por la IA
-                "data_raw": db_results,   # Los datos crudos (opcional, útil para frontend)
-                "sql_debug": sql_clean    # Debug (opcional)
-            }
+        query_logger.info("5. Paso final, enviando respuesta")
+        yield "final", (200, "Asistente Virtual", {
+            "mensaje": final_message, # El mensaje generado por la IA
+            "data_raw": db_results,   # Los datos crudos (opcional, útil para frontend)
+            "sql_debug": sql_clean,   # Debug (opcional)
+            "sql_cache": "hit" if cached_sql else "miss",
+            "path": path              # fast_path / search / cache / agent
+        })
+
+    except AgentUnavailable as e:
+        query_logger.warning("Agente no disponible: %s", e)
+        yield "final", (503, "Servicio No Disponible", {
+            "mensaje": "El asistente no está disponible en este momento. Intenta de nuevo en unos segundos.",
+            "retry_after_s": round(e.retry_after, 1),
+            "sql_debug": sql_clean
+        })
+
+    except GuardrailError as e:
+        query_logger.warning("SQL rechazado por guardrails (%s): %s", e.motivo, e.mensaje)
+        yield "final", (422, "Consulta Rechazada", {
+            "mensaje": f"No pude ejecutar esa búsqueda de forma segura. {e.mensaje}",
+            "motivo": e.motivo,
+            "sql_debug": sql_clean
+        })
+
+    except Exception as e:
+        query_logger.error("Error crítico en query_generator: %s", e)
+        yield "final", (200, "Error en el sistema", {"mensaje": f"Ocurrió un problema procesando tu solicitud: {str(e)}"})
+
+
+def _stream_frame(event: str, data: Dict[str, Any], fmt: str) -> bytes:
+    """Serializa un evento como línea NDJSON o como mensaje SSE."""
+    if fmt == "sse":
+        return b"event: " + event.encode("utf-8") + b"\ndata: " + json_bytes(data) + b"\n\n"
+    return json_bytes({"event": event, "data": data}) + b"\n"
+
+
+async def _query_event_stream(question: str, function_call_username: Optional[str], fmt: str):
+    # Sesión propia: la del Depends puede cerrarse antes de que termine el stream
+    async with SessionLocal() as db:
+        async for event, data in query_pipeline(question, function_call_username, db, stream_answer=True):
+            if event == "final":
+                status_code, title, raw_data = data
+                data = {"status_code": status_code, **envelope(status_code, title, raw_data)}
+            yield _stream_frame(event, data, fmt)
+
+
+@app.post("/query-generator")
+async def query_generator(request: QueryRequest, db: AsyncSession = Depends(get_db),
+                          stream: Optional[str] = Query(None, description="ndjson o sse para recibir eventos por etapa")):
+    question = request.nlp_query
+    
+    # --- VALIDACIÓN INICIAL ---
+    if not question or not isinstance(question, str) or not question.strip():
+        return JSONResponse(status_code=400, content={
+            "raw": {"error": "Bad Request", "details": 'El campo "question" es requerido.'},
+            "markdown": "No hay datos.", "type": "markdown", "desc": "⚠️ Error: Pregunta vacía."
+        })
+
+    fmt = (stream or ("ndjson" if request.stream else "")).lower()
+    if fmt:
+        if fmt not in ("ndjson", "sse"):
+            return responder(400, "Error", {"mensaje": "stream debe ser 'ndjson' o 'sse'."})
+        media_type = "text/event-stream" if fmt == "sse" else "application/x-ndjson"
+        return StreamingResponse(
+            _query_event_stream(question, request.function_call_username, fmt),
+            media_type=media_type,
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
         )
 
+    async for event, data in query_pipeline(question, request.function_call_username, db):
+        if event == "final":
+            status_code, title, raw_data = data
+            return responder(status_code=status_code, title=title, raw_data=raw_data)
+
+async def _sql_row_stream(sql_query: str, fmt: str, max_rows: int):
+    """
+    Ejecuta la consulta con un cursor del lado del servidor y emite las filas
+    por lotes (NDJSON o CSV). La memoria se mantiene en un lote a la vez.
+    """
+    enviados = 0
+    try:
+        # Sesión propia: vive mientras dura el stream
+        async with SessionLocal() as db:
+            result = await db.stream(text(sql_query), execution_options={"yield_per": SQL_STREAM_BATCH})
+            keys = list(result.keys())
+            converters = None
+            if fmt == "csv":
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerow(keys)
+                yield buffer.getvalue().encode("utf-8")
+
+            async for batch in result.partitions(SQL_STREAM_BATCH):
+                batch = batch[:max_rows - enviados]
+                if converters is None:
+                    converters = row_converters(keys, batch)
+                if fmt == "csv":
+                    buffer = io.StringIO()
+                    writer = csv.writer(buffer)
+                    writer.writerows(["" if v is None else v for v in row] for row in batch)
+                    chunk = buffer.getvalue().encode("utf-8")
+                else:
+                    chunk = b"".join(json_bytes(item) + b"\n" for item in rows_to_dicts(keys, batch, converters))
+                enviados += len(batch)
+                yield chunk
+                if enviados >= max_rows:
+                    query_logger.info("Stream SQL truncado en %s filas", max_rows)
+                    break
+            await result.close()
+        query_logger.info("Stream SQL terminado: %s filas", enviados)
     except Exception as e:
-        logger.error(f"Error crítico en query_generator: {e}")
-        return responder(200, "Error en el sistema", {"mensaje": f"Ocurrió un problema procesando tu solicitud: {str(e)}"})
+        query_logger.error("Error en stream SQL tras %s filas: %s", enviados, e)
+        # El status 200 ya se envió: avisamos dentro del propio stream
+        if fmt == "csv":
+            yield f"# ERROR: {e}\n".encode("utf-8")
+        else:
+            yield json_bytes({"error": str(e), "filas_enviadas": enviados}) + b"\n"
+
 
 @app.post("/test-sql-raw")
-async def test_sql_raw(request: SqlRequest, db: Session = Depends(get_db)):
+async def test_sql_raw(request: SqlRequest, db: AsyncSession = Depends(get_db),
+                       stream: Optional[str] = Query(None, description="ndjson o csv para recibir las filas por lotes"),
+                       max_rows: Optional[int] = Query(None, ge=1, description="Tope de filas en modo stream")):
     """
     Endpoint para probar queries SQL manualmente.
     Uso: {"sql": "SELECT * FROM especificaciones_producto LIMIT 5"}
+    Con ?stream=ndjson|csv las filas se leen con cursor del servidor y se envían por lotes.
     """
     sql_query = request.sql
 
     if not sql_query or not sql_query.strip():
         return responder(400, "Error", {"mensaje": "La consulta SQL no puede estar vacía."})
 
+    if stream:
+        fmt = stream.lower()
+        if fmt not in ("ndjson", "csv"):
+            return responder(400, "Error", {"mensaje": "stream debe ser 'ndjson' o 'csv'."})
+        if not sql_query.strip().upper().startswith(("SELECT", "WITH")):
+            return responder(400, "Error", {"mensaje": "El modo stream solo acepta consultas SELECT."})
+        limite = min(max_rows or SQL_STREAM_MAX_ROWS, SQL_STREAM_MAX_ROWS)
+        query_logger.info("Ejecutando SQL manual en stream (%s, máx %s filas): %s", fmt, limite, sql_query)
+        return StreamingResponse(
+            _sql_row_stream(sql_query, fmt, limite),
+            media_type="text/csv" if fmt == "csv" else "application/x-ndjson",
+            headers={"X-Max-Rows": str(limite)}
+        )
+
     try:
-        logger.info(f"Ejecutando SQL manual: {sql_query}")
+        query_logger.info("Ejecutando SQL manual: %s", sql_query)
         
-        result = db.execute(text(sql_query))
+        result = await db.execute(text(sql_query))
         
         if result.returns_rows:
-            keys = result.keys()
-            # 1. Convertimos a diccionarios
-            data = [dict(zip(keys, row)) for row in result]
-            
-            # 2. SOLUCIÓN AL ERROR DATETIME:
-            # Serializamos a string JSON usando 'str' para tipos desconocidos (fechas, decimales)
-            # y luego lo volvemos a convertir a lista/dict de Python.
-            # Esto convierte datetime -> "2024-01-28T..."
-            data_serializable = json.loads(json.dumps(data, default=str))
+            # Diccionarios JSON-nativos en una sola pasada (fechas y decimales -> str)
+            data_serializable = serialize_rows(result)
             
             return responder(200, "Query Exitosa", {
                 "filas_encontradas": len(data_serializable),
                 "resultados": data_serializable
             })
         else:
-            db.commit()
+            await db.commit()
             return responder(200, "Ejecución Exitosa", {
                 "mensaje": f"Operación realizada. Filas afectadas: {result.rowcount}"
             })
 
     except Exception as e:
-        logger.error(f"Error ejecutando SQL manual: {e}")
+        query_logger.error("Error ejecutando SQL manual: %s", e)
         return responder(500, "Error SQL", {"detalle_error": str(e)})
 
 
 
+# --- /metrics ---
+
+@metrics.collector
+def _cache_and_pool_metrics():
+    muestras = [("query_path_total", "counter", {"path": p}, n) for p, n in query_path_counts.items()]
+    for nombre, cache in (("sql_translation", sql_cache), ("sql_template", sql_templates)):
+        muestras.append(("cache_hits_total", "counter", {"cache": nombre}, cache.hits))
+        muestras.append(("cache_misses_total", "counter", {"cache": nombre}, cache.misses))
+    muestras.append(("cache_hits_total", "counter", {"cache": "sql_translation_persistent"}, sql_cache.persistent_hits))
+    muestras.append(("cache_hits_total", "counter", {"cache": "lead"}, lead_cache.hits))
+    muestras.append(("cache_hits_total", "counter", {"cache": "lead_negative"}, lead_cache.negative_hits))
+    muestras.append(("cache_misses_total", "counter", {"cache": "lead"}, lead_cache.misses))
+    muestras.append(("lead_cache_entries", "gauge", {}, len(lead_cache._data)))
+    muestras.append(("log_records_dropped_total", "counter", {}, queue_handler.dropped))
+    muestras.append(("log_queue_depth", "gauge", {}, log_queue.qsize()))
+    for evento, valor in lead_writer.stats.items():
+        muestras.append(("lead_write_behind_total", "counter", {"event": evento}, valor))
+
+    pool = engine.sync_engine.pool
+    for estado, valor in (("checked_out", pool.checkedout()), ("idle", pool.checkedin()),
+                          ("overflow", max(pool.overflow(), 0)), ("size", pool.size())):
+        muestras.append(("db_pool_connections", "gauge", {"state": estado}, valor))
+
+    pool_http = getattr(getattr(getattr(http_client, "_transport", None), "inner", None), "_pool", None)
+    if pool_http is not None:
+        conexiones = pool_http.connections
+        ocupadas = sum(1 for c in conexiones if not c.is_idle())
+        muestras.append(("http_pool_connections", "gauge", {"state": "active"}, ocupadas))
+        muestras.append(("http_pool_connections", "gauge", {"state": "idle"}, len(conexiones) - ocupadas))
+    return muestras
+
+
+_BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+@metrics.collector
+def _agent_resilience_metrics():
+    muestras = [("agent_retry_budget_tokens", "gauge", {}, agent_retry_budget.tokens),
+                ("agent_retry_budget_exhausted_total", "counter", {}, agent_retry_budget.exhausted)]
+    for nombre, caller in agent_callers.items():
+        for evento, valor in caller.counts.items():
+            muestras.append(("agent_calls_total", "counter", {"caller": nombre, "event": evento}, valor))
+        muestras.append(("agent_breaker_state", "gauge", {"caller": nombre}, _BREAKER_STATES[caller.breaker.state]))
+        muestras.append(("agent_breaker_opened_total", "counter", {"caller": nombre}, caller.breaker.opened_total))
+        p95 = caller.latency_quantile(0.95)
+        if p95 is not None:
+            muestras.append(("agent_latency_p95_seconds", "gauge", {"caller": nombre}, p95))
+    return muestras
+
+
+@app.get("/agent-resilience/stats")
+async def agent_resilience_stats():
+    """Estado de los circuit breakers, presupuesto de reintentos, hedging y latencias del agente."""
+    abiertos = [n for n, c in agent_callers.items() if c.breaker.state != "closed"]
+    return responder(200, "Resiliencia del Agente", {
+        "callers": {n: c.stats() for n, c in agent_callers.items()},
+        "retry_budget": {"tokens": round(agent_retry_budget.tokens, 2), "capacity": agent_retry_budget.capacity,
+                         "ratio": agent_retry_budget.ratio, "exhausted": agent_retry_budget.exhausted},
+        "mensaje": f"Circuitos no cerrados: {', '.join(abiertos)}" if abiertos else "Todos los circuitos cerrados."
+    })
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Métricas en formato de exposición de texto de Prometheus."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/")
 async def health_check():
     return {"status": "online", "service": "Marketing Agent Database Tool"}
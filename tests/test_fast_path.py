@@ -0,0 +1,31 @@
+import pytest
+
+
+@pytest.mark.parametrize("question", [
+    "celular de 256 GB",                     # GB a secas por encima de una RAM plausible
+    "celular con 8gb de ram y 256gb",        # el segundo GB no es RAM
+    "celular con 8gb de ram y 12gb de ram",  # dos mínimos sobre la misma columna
+    "moto de 3 horas de carga",              # unidad (horas) vs. calificador (carga = kg)
+    "celular de 8 mah de ram",               # unidad y calificador de columnas distintas
+    "moto con 8gb",                          # unidad de la otra tabla
+    "moto de 60 km de ram",                  # calificador de la otra tabla
+])
+def test_ambiguous_questions_go_to_agent(main, question):
+    assert main.parse_catalog_intent(question) is None
+
+
+@pytest.mark.parametrize("question, filters", [
+    ("celulares con 8GB de RAM", [("ram_gb", ">=", 8.0)]),
+    ("celular con 8gb", [("ram_gb", ">=", 8.0)]),
+    ("celular con 256gb de almacenamiento", [("rom_gb", ">=", 256.0)]),
+    ("celular con 8gb de ram y 256gb de almacenamiento", [("ram_gb", ">=", 8.0), ("rom_gb", ">=", 256.0)]),
+    ("celulares de menos de $5000", [("precio_num", "<", 5000.0)]),
+    ("celulares de mas de $3000 y menos de $5000", [("precio_num", ">", 3000.0), ("precio_num", "<", 5000.0)]),
+    ("moto con mas de 60 km de autonomia", [("autonomia_km_num", ">", 60.0)]),
+    ("moto de 3 horas", [("tiempo_carga_horas", ">=", 3.0)]),
+    ("moto de 150 kg de carga", [("carga_max_kg", ">=", 150.0)]),
+])
+def test_fast_path_filters(main, question, filters):
+    intent = main.parse_catalog_intent(question)
+    assert intent is not None
+    assert intent.filters == filters
@@ -0,0 +1,53 @@
+import pytest
+
+
+def test_appends_limit_when_missing(main):
+    assert main.guard_sql("SELECT id FROM t", 50) == "SELECT id FROM t\nLIMIT 50"
+
+
+def test_caps_trailing_limit(main):
+    assert main.guard_sql("SELECT id FROM t LIMIT 1000 OFFSET 5", 50) == "SELECT id FROM t LIMIT 50 OFFSET 5"
+    assert main.guard_sql("SELECT id FROM t LIMIT 10", 50) == "SELECT id FROM t LIMIT 10"
+
+
+def test_offset_before_limit(main):
+    sql = "SELECT id FROM t ORDER BY id OFFSET 5 LIMIT 10"
+    assert main.guard_sql(sql, 50) == sql
+    assert main.guard_sql("SELECT id FROM t OFFSET 5 LIMIT 1000", 50) == "SELECT id FROM t OFFSET 5 LIMIT 50"
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT id FROM t ORDER BY id FETCH FIRST 5 ROWS ONLY",
+    "SELECT id FROM t ORDER BY id OFFSET 5",
+])
+def test_other_paging_forms_are_wrapped(main, sql):
+    assert main.guard_sql(sql, 50) == f"SELECT * FROM (\n{sql}\n) AS guarded_q LIMIT 50"
+
+
+def test_limit_inside_subquery_does_not_count(main):
+    sql = "SELECT * FROM (SELECT id FROM t LIMIT 5) s"
+    assert main.guard_sql(sql, 50) == sql + "\nLIMIT 50"
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT marca AS set, modelo AS do FROM dispositivos_moviles",
+    "SELECT t.set, t.do FROM t",
+    "SELECT id FROM t WHERE nombre = 'delete from t'",
+    "SELECT update_time, created_by FROM t",
+])
+def test_identifiers_named_like_keywords_are_allowed(main, sql):
+    assert main.guard_sql(sql, 50).startswith(sql)
+
+
+@pytest.mark.parametrize("sql", [
+    "WITH x AS (DELETE FROM t RETURNING *) SELECT * FROM x",
+    "WITH x AS (SELECT 1) DELETE FROM t",
+    "SELECT * INTO copia FROM t",
+    "SELECT * FROM t FOR UPDATE",
+    "SELECT pg_sleep(10)",
+    "SELECT 1; DROP TABLE t",
+    "UPDATE t SET a = 1",
+])
+def test_writes_and_side_effects_are_rejected(main, sql):
+    with pytest.raises(main.GuardrailError):
+        main.guard_sql(sql, 50)
@@ -0,0 +1,21 @@
+import logging
+import queue
+
+
+def test_full_log_queue_drops_and_counts(main, capsys):
+    handler = main.LazyQueueHandler(queue.Queue(maxsize=2))
+    log = logging.getLogger("tests.full_queue")
+    log.propagate = False
+    log.addHandler(handler)
+    try:
+        for i in range(5):
+            log.warning("registro %s", i)
+    finally:
+        log.removeHandler(handler)
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == 3
+    assert "Logging error" not in capsys.readouterr().err
+
+
+def test_dropped_records_exposed_on_metrics(main):
+    assert "log_records_dropped_total" in main.metrics.render()
@@ -0,0 +1,9 @@
+def test_sql_cache_declares_ttl_index(main):
+    spec = next(s for s in main.MONGO_INDEXES["sql_cache"] if s["name"] == "created_at_ttl")
+    assert spec["keys"] == [("created_at", 1)]
+    assert spec["expireAfterSeconds"] == main.SQL_CACHE_PERSIST_TTL
+
+    actual = {"key": [("created_at", 1)], "expireAfterSeconds": main.SQL_CACHE_PERSIST_TTL}
+    assert main._index_drift(spec, actual) is None
+    assert main._index_drift(spec, {**actual, "expireAfterSeconds": 60}).startswith("expireAfterSeconds=60")
+    assert main._index_drift(spec, {"key": [("created_at", 1)]}) is not None  # índice sin TTL
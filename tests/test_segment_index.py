@@ -0,0 +1,58 @@
+import asyncio
+import json
+import logging
+
+import httpx
+
+
+def _index(main, monkeypatch, users=250, total=True):
+    llamadas = {"pages": 0}
+
+    async def handler(request):
+        llamadas["pages"] += 1
+        await asyncio.sleep(0.01)
+        body = json.loads(request.content)
+        page, size = body["page"], body["pagesize"]
+        chats = [{"user_code": f"52155{i:08d}", "segment_code": f"seg-{i}"}
+                 for i in range((page - 1) * size, min(page * size, users))]
+        data = {"list": chats, "total": users} if total else {"list": chats}
+        return httpx.Response(200, json={"code": "000000", "data": data})
+
+    monkeypatch.setattr(main, "http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(main, "main_bot_credentials", lambda: ("acct", {"x": "y"}))
+    monkeypatch.setattr(main, "SEGMENT_PAGE_SIZE", 100)
+    return main.SegmentIndex(ttl=300), llamadas
+
+
+def test_misses_share_one_sweep_and_respect_min_interval(main, monkeypatch):
+    index, llamadas = _index(main, monkeypatch)
+
+    async def run():
+        # 20 leads sin chat a la vez: un solo barrido (3 páginas)
+        codes = await asyncio.gather(*(index.lookup(f"52199{i:08d}") for i in range(20)))
+        assert codes == [None] * 20
+        assert llamadas["pages"] == 3
+        # Índice viejo, pero el último intento fue hace poco: no se vuelve a barrer
+        index._built_at -= 120
+        assert await index.lookup("5219900000001") is None
+        assert llamadas["pages"] == 3
+        index._last_attempt -= 120
+        assert await index.lookup("5215500000007") == "seg-7"
+        assert await index.lookup("5219900000002") is None
+        assert llamadas["pages"] == 6
+
+    asyncio.run(run())
+
+
+def test_truncated_sweep_logs_warning(main, monkeypatch, caplog):
+    index, _ = _index(main, monkeypatch, users=250, total=False)
+    monkeypatch.setattr(main, "SEGMENT_MAX_PAGES", 2)
+    main.logger.propagate = True
+    try:
+        with caplog.at_level(logging.WARNING, logger="marketing_agent.chat"):
+            asyncio.run(index.refresh(force=True))
+    finally:
+        main.logger.propagate = False
+    assert index.truncated
+    assert len(index) == 200
+    assert any("truncado" in r.getMessage() for r in caplog.records)
@@ -0,0 +1,93 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+from sqlalchemy.exc import DataError, OperationalError, ProgrammingError
+
+
+class _Result:
+    def __init__(self, rows):
+        self._rows = rows
+
+    def all(self):
+        return self._rows
+
+    def keys(self):
+        return ["id"]
+
+
+class FakeIntColumnSession:
+    """Sesión que, como asyncpg con una columna int4, rechaza parámetros que no son int."""
+
+    def __init__(self):
+        self.executed = []
+        self.savepoints = 0
+
+    @asynccontextmanager
+    async def begin_nested(self):
+        self.savepoints += 1
+        yield
+
+    async def execute(self, stmt, params=None):
+        self.executed.append((str(stmt), params))
+        if params and not all(isinstance(v, int) for v in params.values()):
+            # asyncpg rechaza el valor al codificarlo: DataError sin SQLSTATE
+            raise DataError("SELECT", params, Exception("invalid input for query argument $1"))
+        return _Result([(1,)])
+
+
+def test_new_slot_types_are_retried_under_savepoint(main):
+    cache = main.SqlTemplateCache(10)
+    db = FakeIntColumnSession()
+
+    async def run():
+        await cache.execute(db, "SELECT id FROM t WHERE ram_gb = 8")        # int: se prueba y queda ok
+        await cache.execute(db, "SELECT id FROM t WHERE ram_gb = 12")       # int: directo
+        await cache.execute(db, "SELECT id FROM t WHERE ram_gb = 8.5")      # float: SAVEPOINT -> literal
+        await cache.execute(db, "SELECT id FROM t WHERE ram_gb = '8'")      # str: SAVEPOINT -> literal
+
+    asyncio.run(run())
+    assert db.savepoints == 3
+    assert db.executed[-1] == ("SELECT id FROM t WHERE ram_gb = '8'", None)
+    assert cache.fallbacks == 2
+    assert cache.stats()["states"] == {"ok": 1, "literal": 2}
+
+
+class _PgError(Exception):
+    def __init__(self, sqlstate):
+        super().__init__(sqlstate)
+        self.sqlstate = sqlstate
+
+
+class FailingSession(FakeIntColumnSession):
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+
+    async def execute(self, stmt, params=None):
+        self.executed.append((str(stmt), params))
+        raise self.error
+
+
+@pytest.mark.parametrize("error", [
+    OperationalError("SELECT", {}, _PgError("57014")),         # statement_timeout
+    ProgrammingError("SELECT", {}, _PgError("42703")),         # columna inexistente
+    ProgrammingError("SELECT", {}, _PgError("42601")),         # sintaxis
+])
+def test_non_type_errors_are_not_retried_as_literal(main, error):
+    cache = main.SqlTemplateCache(10)
+    db = FailingSession(error)
+    with pytest.raises(type(error)):
+        asyncio.run(cache.execute(db, "SELECT id FROM t WHERE ram_gb = 8"))
+    assert len(db.executed) == 1
+    assert cache.fallbacks == 0
+    assert cache.stats()["states"] == {"ok": 0, "literal": 0}
+
+
+def test_server_type_mismatch_falls_back(main):
+    cache = main.SqlTemplateCache(10)
+    db = FailingSession(ProgrammingError("SELECT", {}, _PgError("42883")))  # operator does not exist
+    with pytest.raises(ProgrammingError):
+        asyncio.run(cache.execute(db, "SELECT id FROM t WHERE name = 8"))
+    assert len(db.executed) == 2  # plantilla y luego el SQL literal
+    assert cache.stats()["states"] == {"ok": 0, "literal": 1}
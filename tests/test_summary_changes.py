@@ -0,0 +1,29 @@
+from datetime import datetime
+
+
+def _chat(*times):
+    return {"data": {"list": [{"question": "q", "answer": "a", "create_time": t} for t in times]}}
+
+
+def test_parse_message_time_formats(main):
+    esperado = datetime(2026, 10, 1, 10, 5, 0)
+    assert main.parse_message_time("2026-10-01 10:05:00") == esperado
+    assert main.parse_message_time("2026-10-01T10:05:00Z") == esperado
+    assert main.parse_message_time("2026-10-01T12:05:00+02:00") == esperado
+    assert main.parse_message_time("1790849100") == esperado
+    assert main.parse_message_time("2026-10-01 9:30:00") == datetime(2026, 10, 1, 9, 30, 0)
+    assert main.parse_message_time("1790849100000") == esperado
+    assert main.parse_message_time("ayer") is None
+
+
+def test_new_messages_compare_parsed_times(main):
+    # Como texto "2026-10-01 9:30:00" > "2026-10-01 10:00:00"; como fecha no es posterior
+    doc = {"last_message_at": "2026-10-01T10:00:00Z"}
+    assert not main._has_new_messages(doc, _chat("2026-10-01 9:30:00", "2026-10-01 10:00:00"))
+    assert main._has_new_messages(doc, _chat("2026-10-01 10:00:00", "2026-10-01 10:00:01"))
+    assert main._has_new_messages({}, _chat("2026-10-01 10:00:00"))
+
+
+def test_fingerprint_keeps_latest_original_text(main):
+    _, last = main.chat_fingerprint(_chat("2026-10-01 10:00:00", "2026-10-01 9:30:00"))
+    assert last == "2026-10-01 10:00:00"
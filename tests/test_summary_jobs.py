@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+from benchmark import FakeCollection
+
+
+def _runner(main, monkeypatch):
+    corridas = []
+
+    async def fake_batch(**kwargs):
+        corridas.append(kwargs)
+        await asyncio.sleep(0.05)
+        return {"processed": 0}
+
+    monkeypatch.setattr(main, "run_summary_batch", fake_batch)
+    monkeypatch.setattr(main, "users_collection", FakeCollection())
+    return main.SummaryJobRunner(FakeCollection(latency_ms=5), FakeCollection(latency_ms=5)), corridas
+
+
+def test_concurrent_starts_launch_one_job(main, monkeypatch):
+    runner, corridas = _runner(main, monkeypatch)
+
+    async def run():
+        resultados = await asyncio.gather(runner.start({}, trigger="manual"), runner.start({}, trigger="schedule"),
+                                          return_exceptions=True)
+        conflictos = [r for r in resultados if isinstance(r, main.JobConflict)]
+        assert len(conflictos) == 1
+        await runner.task
+        assert len(corridas) == 1
+        assert runner.locks.docs == {}
+
+    asyncio.run(run())
+
+
+def test_own_lease_only_reused_for_same_job(main, monkeypatch):
+    runner, _ = _runner(main, monkeypatch)
+
+    async def run():
+        assert await runner._acquire("job-a")
+        assert not await runner._acquire("job-b")
+        assert await runner._acquire("job-a")
+        # Liberar otro job no suelta el lease de job-a
+        await runner._release("job-b")
+        assert runner.locks.docs[main.SUMMARY_JOB_LOCK_ID]["job_id"] == "job-a"
+        await runner._release("job-a")
+        assert runner.locks.docs == {}
+
+    asyncio.run(run())